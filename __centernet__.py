@@ -78,7 +78,10 @@ def main():
         'write_submission': ['preprocessing', 'detection', 'classification', 'submission'],
         'test_submission': ['submission', 'test_submission'],
         'test_bboxes': ['visualization'],
-        'all': ['preprocessing', 'detection', 'classification', 'submission', 'visualization']
+        'all': ['preprocessing', 'detection', 'classification', 'submission', 'visualization'],
+        'infer': ['inference'],
+        'serve': ['serving'],
+        'export': ['exporting']
     }
 
     # Run the pipeline
@@ -1,11 +1,12 @@
 from typing import Dict, Generator, Tuple, List, Union
 
-import cv2
 import numpy as np
 import tensorflow as tf
-from PIL import Image
 from sklearn.model_selection import train_test_split
 
+from networks.classes.centernet.datasets.ClassificationSampleLoader import ClassificationSampleLoader
+from networks.classes.centernet.datasets.SampleWorkerPool import SampleWorkerPool
+
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -30,6 +31,20 @@ class ClassificationDataset:
         self.__x_val: List[str]
         self.__y_val: List[int]
 
+        # Loads the samples from files, or from the crops when they are kept in memory
+        self.__sample_loader = ClassificationSampleLoader(input_height=self.__input_height,
+                                                          input_width=self.__input_width)
+
+        # Pool of processes producing the training batches, None to use the single process generator
+        self.__worker_pool: Union[SampleWorkerPool, None] = None
+        if params.get('n_workers', 0) > 0:
+            self.__worker_pool = SampleWorkerPool(load_sample=self.__sample_loader.load_train_sample,
+                                                  input_shape=(self.__input_height, self.__input_width, 3),
+                                                  target_shape=(),
+                                                  batch_size=self.__batch_size,
+                                                  n_workers=params['n_workers'],
+                                                  seed=params.get('workers_seed', 0))
+
         self.__training_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
         self.__validation_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
         self.__evaluation_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
@@ -40,39 +55,18 @@ class ClassificationDataset:
                             is_train: bool = True,
                             random_crop: bool = True) -> Generator:
 
-        input_width, input_height = self.__input_width, self.__input_height
-
         x, y = [], []
         count = 0
 
         while True:
             for sample in data_list:
+                img, category = self.__sample_loader.load(sample, is_train, random_crop)
 
-                crop_ratio = np.random.uniform(0.8, 1) if random_crop else 1
-
-                with Image.open(sample[0]) as img:
-
-                    if random_crop and is_train:
-                        img_width, img_height = img.size
-                        img = np.asarray(img.convert('RGB'), dtype=np.uint8)
+                # Append the current image
+                x.append(img)
 
-                        top_offset = np.random.randint(0, img_height - int(crop_ratio * img_height))
-                        left_offset = np.random.randint(0, img_width - int(crop_ratio * img_width))
-                        bottom_offset = top_offset + int(crop_ratio * img_height)
-                        right_offset = left_offset + int(crop_ratio * img_width)
-
-                        img = cv2.resize(img[top_offset:bottom_offset, left_offset:right_offset, :],
-                                         (input_height, input_width))
-
-                    else:
-                        img = img.resize((input_width, input_height))
-                        img = np.asarray(img.convert('RGB'), dtype=np.uint8)
-
-                    # Append the current image
-                    x.append(img)
-
-                    # Append the category of the current image
-                    y.append(int(sample[1]))
+                # Append the category of the current image
+                y.append(category)
 
                 count += 1
 
@@ -102,12 +96,16 @@ class ClassificationDataset:
     #
     #     return image_resized / 255
 
-    def generate_dataset(self, train_list: List[Tuple[str, int]]) -> Tuple[List[List], List[List], List[List]]:
+    def generate_dataset(self,
+                         train_list: List[Tuple[Union[str, int], int]],
+                         images: Union[np.ndarray, None] = None) -> Tuple[List[List], List[List], List[List]]:
 
         """
         Generate the tf.data.Dataset containing all the objects.
 
         :param train_list: training list with samples as list of tuples (image, class)
+        :param images: the uint8 crops (N, H, W, 3) if they are in memory. In this case the samples in
+            train_list are tuples (crop index, class)
         :return: the split and shuffled train and validation set, in the same shape as 'train_list'
                 param.
         """
@@ -115,6 +113,8 @@ class ClassificationDataset:
         assert self.__evaluation_ratio + self.__training_ratio + self.__validation_ratio == 1, \
             'ERROR: Split ratios are not correctly set up!'
 
+        self.__sample_loader.set_images(images)
+
         training, xy_eval = train_test_split(train_list,
                                              random_state=797,
                                              shuffle=True,
@@ -129,11 +129,16 @@ class ClassificationDataset:
         self.__x_val, self.__y_val = zip(*xy_val)
         self.__x_eval, self.__y_eval = zip(*xy_eval)
 
+        if self.__worker_pool is None:
+            def training_generator():
+                return self.__dataset_generator(xy_train, is_train=True, random_crop=True)
+        else:
+            def training_generator():
+                return self.__worker_pool.generator(xy_train)
+
         self.__training_set = (
             tf.data.Dataset.from_generator(
-                lambda: self.__dataset_generator(xy_train,
-                                                 is_train=True,
-                                                 random_crop=True),
+                training_generator,
                 output_types=(np.float32,
                               np.float32))
                 .repeat()
@@ -0,0 +1,114 @@
+import os
+from typing import Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class ClassificationSampleLoader:
+    """
+    Loads the samples of the classification dataset. It holds only the input size and the crops kept
+    in memory, so that it can be pickled and sent to the processes of a SampleWorkerPool.
+
+    Memory-mapped crops (e.g. of a packed CropStore) are pickled as the path to their file and mapped
+    again when unpickled, the other in-memory crops are copied.
+    """
+
+    def __init__(self, input_height: int, input_width: int):
+        self.__input_height = input_height
+        self.__input_width = input_width
+
+        # The uint8 crops (N, H, W, 3) when they are kept in memory, None to read them from files
+        self.__images: Union[np.ndarray, None] = None
+
+    def set_images(self, images: Union[np.ndarray, None]):
+        self.__images = images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        images = self.__images
+
+        # Only a whole C-ordered memory map of a file can be mapped again from the file
+        if isinstance(images, np.memmap) and images.filename is not None and images.flags.c_contiguous \
+                and images.offset + images.nbytes == os.path.getsize(images.filename):
+            state['_ClassificationSampleLoader__images'] = (images.filename, images.dtype.str, images.shape,
+                                                             images.offset)
+
+        return state
+
+    def __setstate__(self, state):
+        images = state['_ClassificationSampleLoader__images']
+
+        if isinstance(images, tuple):
+            filename, dtype, shape, offset = images
+            state['_ClassificationSampleLoader__images'] = np.memmap(filename, dtype=np.dtype(dtype), mode='r',
+                                                                     shape=shape, offset=offset)
+
+        self.__dict__.update(state)
+
+    def load_train_sample(self, sample, rng=np.random) -> (np.ndarray, int):
+        """
+        Loads a training sample with a random crop, with the signature of the loading function of a SampleWorkerPool
+        """
+
+        return self.load(sample, is_train=True, random_crop=True, rng=rng)
+
+    def load(self,
+             sample,
+             is_train: bool = True,
+             random_crop: bool = True,
+             rng=np.random) -> (np.ndarray, int):
+        """
+        Loads the image and the category of a single sample
+
+        :param sample: the sample in the format (image path, class), or (crop index, class) when
+            the crops are in memory
+        :param is_train: whether the sample belongs to the training set
+        :param random_crop: whether to take a random crop of the image (training set only)
+        :param rng: the random number generator for the crops (numpy.random or a RandomState)
+        :return: the uint8 image and its category
+        """
+
+        input_width, input_height = self.__input_width, self.__input_height
+
+        crop_ratio = rng.uniform(0.8, 1) if random_crop else 1
+
+        if self.__images is not None:
+            # The sample is an index in the in-memory crops
+            img = self.__images[int(sample[0])]
+            img_height, img_width = img.shape[:2]
+
+            if random_crop and is_train:
+                top_offset = rng.randint(0, img_height - int(crop_ratio * img_height))
+                left_offset = rng.randint(0, img_width - int(crop_ratio * img_width))
+                bottom_offset = top_offset + int(crop_ratio * img_height)
+                right_offset = left_offset + int(crop_ratio * img_width)
+
+                img = cv2.resize(img[top_offset:bottom_offset, left_offset:right_offset, :],
+                                 (input_height, input_width))
+
+            elif (img_height, img_width) != (input_height, input_width):
+                img = cv2.resize(img, (input_width, input_height))
+
+            return img, int(sample[1])
+
+        with Image.open(sample[0]) as img:
+
+            if random_crop and is_train:
+                img_width, img_height = img.size
+                img = np.asarray(img.convert('RGB'), dtype=np.uint8)
+
+                top_offset = rng.randint(0, img_height - int(crop_ratio * img_height))
+                left_offset = rng.randint(0, img_width - int(crop_ratio * img_width))
+                bottom_offset = top_offset + int(crop_ratio * img_height)
+                right_offset = left_offset + int(crop_ratio * img_width)
+
+                img = cv2.resize(img[top_offset:bottom_offset, left_offset:right_offset, :],
+                                 (input_height, input_width))
+
+            else:
+                img = img.resize((input_width, input_height))
+                img = np.asarray(img.convert('RGB'), dtype=np.uint8)
+
+        return img, int(sample[1])
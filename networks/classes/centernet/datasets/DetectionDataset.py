@@ -1,11 +1,14 @@
 from typing import Dict, List, Tuple, Union
 
-import cv2
 import numpy as np
 import tensorflow as tf
-from PIL import Image
 from sklearn.model_selection import train_test_split
 
+from networks.classes.centernet.datasets.DetectionSampleLoader import DetectionSampleLoader
+from networks.classes.centernet.datasets.DetectionTargetCache import DetectionTargetCache
+from networks.classes.centernet.datasets.SampleWorkerPool import SampleWorkerPool
+from networks.classes.centernet.datasets.TargetRenderer import TargetRenderer
+
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -26,6 +29,31 @@ class DetectionDataset:
         self.__output_height = params['output_height']
         self.__output_width = params['output_width']
 
+        self.__target_renderer = TargetRenderer(output_height=self.__output_height,
+                                                output_width=self.__output_width)
+
+        # Cache of the non-cropped samples (evaluation set), None if disabled
+        self.__target_cache: Union[DetectionTargetCache, None] = None
+        if params.get('cache_targets', False):
+            self.__target_cache = DetectionTargetCache(cache_path=params.get('cache_path', 'datasets/cache'),
+                                                       csv_path=params['train_csv_path'],
+                                                       input_size=(self.__input_height, self.__input_width),
+                                                       output_size=(self.__output_height, self.__output_width))
+
+        self.__sample_loader = DetectionSampleLoader(input_height=self.__input_height,
+                                                     input_width=self.__input_width,
+                                                     target_renderer=self.__target_renderer)
+
+        # Pool of processes producing the training batches, None to use the single process generator
+        self.__worker_pool: Union[SampleWorkerPool, None] = None
+        if params.get('n_workers', 0) > 0:
+            self.__worker_pool = SampleWorkerPool(load_sample=self.__sample_loader.load_train_sample,
+                                                  input_shape=(self.__input_height, self.__input_width, 3),
+                                                  target_shape=(self.__output_height, self.__output_width, 6),
+                                                  batch_size=self.__batch_size,
+                                                  n_workers=params['n_workers'],
+                                                  seed=params.get('workers_seed', 0))
+
         self.__validation_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
         self.__training_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
         self.__evaluation_set: Tuple[Union[tf.data.Dataset, None], int] = (None, 0)
@@ -40,122 +68,17 @@ class DetectionDataset:
 
         :param list_samples: the list of samples the dataset will contain
         :param batch_size:
-
-        Note that in the original paper, the heatmap is computed as:
-        * exp(-((x_distance_from_center) ^ 2 + (y_distance_from_center) ^ 2) / (2 * sig ^ 2))
-
-        Here:
-        - x_distance_from_center = np.arange(output_width) - x_c
-        - y_distance_from_center = np.arange(output_height) - y_c
-        - sigma = (width / 10) and (height / 10).
-
-        Multiplying allows to consider the shape of characters as ellipses, instead of circles.
-        The result is a 2D array
         """
 
-        input_height, input_width = self.__input_height, self.__input_width
-        output_height, output_width = self.__output_height, self.__output_width
-
-        category_n = 1
-        output_layer_n = category_n + 4
-
         x, y = [], []
 
         count = 0
 
         while True:
-            for i in range(len(list_samples)):
-                h_split = list_samples[i][2]
-                w_split = list_samples[i][3]
-
-                max_crop_ratio_h = 1 / h_split
-                max_crop_ratio_w = 1 / w_split
-
-                crop_ratio = np.random.uniform(0.5, 1)
-                crop_ratio_h = max_crop_ratio_h * crop_ratio
-                crop_ratio_w = max_crop_ratio_w * crop_ratio
-
-                with Image.open(list_samples[i][0]) as f:
-
-                    pic_width, pic_height = f.size
-
-                    if random_crop:
-                        f = np.asarray(f.convert('RGB'), dtype=np.uint8)
-
-                        top_offset = np.random.randint(0, pic_height - int(crop_ratio_h * pic_height))
-                        left_offset = np.random.randint(0, pic_width - int(crop_ratio_w * pic_width))
-                        bottom_offset = top_offset + int(crop_ratio_h * pic_height)
-                        right_offset = left_offset + int(crop_ratio_w * pic_width)
-
-                        f = cv2.resize(f[top_offset:bottom_offset, left_offset:right_offset, :],
-                                       (input_height, input_width))
-                    else:
-                        # No crop
-                        top_offset, left_offset, bottom_offset, right_offset = 0, 0, 0, 0
-                        crop_ratio, crop_ratio_h, crop_ratio_w = 1, 1, 1
-                        f = f.resize((input_width, input_height))
-                        f = np.asarray(f.convert('RGB'), dtype=np.uint8)
-
-                    x.append(f)
-
-                output_layer = np.zeros((output_height, output_width, (output_layer_n + category_n)))
-
-                # list_samples has the following structure:
-                # list_samples[0] = path to image
-                # list_samples[1] = ann
-                # list_samples[2] = recommended height split
-                # list_samples[3] = recommended width split
-                # Where 'ann' the bbox data:
-                # ann[:, 1] = xmin
-                # ann[:, 2] = ymin
-                # ann[:, 3] = x width
-                # ann[:, 4] = y height
-
-                for annotation in list_samples[i][1]:
-                    x_c = (annotation[1] - left_offset) * (output_width / int(crop_ratio_w * pic_width))
-                    y_c = (annotation[2] - top_offset) * (output_height / int(crop_ratio_h * pic_height))
-
-                    # Divide by output stride (pic_width * crop / out_width)
-                    width = annotation[3] * (output_width / int(crop_ratio_w * pic_width))
-                    height = annotation[4] * (output_height / int(crop_ratio_h * pic_height))
-
-                    top = np.maximum(0, y_c - height / 2)
-                    left = np.maximum(0, x_c - width / 2)
-                    bottom = np.minimum(output_height, y_c + height / 2)
-                    right = np.minimum(output_width, x_c + width / 2)
-
-                    # Random crop (out of picture)
-                    if top >= (output_height - 0.1) or left >= (output_width - 0.1) \
-                            or bottom <= 0.1 or right <= 0.1:
-                        continue
-
-                    width = right - left
-                    height = bottom - top
-
-                    x_c = (right + left) / 2
-                    y_c = (top + bottom) / 2
-
-                    # Gaussian kernel
-                    heatmap = (
-                            (np.exp(
-                                -(((np.arange(output_width) - x_c) / (width / 10)) ** 2) / 2
-                            ))
-                            .reshape(1, -1) *
-                            (np.exp(
-                                -(((np.arange(output_height) - y_c) / (height / 10)) ** 2) / 2
-                            ))
-                            .reshape(-1, 1)
-                    )
-                    # Center points will have value closer to 1 (close to 0 otherwise)
-
-                    # Category heatmap
-                    output_layer[:, :, 0] = np.maximum(output_layer[:, :, 0], heatmap[:, :])
-                    output_layer[int(y_c // 1), int(x_c // 1), 1] = 1
-                    output_layer[int(y_c // 1), int(x_c // 1), 2] = y_c % 1  # height offset
-                    output_layer[int(y_c // 1), int(x_c // 1), 3] = x_c % 1
-                    output_layer[int(y_c // 1), int(x_c // 1), 4] = height / output_height
-                    output_layer[int(y_c // 1), int(x_c // 1), 5] = width / output_width
+            for sample in list_samples:
+                f, output_layer = self.__sample_loader.load(sample, random_crop)
 
+                x.append(f)
                 y.append(output_layer)
 
                 count += 1
@@ -172,6 +95,55 @@ class DetectionDataset:
 
                     yield inputs, targets
 
+    def __cached_dataset_generator(self, list_samples, batch_size) -> (np.float32, np.float32):
+        """
+        Generates a dataset of non-cropped samples reading inputs and targets from the on-disk cache.
+        The cache is built on the first call, later epochs only slice the memory-mapped arrays.
+
+        :param list_samples: the list of samples the dataset will contain
+        :param batch_size:
+        """
+
+        inputs, targets = self.__target_cache.load(list_samples)
+
+        if inputs is None:
+            inputs, targets = self.__target_cache.build(list_samples,
+                                                        load_sample=lambda s: self.__sample_loader.load(s, random_crop=False))
+
+        n_samples = len(list_samples)
+        start = 0
+
+        while True:
+            end = start + batch_size
+
+            # Batches span the end of the epoch as in the uncached generator, wrapping around as many
+            # times as needed if the batch is larger than the samples
+            if end <= n_samples:
+                x, y = inputs[start:end], targets[start:end]
+            else:
+                indices = np.arange(start, end) % n_samples
+                x, y = np.take(inputs, indices, axis=0), np.take(targets, indices, axis=0)
+
+            start = end % n_samples
+
+            yield x.astype(np.float32) / 255, y.astype(np.float32)
+
+    @staticmethod
+    def resize_image(image, input_height: int, input_width: int) -> tf.Tensor:
+        """
+        Resizes a page to the input of the model and normalizes it, as the pages of the test set. Pages
+        predicted outside of the test set (e.g. received by a service) must be resized the same way
+
+        :param image: the uint8 page, with shape (height, width, 3)
+        :param input_height: the height of the input of the model
+        :param input_width: the width of the input of the model
+        :return: the resized page, with values in [0, 1]
+        """
+
+        image_resized = tf.image.resize(image, (input_height, input_width))
+
+        return image_resized / 255
+
     def __test_resize_fn(self, path):
         """
         Utility function for image resizing
@@ -182,9 +154,8 @@ class DetectionDataset:
 
         image_string = tf.read_file(path)
         image_decoded = tf.image.decode_jpeg(image_string)
-        image_resized = tf.image.resize(image_decoded, (self.__input_height, self.__input_width))
 
-        return image_resized / 255
+        return self.resize_image(image_decoded, self.__input_height, self.__input_width)
 
     def generate_dataset(self,
                          train_list: List[List],
@@ -212,11 +183,16 @@ class DetectionDataset:
                                             shuffle=True,
                                             train_size=int(self.__training_ratio * len(train_list)))
 
+        if self.__worker_pool is None:
+            def training_generator():
+                return self.__dataset_generator(xy_train, self.__batch_size, random_crop=True)
+        else:
+            def training_generator():
+                return self.__worker_pool.generator(xy_train)
+
         self.__training_set = (
             tf.data.Dataset.from_generator(
-                lambda: self.__dataset_generator(xy_train,
-                                                 self.__batch_size,
-                                                 random_crop=True),
+                training_generator,
                 output_types=(np.float32,
                               np.float32))
                 .repeat()
@@ -236,11 +212,17 @@ class DetectionDataset:
                 len(xy_val))
 
         if len(xy_eval):
+            # The evaluation set is not cropped, so its samples can be read from the cache
+            if self.__target_cache is None:
+                def evaluation_generator():
+                    return self.__dataset_generator(xy_eval, self.__batch_size, random_crop=False)
+            else:
+                def evaluation_generator():
+                    return self.__cached_dataset_generator(xy_eval, self.__batch_size)
+
             self.__evaluation_set = (
                 tf.data.Dataset.from_generator(
-                    lambda: self.__dataset_generator(xy_eval,
-                                                     self.__batch_size,
-                                                     random_crop=False),
+                    evaluation_generator,
                     output_types=(np.float32,
                                   np.float32))
                     .repeat()
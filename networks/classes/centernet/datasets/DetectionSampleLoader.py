@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from networks.classes.centernet.datasets.TargetRenderer import TargetRenderer
+
+
+class DetectionSampleLoader:
+    """
+    Loads the samples of the detection dataset. It holds only the input size and the target renderer,
+    so that it can be pickled and sent to the processes of a SampleWorkerPool.
+    """
+
+    def __init__(self, input_height: int, input_width: int, target_renderer: TargetRenderer):
+        self.__input_height = input_height
+        self.__input_width = input_width
+        self.__target_renderer = target_renderer
+
+    def load_train_sample(self, sample, rng=np.random) -> (np.ndarray, np.ndarray):
+        """
+        Loads a training sample with a random crop, with the signature of the loading function of a SampleWorkerPool
+        """
+
+        return self.load(sample, random_crop=True, rng=rng)
+
+    def load(self, sample, random_crop: bool = True, rng=np.random) -> (np.ndarray, np.ndarray):
+        """
+        Loads the input image and renders the targets of a single sample
+
+        :param sample: the sample in the format [image path, annotations, height split, width split]
+        :param random_crop: whether to take a random crop of the image
+        :param rng: the random number generator for the crops (numpy.random or a RandomState)
+        :return: the uint8 input image and the targets
+
+        The targets are rendered by TargetRenderer (see TargetRenderer.render_dense for the heatmap formula)
+        """
+
+        input_height, input_width = self.__input_height, self.__input_width
+
+        h_split = sample[2]
+        w_split = sample[3]
+
+        max_crop_ratio_h = 1 / h_split
+        max_crop_ratio_w = 1 / w_split
+
+        crop_ratio = rng.uniform(0.5, 1)
+        crop_ratio_h = max_crop_ratio_h * crop_ratio
+        crop_ratio_w = max_crop_ratio_w * crop_ratio
+
+        with Image.open(sample[0]) as f:
+
+            pic_width, pic_height = f.size
+
+            if random_crop:
+                f = np.asarray(f.convert('RGB'), dtype=np.uint8)
+
+                top_offset = rng.randint(0, pic_height - int(crop_ratio_h * pic_height))
+                left_offset = rng.randint(0, pic_width - int(crop_ratio_w * pic_width))
+                bottom_offset = top_offset + int(crop_ratio_h * pic_height)
+                right_offset = left_offset + int(crop_ratio_w * pic_width)
+
+                f = cv2.resize(f[top_offset:bottom_offset, left_offset:right_offset, :],
+                               (input_height, input_width))
+            else:
+                # No crop
+                top_offset, left_offset, bottom_offset, right_offset = 0, 0, 0, 0
+                crop_ratio, crop_ratio_h, crop_ratio_w = 1, 1, 1
+                f = f.resize((input_width, input_height))
+                f = np.asarray(f.convert('RGB'), dtype=np.uint8)
+
+        # sample has the following structure:
+        # sample[0] = path to image
+        # sample[1] = ann
+        # sample[2] = recommended height split
+        # sample[3] = recommended width split
+        # Where 'ann' the bbox data:
+        # ann[:, 1] = xmin
+        # ann[:, 2] = ymin
+        # ann[:, 3] = x width
+        # ann[:, 4] = y height
+
+        output_layer = self.__target_renderer.render(sample[1],
+                                                     top_offset=top_offset,
+                                                     left_offset=left_offset,
+                                                     crop_height=int(crop_ratio_h * pic_height),
+                                                     crop_width=int(crop_ratio_w * pic_width))
+
+        return f, output_layer
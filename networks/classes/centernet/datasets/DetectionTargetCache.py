@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+
+class DetectionTargetCache:
+    """
+    On-disk cache of the inputs and targets of non-cropped detection samples.
+
+    Each set of samples is stored in a folder named after a key derived from the content of the
+    train csv, the input and output sizes and the list of image paths. The folder contains:
+    - inputs.npy: uint8 array (N, input_height, input_width, 3) of resized images
+    - targets.npy: float16 array (N, output_height, output_width, 6) of targets
+    - meta.json: written last, marks the cache as complete
+
+    Arrays are opened as memory maps, so slicing them reads only the requested samples.
+    """
+
+    def __init__(self,
+                 cache_path: str,
+                 csv_path: str,
+                 input_size: Tuple[int, int],
+                 output_size: Tuple[int, int],
+                 n_channels: int = 6):
+        self.__cache_path = cache_path
+        self.__csv_path = csv_path
+        self.__input_size = input_size
+        self.__output_size = output_size
+        self.__n_channels = n_channels
+        self.__csv_hash: Union[str, None] = None
+
+    def __hash_csv(self) -> str:
+        if self.__csv_hash is None:
+            csv_hash = hashlib.sha1()
+
+            with open(self.__csv_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    csv_hash.update(chunk)
+
+            self.__csv_hash = csv_hash.hexdigest()
+
+        return self.__csv_hash
+
+    def __get_folder(self, samples: List) -> str:
+        key = hashlib.sha1()
+        key.update(self.__hash_csv().encode())
+        key.update(json.dumps([self.__input_size, self.__output_size, self.__n_channels]).encode())
+        key.update('\n'.join(str(sample[0]) for sample in samples).encode())
+
+        return os.path.join(self.__cache_path, 'detection_' + key.hexdigest())
+
+    def load(self, samples: List) -> Tuple[Union[np.ndarray, None], Union[np.ndarray, None]]:
+        """
+        Opens the cached arrays of the given samples
+
+        :param samples: the samples in the format [[image path, annotations, height split, width split]]
+        :return: the memory-mapped inputs and targets, or (None, None) if the cache is missing
+        """
+
+        folder = self.__get_folder(samples)
+
+        if not os.path.isfile(os.path.join(folder, 'meta.json')):
+            return None, None
+
+        inputs = np.load(os.path.join(folder, 'inputs.npy'), mmap_mode='r')
+        targets = np.load(os.path.join(folder, 'targets.npy'), mmap_mode='r')
+
+        return inputs, targets
+
+    def build(self, samples: List, load_sample: Callable) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Computes and stores the inputs and targets of the given samples
+
+        :param samples: the samples in the format [[image path, annotations, height split, width split]]
+        :param load_sample: a function returning the uint8 input image and the targets of a sample
+        :return: the memory-mapped inputs and targets
+        """
+
+        folder = self.__get_folder(samples)
+        os.makedirs(folder, exist_ok=True)
+
+        input_height, input_width = self.__input_size
+        output_height, output_width = self.__output_size
+
+        inputs = np.lib.format.open_memmap(os.path.join(folder, 'inputs.npy'),
+                                           mode='w+',
+                                           dtype=np.uint8,
+                                           shape=(len(samples), input_height, input_width, 3))
+        targets = np.lib.format.open_memmap(os.path.join(folder, 'targets.npy'),
+                                            mode='w+',
+                                            dtype=np.float16,
+                                            shape=(len(samples), output_height, output_width, self.__n_channels))
+
+        for i, sample in enumerate(tqdm(samples, desc='Caching detection targets')):
+            inputs[i], targets[i] = load_sample(sample)
+
+        inputs.flush()
+        targets.flush()
+        del inputs, targets
+
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({'csv_path': self.__csv_path,
+                       'csv_sha1': self.__hash_csv(),
+                       'input_size': self.__input_size,
+                       'output_size': self.__output_size,
+                       'n_samples': len(samples)}, f, indent=4)
+
+        return self.load(samples)
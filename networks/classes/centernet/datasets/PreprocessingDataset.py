@@ -1,12 +1,12 @@
 from typing import Dict, List, Tuple
-from collections import OrderedDict
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import tensorflow as tf
-from PIL import Image
 from math import log
 
+from networks.classes.centernet.utils.ImageSizeIndex import DEFAULT_INDEX_PATH, get_image_size_index
+
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -20,7 +20,15 @@ class PreprocessingDataset:
         self.__training_ratio = params['training_ratio']
         self.__batch_size = params['batch_size']
 
+        # Whether to preprocess the images with native TF ops instead of tf.py_function
+        self.__native_preprocessing = params.get('native_preprocessing', False)
+        self.__preprocessing_seed = params.get('preprocessing_seed', 0)
+
+        self.__image_sizes = get_image_size_index(params.get('image_index_path', DEFAULT_INDEX_PATH))
+
         self.__train_list: List[Tuple[str, np.array]] = []
+        self.__annotations: np.ndarray = np.empty((0, 6), dtype='int32')
+        self.__annotation_offsets: np.ndarray = np.zeros(1, dtype=np.int64)
         self.__w_and_h: List[float] = []
         self.__dict_cat: Dict[str, int] = {}
         self.__class_weights: Dict[int, float] = {}
@@ -33,6 +41,9 @@ class PreprocessingDataset:
     def get_class_weights(self) -> Dict[int, float]:
         return self.__class_weights
 
+    def get_annotation_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.__annotations, self.__annotation_offsets
+
     def generate_dataset(self):
         # Generate a train list of tuples where each row represents an image and the list of the
         # characters within it (codified as integers) with relative coordinates of bbox
@@ -47,30 +58,20 @@ class PreprocessingDataset:
     def __get_dataset_labels(self) -> List[float]:
         return [img_data[1] for img_data in self.__train_image_avg_char_area_ratios]
 
-    def __set_class_encoding(self, df_train, show_frequency=False):
-        # Initialize an empty dictionary of <unicode> -> <class frequency>
-        class_frequencies = {}
-
-        # Iterate over the rows of the train list
-        for i in range(len(df_train)):
-            # Get one row for each label character w.r.t. image i, as: <category> <x> <y> <width> <height>
-            ann = np.array(df_train.loc[i, "labels"].split(" ")).reshape(-1, 5)
-
-            # Iterate over the unicodes of the current row
-            for unicode in ann[:, 0]:
-                # Update the frequency of class <unicode>
-                frequency = class_frequencies.setdefault(unicode, 0) + 1
-                class_frequencies[unicode] = frequency
+    def __set_class_encoding(self, category_names: np.ndarray, frequencies: np.ndarray, show_frequency=False):
+        """
+        Sets the integer encoding and the weights of the classes
 
-        # Sort the dictionary of frequencies
-        ord_class_frequencies = OrderedDict(sorted(class_frequencies.items()))
+        :param category_names: the sorted unicodes of the classes
+        :param frequencies: the number of occurrences of each class
+        :param show_frequency: whether to plot the class frequencies and weights
+        """
 
         # Make a dict assigning an integer to each category
-        category_names = ord_class_frequencies.keys()
-        self.__dict_cat: Dict[str, int] = {list(category_names)[j]: j for j in range(len(category_names))}
+        self.__dict_cat: Dict[str, int] = {category_name: j for j, category_name in enumerate(category_names)}
 
         # Set up a dictionary of frequencies as: <int class code> -> <frequency>
-        dict_frequencies = {self.__dict_cat[k]: ord_class_frequencies[k] for k in self.__dict_cat.keys()}
+        dict_frequencies = {j: int(frequency) for j, frequency in enumerate(frequencies)}
 
         # Set up the dictionary of class weights as: <int class code> -> <relative frequency>
         num_occurs = sum(dict_frequencies.values())
@@ -97,6 +98,10 @@ class PreprocessingDataset:
     def __parse_train_csv(self):
         """
         Read training csv and generate a list with char classes and bounding box in a convenient format.
+
+        The labels of all the images are parsed at once into a flat annotation table with columns
+        <image index> <class> <x_center> <y_center> <width> <height>, where the annotations of image i
+        are the rows in [offsets[i], offsets[i + 1]).
         """
 
         # Read the train list from csv
@@ -106,43 +111,64 @@ class PreprocessingDataset:
         df_train = df_train.dropna(axis=0, how='any')
         df_train = df_train.reset_index(drop=True)
 
-        self.__set_class_encoding(df_train)
-
-        for i in range(len(df_train)):
-            # Get one row for each label character for image i, as: <category> <x> <y> <width> <height>
-            ann = np.array(df_train.loc[i, "labels"].split(" ")).reshape(-1, 5)
-
-            # Iterate over categories in first column of annotations (characters)
-            for j, category_name in enumerate(ann[:, 0]):
-                # Change categories in integer values
-                ann[j, 0] = int(self.__dict_cat[category_name])
-
-            # Calculate the center of each bbox
-            # Before the operations:
-            # - ann[:, 0] = class
-            # - ann[:, 1] = xmin
-            # - ann[:, 2] = ymin
-            # - ann[:, 3] = x width
-            # - ann[:, 4] = y height
-
-            ann = ann.astype('int32')
-
-            # center_x
-            ann[:, 1] += ann[:, 3] // 2
-
-            # center_y
-            ann[:, 2] += ann[:, 4] // 2
-
-            # After the operations:
-            #    ann[:, 0] = class
-            # -> ann[:, 1] = x_center
-            # -> ann[:, 2] = y_center
-            #    ann[:, 3] = x width
-            #    ann[:, 4] = y height
-
-            self.__train_list.append(
-                ("{}/{}.jpg".format(self.__train_images_path, df_train.loc[i, "image_id"]),
-                 ann))
+        labels = df_train['labels']
+
+        # Number of characters in each image, each one as: <category> <x> <y> <width> <height>
+        chars_per_image = ((labels.str.count(' ').values + 1) // 5).astype(np.int64)
+        self.__annotation_offsets = np.concatenate(([0], np.cumsum(chars_per_image)))
+
+        # Split the labels of all the images with a single pass, 5 tokens for each character
+        tokens = ' '.join(labels).split(' ')
+
+        # Change categories in integer values, sorted by unicode
+        codes, category_names = pd.factorize(pd.Series(tokens[0::5]))
+        order = np.argsort(category_names)
+        category_ranks = np.empty(len(order), dtype=np.int64)
+        category_ranks[order] = np.arange(len(order))
+
+        categories = category_ranks[codes]
+        self.__set_class_encoding(category_names[order], np.bincount(categories, minlength=len(order)))
+
+        # Parse all the coordinates at once, as: <x> <y> <width> <height>
+        del tokens[0::5]
+        coordinates = np.fromstring(' '.join(tokens), sep=' ', dtype='int32').reshape(-1, 4)
+
+        # Before the operations:
+        # - ann[:, 0] = image index
+        # - ann[:, 1] = class
+        # - ann[:, 2] = xmin
+        # - ann[:, 3] = ymin
+        # - ann[:, 4] = x width
+        # - ann[:, 5] = y height
+
+        annotations = np.empty((len(categories), 6), dtype='int32')
+        annotations[:, 0] = np.repeat(np.arange(len(df_train)), chars_per_image)
+        annotations[:, 1] = categories
+        annotations[:, 2:] = coordinates
+
+        # Calculate the center of each bbox
+        # center_x
+        annotations[:, 2] += annotations[:, 4] // 2
+
+        # center_y
+        annotations[:, 3] += annotations[:, 5] // 2
+
+        # After the operations:
+        #    ann[:, 0] = image index
+        #    ann[:, 1] = class
+        # -> ann[:, 2] = x_center
+        # -> ann[:, 3] = y_center
+        #    ann[:, 4] = x width
+        #    ann[:, 5] = y height
+
+        self.__annotations = annotations
+
+        # The annotations of each image, without the image index
+        self.__train_list = [
+            ("{}/{}.jpg".format(self.__train_images_path, image_id), annotations[start:end, 1:])
+            for image_id, start, end in zip(df_train['image_id'],
+                                            self.__annotation_offsets[:-1],
+                                            self.__annotation_offsets[1:])]
 
     def __annotate_char_area_ratio(self, show_plot: bool = False):
         """
@@ -156,30 +182,29 @@ class PreprocessingDataset:
         self.__train_image_avg_char_area_ratios: List[Tuple[str, np.array]] = []
         all_avg_char_area_ratio: List[np.array] = []
 
-        for img_path, ann in self.__train_list:
-            with Image.open(img_path) as img:
-                # Image dimensions
-                width, height = img.size
+        # Image dimensions, read from the headers through the persistent index
+        img_sizes = self.__image_sizes.get_sizes([img_path for img_path, _ in self.__train_list])
 
-                # Image img_area
-                img_area = width * height
-                aspect_ratio = height / width
+        for (img_path, ann), (width, height) in zip(self.__train_list, img_sizes):
+            # Image img_area
+            img_area = width * height
+            aspect_ratio = height / width
 
-                # Bbox img_area for each character in image (width * height)
-                char_area = ann[:, 3] * ann[:, 4]
+            # Bbox img_area for each character in image (width * height)
+            char_area = ann[:, 3] * ann[:, 4]
 
-                # List of ratios for each character
-                char_area_ratio = char_area / img_area
+            # List of ratios for each character
+            char_area_ratio = char_area / img_area
 
-                # Take the mean and append it to a list
-                avg_char_area_ratio = np.mean(char_area_ratio)
-                all_avg_char_area_ratio.append(avg_char_area_ratio)
+            # Take the mean and append it to a list
+            avg_char_area_ratio = np.mean(char_area_ratio)
+            all_avg_char_area_ratio.append(avg_char_area_ratio)
 
-                # Add example for training with image path and log average bbox size for objects in it
-                self.__train_image_avg_char_area_ratios.append((img_path, avg_char_area_ratio))
+            # Add example for training with image path and log average bbox size for objects in it
+            self.__train_image_avg_char_area_ratios.append((img_path, avg_char_area_ratio))
 
-                # Add aspect ratio
-                self.__aspect_ratios.append(aspect_ratio)
+            # Add aspect ratio
+            self.__aspect_ratios.append(aspect_ratio)
 
         if show_plot:
             plt.hist(np.log(all_avg_char_area_ratio), bins=100)
@@ -279,6 +304,65 @@ class PreprocessingDataset:
 
         return image_resized, label
 
+    def __preprocess_image_native(self, index, image, label, is_train=True, random_crop=True):
+        """
+        Processes an image with native TF ops only, so that the map is not serialized by the GIL.
+        The crop follows the same logic of __preprocess_image, drawing the random values with
+        stateless ops seeded by the preprocessing seed and the index of the element.
+
+        :param index: the index of the element over all the epochs, used to seed the random crop
+        :param image: tensor representing image path
+        :param label: tensor representing label
+        :param is_train: true if preprocessing for training set, else false
+        :param random_crop: whether to apply a random crop
+        :return: image and labels tensors.
+        """
+
+        input_width, input_height = self.__input_width, self.__input_height
+
+        # Load image
+        image_string = tf.read_file(image)
+        image_decoded = tf.image.decode_jpeg(image_string, channels=3)
+
+        if random_crop and is_train:
+            seed = tf.stack([tf.constant(self.__preprocessing_seed, dtype=tf.int64), tf.cast(index, tf.int64)])
+
+            # Draw the crop ratio and the relative offsets of the crop at once
+            random_values = tf.random.stateless_uniform([3], seed=seed, dtype=tf.float64)
+            crop_ratio = 0.7 + 0.3 * random_values[0]
+
+            # Get image size
+            image_shape = tf.cast(tf.shape(image_decoded), tf.float64)
+            pic_height, pic_width = image_shape[0], image_shape[1]
+
+            crop_height = tf.floor(crop_ratio * pic_height)
+            crop_width = tf.floor(crop_ratio * pic_width)
+
+            # Compute the offsets (integer pixels in [0, pic size - crop size))
+            top_offset = tf.floor(random_values[1] * (pic_height - crop_height)) / (pic_height - 1)
+            left_offset = tf.floor(random_values[2] * (pic_width - crop_width)) / (pic_width - 1)
+            bottom_offset = top_offset + crop_height / (pic_height - 1)
+            right_offset = left_offset + crop_width / (pic_width - 1)
+
+            boxes = tf.cast(tf.stack([[top_offset, left_offset, bottom_offset, right_offset]]), tf.float32)
+
+            # Resize the image
+            image_resized = tf.image.crop_and_resize(image=tf.expand_dims(image_decoded, 0),
+                                                     box_ind=[0],
+                                                     boxes=boxes,
+                                                     crop_size=[input_width, input_height])[0]
+
+            # Update average bbox size after cropping
+            label -= tf.log(crop_ratio)
+        else:
+            image_resized = tf.image.resize_images(images=image_decoded,
+                                                   size=[input_width, input_height])
+
+        # Make sure values are in range [0, 255]
+        image_resized /= 255
+
+        return image_resized, label
+
     def __compose_dataset_object(self):
         """
         Generates the tf.data.Dataset containing all the objects
@@ -299,26 +383,47 @@ class PreprocessingDataset:
     def get_training_set(self) -> Tuple[tf.data.Dataset, int]:
         train_size = int(self.__training_ratio * self.__dataset[1])
 
-        return (self.__dataset[0]
-                .take(train_size)
-                .map(lambda path, label: tf.py_function(self.__preprocess_image,
-                                                        [path, label, True, True],
-                                                        (tf.float32, tf.float64)),
-                     num_parallel_calls=AUTOTUNE)
-                .batch(self.__batch_size)
-                .repeat()
-                .prefetch(AUTOTUNE),
-                train_size)
+        if self.__native_preprocessing:
+            def get_epoch(epoch):
+                # Number the elements over all the epochs to seed their random crops, so that each epoch
+                # draws new crops
+                return (tf.data.Dataset.zip((tf.data.experimental.Counter(), self.__dataset[0].take(train_size)))
+                        .map(lambda index, sample: self.__preprocess_image_native(epoch * train_size + index,
+                                                                                  sample[0], sample[1], True, True),
+                             num_parallel_calls=AUTOTUNE)
+                        .batch(self.__batch_size))
+
+            # The counter of the epochs repeats the dataset
+            dataset = tf.data.experimental.Counter().flat_map(get_epoch)
+        else:
+            dataset = (self.__dataset[0]
+                       .take(train_size)
+                       .map(lambda path, label: tf.py_function(self.__preprocess_image,
+                                                               [path, label, True, True],
+                                                               (tf.float32, tf.float64)),
+                            num_parallel_calls=AUTOTUNE)
+                       .batch(self.__batch_size)
+                       .repeat())
+
+        return dataset.prefetch(AUTOTUNE), train_size
 
     def get_validation_set(self) -> Tuple[tf.data.Dataset, int]:
         train_size = int(self.__training_ratio * self.__dataset[1])
 
-        return (self.__dataset[0]
-                .skip(train_size)
-                .map(lambda path, label: tf.py_function(self.__preprocess_image,
-                                                        [path, label, False, False],
-                                                        (tf.float32, tf.float64)),
-                     num_parallel_calls=AUTOTUNE)
+        if self.__native_preprocessing:
+            dataset = (self.__dataset[0]
+                       .skip(train_size)
+                       .map(lambda path, label: self.__preprocess_image_native(None, path, label, False, False),
+                            num_parallel_calls=AUTOTUNE))
+        else:
+            dataset = (self.__dataset[0]
+                       .skip(train_size)
+                       .map(lambda path, label: tf.py_function(self.__preprocess_image,
+                                                               [path, label, False, False],
+                                                               (tf.float32, tf.float64)),
+                            num_parallel_calls=AUTOTUNE))
+
+        return (dataset
                 .batch(self.__batch_size)
                 .repeat()
                 .prefetch(AUTOTUNE),
@@ -0,0 +1,166 @@
+import multiprocessing as mp
+import traceback
+from typing import Callable, Generator, List, Tuple
+
+import numpy as np
+
+
+class SampleWorkerPool:
+    """
+    Produces the batches of a dataset generator with a pool of worker processes.
+
+    Batches are assigned to the workers round-robin (batch b goes to worker b % n_workers) and each
+    worker fills them in its own slots of a shared-memory buffer, so that the images never go through
+    pickling. Each worker draws the random crops from its own numpy RandomState, seeded with
+    'seed + worker index', hence for a given number of workers the sequence of batches is deterministic.
+
+    The loading function must have signature load_sample(sample, rng) -> (input, target), where 'rng'
+    exposes the numpy.random sampling functions (e.g. uniform, randint).
+
+    The workers are started from a fork server: the batches are consumed inside the threads of
+    tf.data in a multithreaded TF process, which is unsafe to fork. Hence the loading function and
+    the samples must be picklable (e.g. a method of a DetectionSampleLoader, not a lambda).
+    """
+
+    def __init__(self,
+                 load_sample: Callable,
+                 input_shape: Tuple,
+                 target_shape: Tuple,
+                 batch_size: int,
+                 n_workers: int,
+                 seed: int = 0,
+                 slots_per_worker: int = 2):
+        """
+        :param load_sample: the function loading a single sample
+        :param input_shape: the shape of a single input, stored as uint8
+        :param target_shape: the shape of a single target, stored as float32
+        :param batch_size: the number of samples of each batch
+        :param n_workers: the number of worker processes
+        :param seed: the base seed of the random number generators of the workers
+        :param slots_per_worker: the number of batches each worker can produce ahead of the consumer
+        """
+
+        assert n_workers > 0, 'The number of workers must be positive!'
+
+        self.__load_sample = load_sample
+        self.__input_shape = tuple(input_shape)
+        self.__target_shape = tuple(target_shape)
+        self.__batch_size = batch_size
+        self.__n_workers = n_workers
+        self.__seed = seed
+        self.__slots_per_worker = slots_per_worker
+
+        # Workers are started from a clean single threaded server process, not forked from the TF process
+        self.__context = mp.get_context('forkserver')
+
+    @staticmethod
+    def get_buffers(inputs_buffer, targets_buffer, batch_size: int, input_shape: Tuple, target_shape: Tuple) \
+            -> (np.ndarray, np.ndarray):
+        """
+        Wraps the shared-memory buffers into numpy arrays of shape (slots, batch size, ...)
+        """
+
+        inputs = np.frombuffer(inputs_buffer, dtype=np.uint8).reshape((-1, batch_size) + input_shape)
+        targets = np.frombuffer(targets_buffer, dtype=np.float32).reshape((-1, batch_size) + target_shape)
+
+        return inputs, targets
+
+    @staticmethod
+    def run_worker(load_sample: Callable,
+                   samples: List,
+                   worker_id: int,
+                   n_workers: int,
+                   seed: int,
+                   batch_size: int,
+                   input_shape: Tuple,
+                   target_shape: Tuple,
+                   inputs_buffer,
+                   targets_buffer,
+                   free_slots,
+                   ready_slots):
+        """
+        Fills the batches assigned to the worker, waiting for a free slot before each one
+
+        :param load_sample: the function loading a single sample
+        :param samples: the list of samples of the dataset
+        :param worker_id: the index of the worker, used for batch assignment and seeding
+        """
+
+        inputs, targets = SampleWorkerPool.get_buffers(inputs_buffer, targets_buffer,
+                                                       batch_size, input_shape, target_shape)
+        rng = np.random.RandomState(seed + worker_id)
+
+        n_samples = len(samples)
+        batch_idx = worker_id
+
+        try:
+            while True:
+                slot = free_slots.get()
+
+                # Batches span the end of the epoch, as in the single process generator
+                start = batch_idx * batch_size
+                for i in range(batch_size):
+                    inputs[slot, i], targets[slot, i] = load_sample(samples[(start + i) % n_samples], rng)
+
+                ready_slots.put(slot)
+                batch_idx += n_workers
+
+        except Exception:
+            ready_slots.put(traceback.format_exc())
+
+    def generator(self, samples: List) -> Generator:
+        """
+        Starts the workers and yields the batches in order. The workers are terminated when the
+        generator is closed or garbage collected.
+
+        :param samples: the list of samples of the dataset
+        :return: a generator of (inputs / 255, targets) batches in float32
+        """
+
+        n_workers, slots_per_worker = self.__n_workers, self.__slots_per_worker
+        n_slots = n_workers * slots_per_worker
+
+        inputs_buffer = self.__context.RawArray('B', int(n_slots * self.__batch_size * np.prod(self.__input_shape)))
+        targets_buffer = self.__context.RawArray('f', int(n_slots * self.__batch_size * np.prod(self.__target_shape)))
+        inputs, targets = self.get_buffers(inputs_buffer, targets_buffer,
+                                           self.__batch_size, self.__input_shape, self.__target_shape)
+
+        free_slots, ready_slots, workers = [], [], []
+
+        for worker_id in range(n_workers):
+            free_slots.append(self.__context.Queue())
+            ready_slots.append(self.__context.Queue())
+
+            for slot in range(worker_id * slots_per_worker, (worker_id + 1) * slots_per_worker):
+                free_slots[worker_id].put(slot)
+
+            workers.append(self.__context.Process(target=SampleWorkerPool.run_worker,
+                                                  args=(self.__load_sample, samples, worker_id, n_workers,
+                                                        self.__seed, self.__batch_size, self.__input_shape,
+                                                        self.__target_shape, inputs_buffer, targets_buffer,
+                                                        free_slots[worker_id], ready_slots[worker_id]),
+                                                  daemon=True))
+            workers[worker_id].start()
+
+        try:
+            batch_idx = 0
+
+            while True:
+                worker_id = batch_idx % n_workers
+                slot = ready_slots[worker_id].get()
+
+                if isinstance(slot, str):
+                    raise RuntimeError('Worker {} failed loading a batch:\n{}'.format(worker_id, slot))
+
+                # Copy the batch out of the slot before handing it back to the worker
+                batch = inputs[slot].astype(np.float32) / 255, targets[slot].copy()
+                free_slots[worker_id].put(slot)
+
+                yield batch
+
+                batch_idx += 1
+
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
@@ -0,0 +1,204 @@
+import numpy as np
+
+# Smallest value that does not round to 0 when the targets are cast to float32
+FLOAT32_UNDERFLOW = 2. ** -150
+
+
+class TargetRenderer:
+    """
+    Renders the ground-truth detection targets of a page.
+
+    The output layer has shape (output_height, output_width, 6):
+    - [..., 0] = gaussian heatmap of the character centers
+    - [..., 1] = 1 at the centers, 0 elsewhere
+    - [..., 2] = height offset of the center
+    - [..., 3] = width offset of the center
+    - [..., 4] = height of the character, relative to the output height
+    - [..., 5] = width of the character, relative to the output width
+    """
+
+    def __init__(self, output_height: int, output_width: int, category_n: int = 1):
+        self.__output_height = output_height
+        self.__output_width = output_width
+        self.__output_layer_n = category_n + 4
+        self.__category_n = category_n
+
+    def __get_output_boxes(self, annotations, top_offset, left_offset, crop_height, crop_width):
+        """
+        Maps the annotations of a page to the output layer, removing the characters out of the crop
+
+        :param annotations: the annotations of the page, as [class, x_center, y_center, width, height]
+        :param top_offset: the top offset of the crop in the page
+        :param left_offset: the left offset of the crop in the page
+        :param crop_height: the height of the crop in the page
+        :param crop_width: the width of the crop in the page
+        :return: the arrays of x_c, y_c, width and height of the characters in the output layer
+        """
+
+        output_height, output_width = self.__output_height, self.__output_width
+
+        annotations = np.asarray(annotations).reshape(-1, 5)
+
+        x_c = (annotations[:, 1] - left_offset) * (output_width / crop_width)
+        y_c = (annotations[:, 2] - top_offset) * (output_height / crop_height)
+
+        # Divide by output stride (pic_width * crop / out_width)
+        width = annotations[:, 3] * (output_width / crop_width)
+        height = annotations[:, 4] * (output_height / crop_height)
+
+        top = np.maximum(0, y_c - height / 2)
+        left = np.maximum(0, x_c - width / 2)
+        bottom = np.minimum(output_height, y_c + height / 2)
+        right = np.minimum(output_width, x_c + width / 2)
+
+        # Random crop (out of picture)
+        inside = ~((top >= (output_height - 0.1)) | (left >= (output_width - 0.1))
+                   | (bottom <= 0.1) | (right <= 0.1))
+
+        top, left, bottom, right = top[inside], left[inside], bottom[inside], right[inside]
+
+        return (right + left) / 2, (top + bottom) / 2, right - left, bottom - top
+
+    def __set_centers(self, output_layer, x_c, y_c, width, height):
+        """
+        Writes the centers, offsets and sizes of the characters in the output layer. When two
+        characters share the same center cell, the last one wins.
+        """
+
+        output_height, output_width = self.__output_height, self.__output_width
+
+        rows = (y_c // 1).astype(int)
+        cols = (x_c // 1).astype(int)
+
+        # Keep only the last character of each center cell
+        _, last = np.unique((rows * output_width + cols)[::-1], return_index=True)
+        last = len(rows) - 1 - last
+
+        rows, cols = rows[last], cols[last]
+
+        output_layer[rows, cols, 1] = 1
+        output_layer[rows, cols, 2] = y_c[last] % 1  # height offset
+        output_layer[rows, cols, 3] = x_c[last] % 1
+        output_layer[rows, cols, 4] = height[last] / output_height
+        output_layer[rows, cols, 5] = width[last] / output_width
+
+    def render(self, annotations, top_offset, left_offset, crop_height, crop_width) -> np.ndarray:
+        """
+        Renders the targets of a page. The gaussians of all the characters are computed at once and
+        each one is painted only over the window where it does not underflow float32, so that the
+        result cast to float32 is identical to the one of render_dense.
+
+        :param annotations: the annotations of the page, as [class, x_center, y_center, width, height]
+        :param top_offset: the top offset of the crop in the page
+        :param left_offset: the left offset of the crop in the page
+        :param crop_height: the height of the crop in the page
+        :param crop_width: the width of the crop in the page
+        :return: the output layer
+        """
+
+        output_height, output_width = self.__output_height, self.__output_width
+        output_layer = np.zeros((output_height, output_width, (self.__output_layer_n + self.__category_n)))
+
+        x_c, y_c, width, height = self.__get_output_boxes(annotations, top_offset, left_offset,
+                                                          crop_height, crop_width)
+
+        if x_c.size == 0:
+            return output_layer
+
+        # Gaussian kernels of all the characters, one row for each character
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gaussian_x = np.exp(
+                -(((np.arange(output_width) - x_c.reshape(-1, 1)) / (width.reshape(-1, 1) / 10)) ** 2) / 2
+            )
+            gaussian_y = np.exp(
+                -(((np.arange(output_height) - y_c.reshape(-1, 1)) / (height.reshape(-1, 1) / 10)) ** 2) / 2
+            )
+
+        # Windows where the kernels are not negligible (NaNs are kept, as in the dense rendering)
+        visible_x = ~(gaussian_x < FLOAT32_UNDERFLOW)
+        visible_y = ~(gaussian_y < FLOAT32_UNDERFLOW)
+
+        heatmap_layer = output_layer[:, :, 0]
+
+        for kernel_x, kernel_y, mask_x, mask_y in zip(gaussian_x, gaussian_y, visible_x, visible_y):
+            cols = np.flatnonzero(mask_x)
+            rows = np.flatnonzero(mask_y)
+
+            if cols.size == 0 or rows.size == 0:
+                continue
+
+            left, right = cols[0], cols[-1] + 1
+            top, bottom = rows[0], rows[-1] + 1
+
+            heatmap = kernel_x[left:right].reshape(1, -1) * kernel_y[top:bottom].reshape(-1, 1)
+            heatmap_layer[top:bottom, left:right] = np.maximum(heatmap_layer[top:bottom, left:right], heatmap)
+
+        self.__set_centers(output_layer, x_c, y_c, width, height)
+
+        return output_layer
+
+    def render_dense(self, annotations, top_offset, left_offset, crop_height, crop_width) -> np.ndarray:
+        """
+        Reference rendering, one full-size gaussian for each character
+
+        Note that in the original paper, the heatmap is computed as:
+        * exp(-((x_distance_from_center) ^ 2 + (y_distance_from_center) ^ 2) / (2 * sig ^ 2))
+
+        Here:
+        - x_distance_from_center = np.arange(output_width) - x_c
+        - y_distance_from_center = np.arange(output_height) - y_c
+        - sigma = (width / 10) and (height / 10).
+
+        Multiplying allows to consider the shape of characters as ellipses, instead of circles.
+        The result is a 2D array
+        """
+
+        output_height, output_width = self.__output_height, self.__output_width
+        output_layer = np.zeros((output_height, output_width, (self.__output_layer_n + self.__category_n)))
+
+        for annotation in annotations:
+            x_c = (annotation[1] - left_offset) * (output_width / crop_width)
+            y_c = (annotation[2] - top_offset) * (output_height / crop_height)
+
+            # Divide by output stride (pic_width * crop / out_width)
+            width = annotation[3] * (output_width / crop_width)
+            height = annotation[4] * (output_height / crop_height)
+
+            top = np.maximum(0, y_c - height / 2)
+            left = np.maximum(0, x_c - width / 2)
+            bottom = np.minimum(output_height, y_c + height / 2)
+            right = np.minimum(output_width, x_c + width / 2)
+
+            # Random crop (out of picture)
+            if top >= (output_height - 0.1) or left >= (output_width - 0.1) \
+                    or bottom <= 0.1 or right <= 0.1:
+                continue
+
+            width = right - left
+            height = bottom - top
+
+            x_c = (right + left) / 2
+            y_c = (top + bottom) / 2
+
+            # Gaussian kernel
+            heatmap = (
+                    (np.exp(
+                        -(((np.arange(output_width) - x_c) / (width / 10)) ** 2) / 2
+                    ))
+                    .reshape(1, -1) *
+                    (np.exp(
+                        -(((np.arange(output_height) - y_c) / (height / 10)) ** 2) / 2
+                    ))
+                    .reshape(-1, 1)
+            )
+            # Center points will have value closer to 1 (close to 0 otherwise)
+
+            # Category heatmap
+            output_layer[:, :, 0] = np.maximum(output_layer[:, :, 0], heatmap[:, :])
+            output_layer[int(y_c // 1), int(x_c // 1), 1] = 1
+            output_layer[int(y_c // 1), int(x_c // 1), 2] = y_c % 1  # height offset
+            output_layer[int(y_c // 1), int(x_c // 1), 3] = x_c % 1
+            output_layer[int(y_c // 1), int(x_c // 1), 4] = height / output_height
+            output_layer[int(y_c // 1), int(x_c // 1), 5] = width / output_width
+
+        return output_layer
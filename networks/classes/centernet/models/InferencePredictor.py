@@ -0,0 +1,77 @@
+import json
+import os
+from typing import Dict
+
+import numpy as np
+import tensorflow as tf
+
+EXPORT_METADATA_FILE = 'export_metadata.json'
+
+
+class InferencePredictor:
+    """
+    Lightweight predictor of a model exported by ModelExporter. It only loads the SavedModel, without
+    importing the model generators nor the training code, and exposes the predict_on_batch of a keras
+    model so that it can replace one at inference.
+    """
+
+    def __init__(self, export_path: str):
+        """
+        :param export_path: the folder of the SavedModel
+        """
+
+        self.__metadata = self.load_metadata(export_path)
+
+        if tf.executing_eagerly():
+            self.__session = None
+            self.__model = tf.compat.v2.saved_model.load(export_path)
+            self.__serve = self.__model.signatures['serving_default']
+        else:
+            # Eager execution disabled: the SavedModel is restored in a session of its own graph
+            self.__session = tf.compat.v1.Session(graph=tf.Graph())
+            meta_graph = tf.compat.v1.saved_model.loader.load(self.__session,
+                                                              [tf.compat.v1.saved_model.tag_constants.SERVING],
+                                                              export_path)
+            signature = meta_graph.signature_def['serving_default']
+            self.__images = self.__session.graph.get_tensor_by_name(signature.inputs['images'].name)
+            self.__predictions = self.__session.graph.get_tensor_by_name(signature.outputs['predictions'].name)
+
+    @staticmethod
+    def is_exported(export_path: str) -> bool:
+        return os.path.isfile(os.path.join(export_path, EXPORT_METADATA_FILE))
+
+    @staticmethod
+    def load_metadata(export_path: str) -> Dict:
+        """
+        :param export_path: the folder of the SavedModel
+        :return: the metadata of the export, read without loading the model
+        """
+
+        with open(os.path.join(export_path, EXPORT_METADATA_FILE)) as f:
+            return json.load(f)
+
+    def get_metadata(self) -> Dict:
+        return self.__metadata
+
+    def predict_on_batch(self, batch: np.ndarray) -> np.ndarray:
+        """
+        :param batch: the normalized input batch, with the input shape of the exported model
+        :return: the predictions of the model for the batch
+        """
+
+        if self.__session is not None:
+            return self.__session.run(self.__predictions, feed_dict={self.__images: np.asarray(batch, np.float32)})
+
+        return self.__serve(images=tf.convert_to_tensor(batch, dtype=tf.float32))['predictions'].numpy()
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """
+        Predicts an array of inputs in batches, as the predict of a keras model
+
+        :param x: the normalized inputs
+        :param batch_size: the number of inputs in each batch
+        :return: the predictions of the model for the inputs
+        """
+
+        return np.concatenate([self.predict_on_batch(x[start:start + batch_size])
+                               for start in range(0, len(x), batch_size)])
@@ -3,7 +3,7 @@ import os
 
 import pandas as pd
 from tensorflow.python.keras.preprocessing.image import ImageDataGenerator
-from typing import Dict, List, Union, Tuple
+from typing import Dict, List, Union, Tuple, Generator
 
 import numpy as np
 import tensorflow as tf
@@ -78,16 +78,14 @@ class ModelCenterNet:
 
         return [tensorboard, checkpointer, lr_schedule]
 
-    def restore_weights(self,
-                        model: tf.keras.Model,
-                        init_epoch: int,
-                        weights_folder_path: str) -> None:
+    @staticmethod
+    def get_weights_path(init_epoch: int, weights_folder_path: str) -> str:
         """
-        Restores the weights from an existing weights file
+        Gets the path to the weights file saved at the given epoch
 
-        :param model:
-        :param init_epoch:
-        :param weights_folder_path:
+        :param init_epoch: the epoch of the weights
+        :param weights_folder_path: the folder of the weights files
+        :return: the path to the weights file
         """
 
         init_epoch_str = '0' + str(init_epoch) if init_epoch < 10 else str(init_epoch)
@@ -103,7 +101,39 @@ class ModelCenterNet:
         assert os.path.isfile(restore_path), \
             'ERR: Weight file in path {} seems not to be a file'.format(restore_path)
 
-        self.__logs['execution'].info("Restoring weights in file {}...".format(restore_filename))
+        return restore_path
+
+    @staticmethod
+    def fingerprint_weights(weights_path: Union[str, None]) -> Dict:
+        """
+        Fingerprints a weights file by its name, byte size and modification time
+
+        :param weights_path: the path to the weights file, None if the weights are not restored
+        :return: a json serializable fingerprint, which changes whenever the weights file changes
+        """
+
+        if weights_path is None:
+            return {'weights_file': None}
+
+        stat = os.stat(weights_path)
+
+        return {'weights_file': os.path.basename(weights_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def restore_weights(self,
+                        model: tf.keras.Model,
+                        init_epoch: int,
+                        weights_folder_path: str) -> None:
+        """
+        Restores the weights from an existing weights file
+
+        :param model:
+        :param init_epoch:
+        :param weights_folder_path:
+        """
+
+        restore_path = self.get_weights_path(init_epoch, weights_folder_path)
+
+        self.__logs['execution'].info("Restoring weights in file {}...".format(os.path.basename(restore_path)))
         model.load_weights(restore_path)
 
     def train(self,
@@ -249,3 +279,16 @@ class ModelCenterNet:
             return model.predict_generator(generator, steps=steps, verbose=verbose)
         else:
             return model.predict(dataset, verbose=verbose, steps=steps)
+
+    def predict_batches(self,
+                        model: tf.keras.Model,
+                        dataset: tf.data.Dataset) -> Generator[np.ndarray, None, None]:
+        """
+        Performs a prediction on a given batched dataset, yielding the predictions one batch at a time
+        instead of collecting the predictions for the whole dataset
+        """
+
+        self.__logs['test'].info("Predicting batch by batch...")
+
+        for batch in dataset:
+            yield np.asarray(model.predict_on_batch(batch))
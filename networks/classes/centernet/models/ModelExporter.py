@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.keras import Model, activations
+from tensorflow.python.keras import backend as K
+from tensorflow.python.keras.layers import BatchNormalization, Conv2D, Conv2DTranspose, Dropout
+
+from networks.classes.centernet.models.InferencePredictor import EXPORT_METADATA_FILE
+
+
+class ModelExporter:
+    """
+    Exports a trained keras model as an inference-only SavedModel, loaded by InferencePredictor.
+
+    Before the export the graph is simplified for inference:
+    - each BatchNormalization fed only by a Conv2D is folded into the kernel and bias of the convolution
+    - Dropout layers, which are the identity at inference, are removed
+
+    The exported graph has no optimizer, loss nor training branch, and takes a float batch named 'images'
+    returning a batch named 'predictions'. The pipeline runs with eager execution enabled (see __centernet__),
+    so the model is saved as a tf.function signature with tf.compat.v2.saved_model.save. When the model is
+    built in graph mode instead (eager execution disabled), it is saved from the keras session with simple_save.
+    """
+
+    def __init__(self, log):
+        self.__log = log
+
+    @staticmethod
+    def fold_conv_bn(kernel: np.ndarray,
+                     bias: np.ndarray,
+                     gamma: np.ndarray,
+                     beta: np.ndarray,
+                     moving_mean: np.ndarray,
+                     moving_variance: np.ndarray,
+                     epsilon: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Computes the kernel and bias of a convolution followed by a batch normalization at inference,
+        i.e. gamma * (conv(x) - mean) / sqrt(var + eps) + beta
+
+        :param kernel: the kernel of the convolution, with the output channels on the last axis
+        :param bias: the bias of the convolution, zeros if it has none
+        :return: the folded kernel and bias
+        """
+
+        scale = gamma / np.sqrt(moving_variance + epsilon)
+
+        return kernel * scale, (bias - moving_mean) * scale + beta
+
+    @staticmethod
+    def __is_foldable(conv, bn: BatchNormalization, n_consumers: int) -> bool:
+        return type(conv) is Conv2D \
+               and not isinstance(conv, Conv2DTranspose) \
+               and n_consumers == 1 \
+               and conv.data_format == 'channels_last' \
+               and conv.activation is activations.linear \
+               and bn.axis in (-1, 3, [-1], [3])
+
+    @staticmethod
+    def __get_bn_weights(bn: BatchNormalization, n_channels: int) -> Dict[str, np.ndarray]:
+        return {'gamma': K.get_value(bn.gamma) if bn.scale else np.ones(n_channels),
+                'beta': K.get_value(bn.beta) if bn.center else np.zeros(n_channels),
+                'moving_mean': K.get_value(bn.moving_mean),
+                'moving_variance': K.get_value(bn.moving_variance),
+                'epsilon': bn.epsilon}
+
+    def fold_batch_norms(self, model: Model) -> Tuple[Model, int, int]:
+        """
+        Rebuilds the model from its config without the foldable batch normalizations and the dropouts
+
+        :param model: a functional keras model
+        :return: the simplified model, the number of folded batch normalizations and of removed dropouts
+        """
+
+        config = model.get_config()
+        layers = {layer.name: layer for layer in model.layers}
+
+        # Number of inputs reading each layer, the outputs of the model included
+        consumers: Dict[str, int] = {}
+        for layer_config in config['layers']:
+            for node in layer_config['inbound_nodes']:
+                for inbound in node:
+                    consumers[inbound[0]] = consumers.get(inbound[0], 0) + 1
+        for output in config['output_layers']:
+            consumers[output[0]] = consumers.get(output[0], 0) + 1
+
+        # Removed layers, mapped to the inbound they are replaced with
+        replaced: Dict[str, List] = {}
+        folded: Dict[str, BatchNormalization] = {}
+        kept_layers = []
+
+        for layer_config in config['layers']:
+            layer = layers[layer_config['name']]
+            inbound_nodes = layer_config['inbound_nodes']
+
+            if isinstance(layer, (Dropout, BatchNormalization)) \
+                    and len(inbound_nodes) == 1 and len(inbound_nodes[0]) == 1:
+                source = inbound_nodes[0][0]
+
+                if isinstance(layer, Dropout):
+                    replaced[layer.name] = source
+                    continue
+
+                if self.__is_foldable(layers[source[0]], layer, consumers[source[0]]):
+                    replaced[layer.name] = source
+                    folded[source[0]] = layer
+                    continue
+
+            kept_layers.append(layer_config)
+
+        def resolve(inbound: List) -> List:
+            while inbound[0] in replaced:
+                inbound = replaced[inbound[0]][:3] + inbound[3:]
+            return inbound
+
+        for layer_config in kept_layers:
+            layer_config['inbound_nodes'] = [[resolve(inbound) for inbound in node]
+                                             for node in layer_config['inbound_nodes']]
+            if layer_config['name'] in folded:
+                layer_config['config']['use_bias'] = True
+
+        config['layers'] = kept_layers
+        config['output_layers'] = [resolve(output) for output in config['output_layers']]
+
+        inference_model = Model.from_config(config)
+
+        for layer in inference_model.layers:
+            weights = layers[layer.name].get_weights()
+
+            if layer.name in folded:
+                conv = layers[layer.name]
+                kernel = weights[0]
+                bias = weights[1] if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+                weights = list(self.fold_conv_bn(kernel, bias, **self.__get_bn_weights(folded[layer.name],
+                                                                                       kernel.shape[-1])))
+
+            layer.set_weights(weights)
+
+        n_dropouts = len(replaced) - len(folded)
+
+        return inference_model, len(folded), n_dropouts
+
+    def export(self, model: Model, export_path: str, metadata: Dict = None) -> Dict:
+        """
+        Folds the model and saves it as a SavedModel, checking that the folded model predicts as the original
+
+        :param model: the trained keras model
+        :param export_path: the folder of the SavedModel
+        :param metadata: the info stored alongside the SavedModel (e.g. the name of the model and the
+            fingerprint of its weights file)
+        :return: the metadata of the export
+        """
+
+        inference_model, n_folded, n_dropouts = self.fold_batch_norms(model)
+
+        self.__log.info('Folded {} batch normalizations into convolutions and removed {} dropouts '
+                        '({} -> {} layers)'.format(n_folded, n_dropouts, len(model.layers),
+                                                   len(inference_model.layers)))
+
+        input_shape = [int(d) for d in model.input_shape[1:]]
+
+        check_batch = np.random.RandomState(0).uniform(0, 1, [2] + input_shape).astype(np.float32)
+        max_error = float(np.max(np.abs(np.asarray(model.predict_on_batch(check_batch))
+                                        - np.asarray(inference_model.predict_on_batch(check_batch)))))
+        self.__log.info('Maximum absolute difference of the folded model on a random batch: {:.2e}'
+                        .format(max_error))
+
+        # A previous export, e.g. of older weights, is replaced
+        if os.path.isdir(export_path):
+            shutil.rmtree(export_path)
+
+        if tf.executing_eagerly():
+            @tf.function(input_signature=[tf.TensorSpec([None] + input_shape, tf.float32, name='images')])
+            def serve(images):
+                return {'predictions': inference_model(images, training=False)}
+
+            tf.compat.v2.saved_model.save(inference_model, export_path, signatures={'serving_default': serve})
+        else:
+            # Eager execution disabled: the SavedModel is written from the session holding the weights of the model
+            tf.compat.v1.saved_model.simple_save(K.get_session(),
+                                                 export_path,
+                                                 inputs={'images': inference_model.input},
+                                                 outputs={'predictions': inference_model.output})
+
+        metadata = dict(metadata or {},
+                        input_shape=input_shape,
+                        folded_batch_norms=n_folded,
+                        removed_dropouts=n_dropouts,
+                        max_folding_error=max_error)
+
+        with open(os.path.join(export_path, EXPORT_METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=4)
+
+        self.__log.info('Inference model exported to {}'.format(export_path))
+
+        return metadata
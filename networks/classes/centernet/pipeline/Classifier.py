@@ -1,16 +1,22 @@
+import hashlib
+import json
 import os
 import numpy as np
-import pandas as pd
 import tensorflow as tf
-from typing import Dict, List, Union, Generator
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, Union, Generator
 import natsort
 from sklearn.metrics import classification_report
 
 from tensorflow.python.keras.optimizers import Adam
 
 from networks.classes.centernet.datasets.ClassificationDataset import ClassificationDataset
+from networks.classes.centernet.models.InferencePredictor import InferencePredictor
+from networks.classes.centernet.models.ModelExporter import ModelExporter
 from networks.classes.centernet.models.ModelCenterNet import ModelCenterNet
 from networks.classes.centernet.utils.ImageCropper import ImageCropper
+from networks.classes.centernet.utils.SubmissionJournal import DEFAULT_JOURNAL_PATH, SubmissionJournal
+from networks.classes.centernet.utils.TestCropTable import DEFAULT_TABLE_PATH, TestCropTable
 from networks.classes.centernet.models.ModelGeneratorKaggle import ModelGeneratorKaggle
 from networks.classes.centernet.models.ModelGenerator import ModelGenerator
 
@@ -25,83 +31,82 @@ class Classifier:
         self.__model_params.update(dataset_params)
 
         self.__model_utils = ModelCenterNet(logs=self.__logs)
-        self.__img_cropper = ImageCropper(log=self.__logs['execution'])
+        self.__img_cropper = ImageCropper(log=self.__logs['execution'],
+                                          crop_height=self.__model_params['input_height'],
+                                          crop_width=self.__model_params['input_width'],
+                                          n_workers=self.__model_params.get('crop_workers', 0),
+                                          max_in_flight_pages=self.__model_params.get('crop_max_in_flight_pages'))
 
-        self.__model = self.__build_and_compile_model(len(class_weights.keys()))
+        # The inference-only model exported by export_model, next to the weights
+        self.__export_path = os.path.join(os.path.dirname(self.__weights_path), 'export')
 
-    def __write_test_list_to_csv(self, test_list: List, bbox_predictions: Dict):
+        self.__model = self.__load_model(len(class_weights.keys()))
 
-        self.__logs['execution'].info('Writing test data to csv...')
-
-        # Get all the names of the cropped images
-        cropped_img_names = [cropped_img_path.split(os.sep)[-1] for cropped_img_path in test_list]
-
-        # Get all the original names of the cropped images
-        original_img_names = []
-        for cropped_img_name, cropped_img_path in zip(cropped_img_names, test_list):
-            original_img_name = '_'.join(cropped_img_name.split('_')[:-1])
-            original_img_names.append(original_img_name)
-
-        # Initialize a mapping <original image name> -> <list of cropped images names>
-        original_img_to_cropped = {original_img_name: [] for original_img_name in original_img_names}
-
-        # Initialize a mapping <cropped image name> -> <bbox coordinates>
-        cropped_img_to_bbox = {cropped_img_name: None for cropped_img_name in cropped_img_names}
+    @staticmethod
+    def __resize_fn(path: str, input_h, input_w):
+        """
+        Utility function for image resizing
 
-        # Initialize a mapping <original image name> -> <bbox coordinates>
-        original_img_to_bbox = {original_img_name: [] for original_img_name in original_img_names}
+        :param path: the path to the image to be resized
+        :return: a resized image
+        """
 
-        for cropped_img_name in cropped_img_names:
-            # Map each original image to its cropped characters
-            original_img_name = '_'.join(cropped_img_name.split('_')[:-1])
-            original_img_to_cropped[original_img_name].append(cropped_img_name)
+        image_string = tf.read_file(path)
+        image_decoded = tf.image.decode_jpeg(image_string)
+        image_resized = tf.image.resize(image_decoded, (input_h, input_w))
 
-            # Map each cropped image to its bounding box
-            cropped_img_id = int(cropped_img_name.split('_')[-1].split('.')[0])
+        return image_resized / 255
 
-            # Set the relative path to the original image
-            original_img_path = os.path.join(self.__model_params['test_images_path'],
-                                             original_img_name + '.jpg')
+    def __load_model(self, num_categories) -> Union[tf.keras.Model, InferencePredictor]:
+        """
+        Loads the exported inference model if it must only predict and it has been exported, otherwise
+        builds and compiles the keras model
+        """
 
-            # Convert the coords of the bboxes from float to string
-            bbox_coords = [str(coord) for coord in
-                           bbox_predictions[original_img_path][cropped_img_id][1:]]
+        use_exported_model = self.__model_params.get('use_exported_model', False) \
+                             and not self.__model_params['train'] \
+                             and not self.__model_params['evaluate'] \
+                             and not self.__model_params['augmentation']
 
-            # Join the coordinates in a single string, in format ymin:xmin:ymax:xmax
-            cropped_img_to_bbox[cropped_img_name] = ':'.join(bbox_coords)
+        if use_exported_model and InferencePredictor.is_exported(self.__export_path):
+            # An export of other weights (e.g. before a new training) is stale
+            export_metadata = InferencePredictor.load_metadata(self.__export_path)
+            if export_metadata.get('weights') == self.__get_weights_fingerprint():
+                self.__logs['execution'].info('Loading the exported classification model from {}...'
+                                              .format(self.__export_path))
+                return InferencePredictor(self.__export_path)
 
-        for original_img_name, cropped_img_names in original_img_to_cropped.items():
-            for cropped_img_name in cropped_img_names:
-                original_img_to_bbox[original_img_name].append(cropped_img_to_bbox[cropped_img_name])
+            self.__logs['execution'].warning('The classification model exported to {} does not match the weights '
+                                             'to restore, using the keras model. Export the model again to use it'
+                                             .format(self.__export_path))
 
-        original_img_to_bbox = {img_name: ' '.join(coords) for img_name, coords in
-                                original_img_to_bbox.items()}
+        return self.__build_and_compile_model(num_categories)
 
-        test_list_df = pd.DataFrame({
-            'original_image': [original_img_name for original_img_name in original_img_to_cropped.keys()],
-            'cropped_images': [' '.join(cropped_img_names) for cropped_img_names in original_img_to_cropped.values()],
-            'bboxes': [bbox for bbox in original_img_to_bbox.values()]
-        })
+    def __get_weights_fingerprint(self) -> Dict:
+        """
+        :return: the fingerprint of the weights file restored in the model
+        """
 
-        path_to_test_list = os.path.join('datasets', 'test_list.csv')
-        test_list_df.to_csv(path_to_test_list)
+        weights_path = None
+        if self.__model_params['restore_weights']:
+            weights_path = self.__model_utils.get_weights_path(init_epoch=self.__model_params['initial_epoch'],
+                                                               weights_folder_path=self.__weights_path)
 
-        self.__logs['execution'].info('Written test data at {}'.format(path_to_test_list))
+        return self.__model_utils.fingerprint_weights(weights_path)
 
-    @staticmethod
-    def __resize_fn(path: str, input_h, input_w):
+    def export_model(self) -> Dict:
         """
-        Utility function for image resizing
+        Exports the model for inference only, with the batch normalizations folded into the convolutions
 
-        :param path: the path to the image to be resized
-        :return: a resized image
+        :return: the metadata of the export
         """
 
-        image_string = tf.read_file(path)
-        image_decoded = tf.image.decode_jpeg(image_string)
-        image_resized = tf.image.resize(image_decoded, (input_h, input_w))
+        metadata = {'model': self.__model_params['model'],
+                    'mode': 'classification',
+                    'n_classes': len(self.__class_weights),
+                    'weights': self.__get_weights_fingerprint()}
 
-        return image_resized / 255
+        return ModelExporter(log=self.__logs['execution']).export(self.__model, self.__export_path, metadata=metadata)
 
     def __build_and_compile_model(self, num_categories):
 
@@ -197,7 +202,81 @@ class Classifier:
         sklearn_metrics = classification_report(list(y_eval[:batch_size]), y_pred, output_dict=False, digits=4)
         self.__logs['execution'].info('Classification report:\n{}'.format(sklearn_metrics))
 
-    def __generate_predictions(self, test_list: List[List[str]]) -> Generator:
+    def __predict_packed_crops(self,
+                               pages: Iterable[Tuple[Any, Union[np.ndarray, List[str]]]],
+                               predict_fn: Callable[[Union[np.ndarray, List[str]]], np.ndarray]) \
+            -> Generator[Tuple[Any, np.ndarray], None, None]:
+        """
+        Predicts the crops of a stream of pages, packing the crops of consecutive pages into full batches.
+        This is the packing of every classification at inference: on the crops on disk, in memory or
+        received by the server
+
+        :param pages: an iterable of (page, crops of the page), with the crops as uint8 arrays or file paths
+        :param predict_fn: the function predicting a batch of crops, i.e. an array or a list of file paths
+        :return: a generator of (page, class scores of its crops (N, n classes)), in the order of the pages
+        """
+
+        batch_size = self.__model_params['batch_size_predict']
+
+        def concatenate(chunks: List) -> Union[np.ndarray, List[str]]:
+            if isinstance(chunks[0], np.ndarray):
+                return np.concatenate(chunks)
+            return [crop for chunk in chunks for crop in chunk]
+
+        # Pages whose crops are not all predicted yet, with their number of crops
+        waiting: deque = deque()
+
+        # Crops not yet predicted and scores not yet assigned to a page
+        crops_buffer: List = []
+        n_buffered = 0
+        scores_buffer: List[np.ndarray] = []
+        n_scored = 0
+
+        def pop_predicted_pages() -> Generator[Tuple[Any, np.ndarray], None, None]:
+            nonlocal scores_buffer, n_scored
+
+            while waiting and waiting[0][1] <= n_scored:
+                page, n_crops = waiting.popleft()
+
+                if n_crops == 0:
+                    yield page, np.empty((0, len(self.__class_weights)), dtype=np.float32)
+                    continue
+
+                scores = np.concatenate(scores_buffer)
+
+                yield page, scores[:n_crops]
+
+                scores_buffer, n_scored = [scores[n_crops:]], n_scored - n_crops
+
+        for page, crops in pages:
+            waiting.append((page, len(crops)))
+
+            if len(crops) > 0:
+                crops_buffer.append(crops)
+                n_buffered += len(crops)
+
+            while n_buffered >= batch_size:
+                crops = concatenate(crops_buffer)
+                scores_buffer.append(np.asarray(predict_fn(crops[:batch_size])))
+                n_scored += batch_size
+                crops_buffer, n_buffered = [crops[batch_size:]], n_buffered - batch_size
+
+            yield from pop_predicted_pages()
+
+        # Predict the last partial batch
+        if n_buffered > 0:
+            scores_buffer.append(np.asarray(predict_fn(concatenate(crops_buffer))))
+            n_scored += n_buffered
+
+        yield from pop_predicted_pages()
+
+    def __generate_predictions(self, test_list: Union[List[List[str]], List[np.ndarray]]) -> Generator:
+        """
+        Predicts the classes of the crops, batching crops of consecutive pages together
+
+        :param test_list: the crops of each page, as lists of file paths or as uint8 arrays
+        :return: a generator of the predictions of each page with at least one crop, in page order
+        """
 
         self.__logs['execution'].info(
             'Starting the predict procedure of char class (takes much time)...')
@@ -207,68 +286,273 @@ class Classifier:
         augmentation = self.__model_params['augmentation']
         batch_size = self.__model_params['batch_size_predict']
 
-        for image_crops in test_list:
-            complete_batches: int = len(image_crops) // batch_size
-            for i in range(0, complete_batches + 1):
-                start = i * batch_size
-                end = batch_size * (i + 1)
+        if any(isinstance(image_crops, np.ndarray) for image_crops in test_list):
+            # In-memory crops, already resized to the input size
+            def predict_fn(crops: np.ndarray) -> np.ndarray:
+                return self.predict_batch(crops.astype(np.float32) / 255)
+        elif augmentation:
+            def predict_fn(crop_paths: List[str]) -> np.ndarray:
+                return self.__model_utils.predict(model=self.__model,
+                                                  dataset=crop_paths,
+                                                  verbose=0,
+                                                  batch_size=batch_size,
+                                                  augmentation=augmentation)
+        else:
+            # tf.data reads and resizes the crops ahead of the model, in the same consecutive batches of the
+            # stream of crops as the packing
+            dataset = tf.data.Dataset.from_tensor_slices([crop_path for image_crops in test_list
+                                                          for crop_path in image_crops]) \
+                .map(lambda i: self.__resize_fn(i, input_h, input_w),
+                     num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+                .batch(batch_size) \
+                .prefetch(tf.data.experimental.AUTOTUNE)
+
+            batches = self.__model_utils.predict_batches(model=self.__model, dataset=dataset)
+
+            def predict_fn(crop_paths: List[str]) -> np.ndarray:
+                prediction = next(batches)
+                assert len(prediction) == len(crop_paths), \
+                    'The batches of the dataset are not aligned to the packed crops'
+                return prediction
+
+        for _, prediction in self.__predict_packed_crops(enumerate(test_list), predict_fn):
+            if len(prediction) > 0:
+                yield prediction
 
-                if i == complete_batches:
-                    if len(image_crops) % batch_size == 0:
-                        break
-                    else:
-                        end = len(image_crops)
+        self.__logs['execution'].info('Prediction completed.')
 
-                batch: List[str] = image_crops[start:end]  # [start, end)
+    def classify_pages(self, bbox_predictions: Iterable[Tuple[str, np.ndarray]]) \
+            -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+        """
+        Inference only: crops the characters of a stream of pages in memory and predicts their classes,
+        packing the crops of consecutive pages into full batches. Nothing is written to disk
 
-                if augmentation:
-                    dataset = batch
-                else:
-                    dataset = tf.data.Dataset.from_tensor_slices(batch) \
-                        .map(lambda i: self.__resize_fn(i, input_h, input_w),
-                             num_parallel_calls=tf.data.experimental.AUTOTUNE) \
-                        .batch(batch_size)
+        :param bbox_predictions: an iterable of (page path, np.arr[score, ymin, xmin, ymax, xmax]), e.g. the
+            stream of the detector
+        :return: a generator of (page path, boxes as rows [ymin, xmin, ymax, xmax], class scores (N, n classes)),
+            in the order of the pages
+        """
 
-                prediction = self.__model_utils.predict(model=self.__model,
-                                                        dataset=dataset,
-                                                        verbose=0,
-                                                        batch_size=batch_size,
-                                                        augmentation=augmentation)
+        return self.classify_crops(self.crop_pages(bbox_predictions))
 
-                yield prediction
+    def crop_pages(self, bbox_predictions: Iterable[Tuple[str, np.ndarray]]) \
+            -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+        """
+        Inference only: crops the characters of a stream of pages in memory
 
-        self.__logs['execution'].info('Prediction completed.')
+        :param bbox_predictions: an iterable of (page path, np.arr[score, ymin, xmin, ymax, xmax])
+        :return: a generator of (page path, boxes as rows [ymin, xmin, ymax, xmax], uint8 crops (N, H, W, 3))
+        """
+
+        return self.__img_cropper.iter_crop_arrays(bbox_predictions)
+
+    def predict_batch(self, batch: np.ndarray) -> np.ndarray:
+        """
+        :param batch: the normalized crops
+        :return: the class scores predicted by the model (N, n classes)
+        """
+
+        return np.asarray(self.__model.predict_on_batch(batch))
+
+    def classify_crops(self,
+                       cropped_pages: Iterable[Tuple[str, np.ndarray, np.ndarray]],
+                       predict_fn: Callable[[np.ndarray], np.ndarray] = None) \
+            -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+        """
+        Inference only: predicts the classes of the crops of a stream of pages, packing the crops of
+        consecutive pages into full batches
+
+        :param cropped_pages: an iterable of (page path, boxes, uint8 crops (N, H, W, 3))
+        :param predict_fn: the function predicting a batch, e.g. a batching scheduler shared by many callers.
+            Defaults to the model of the classifier
+        :return: a generator of (page path, boxes, class scores (N, n classes)), in the order of the pages
+        """
+
+        predict_fn = predict_fn if predict_fn is not None else self.predict_batch
+
+        def predict(crops: np.ndarray) -> np.ndarray:
+            return predict_fn(crops.astype(np.float32) / 255)
+
+        classified_pages = self.__predict_packed_crops((((img_path, boxes), crops)
+                                                        for img_path, boxes, crops in cropped_pages), predict)
+
+        for (img_path, boxes), scores in classified_pages:
+            yield img_path, boxes, scores
+
+    def classify_images(self,
+                        images: List[np.ndarray],
+                        bbox_predictions: List[np.ndarray],
+                        predict_fn: Callable[[np.ndarray], np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Inference only: predicts the classes of the characters of pages already decoded in memory (e.g.
+        received by a service), packing the crops of all the pages into full batches
+
+        :param images: the RGB pages as uint8 arrays of shape (height, width, 3)
+        :param bbox_predictions: the predicted bboxes of each page, as np.arr[score, ymin, xmin, ymax, xmax]
+        :param predict_fn: the function predicting a batch, e.g. a batching scheduler shared by many callers.
+            Defaults to the model of the classifier
+        :return: for each page, (boxes as rows [ymin, xmin, ymax, xmax], class scores (N, n classes))
+        """
+
+        cropped_pages = ((i, bboxes[:, 1:], self.__img_cropper.crop_image(img, bboxes))
+                         for i, (img, bboxes) in enumerate(zip(images, bbox_predictions)))
+
+        return [(boxes, scores) for _, boxes, scores in self.classify_crops(cropped_pages, predict_fn)]
+
+    def __get_journal_fingerprint(self, bbox_predictions: Dict[str, np.ndarray]) -> str:
+        """
+        Fingerprints the inputs of the labels of a submission: the weights of the classifier and the bboxes
+
+        :param bbox_predictions: the predicted bboxes, as a dict {page path: bboxes}
+        :return: the fingerprint, which changes whenever the weights file or a predicted bbox changes
+        """
+
+        sha = hashlib.sha1(json.dumps(self.__get_weights_fingerprint(),
+                                      sort_keys=True).encode('utf-8'))
+        for img_path in sorted(bbox_predictions.keys()):
+            sha.update(img_path.split(os.sep)[-1].encode('utf-8'))
+            sha.update(np.ascontiguousarray(bbox_predictions[img_path], dtype=np.float64).tobytes())
+
+        return sha.hexdigest()
+
+    def __skip_journaled_pages(self, bbox_predictions: Dict[str, np.ndarray]) \
+            -> Tuple[Dict[str, np.ndarray], Set[str]]:
+        """
+        Leaves out the test pages already classified by an interrupted submission, as recorded in its journal.
+        If the submission is not resumed, or the journal was written with other weights or bboxes, a new
+        journal is started
+
+        :param bbox_predictions: the predicted bboxes, as a dict {page path: bboxes}
+        :return: the bboxes of the pages still to classify and the ids of the journaled pages
+        """
+
+        journal = SubmissionJournal(self.__model_params.get('submission_journal_path', DEFAULT_JOURNAL_PATH))
+        fingerprint = self.__get_journal_fingerprint(bbox_predictions)
+
+        if not self.__model_params.get('resume_submission', False):
+            journal.start(fingerprint)
+            return bbox_predictions, set()
+
+        journal.load()
+
+        if journal.get_fingerprint() != fingerprint:
+            if journal.get_entries():
+                self.__logs['execution'].warning('The submission journal was written with other weights or '
+                                                 'bboxes, discarding its {} test images'
+                                                 .format(len(journal.get_entries())))
+            journal.start(fingerprint)
+            return bbox_predictions, set()
+
+        journaled_ids = set(journal.get_entries().keys())
+
+        if journaled_ids:
+            self.__logs['execution'].info('Resuming the submission, skipping {} test images already classified'
+                                          .format(len(journaled_ids)))
+
+        return {img_path: bboxes for img_path, bboxes in bbox_predictions.items()
+                if img_path.split(os.sep)[-1].split('.')[0] not in journaled_ids}, journaled_ids
 
     def classify(self,
                  train_list: List[List],
-                 bbox_predictions: Union[Dict[str, np.ndarray], None]) -> Union[Generator, None]:
+                 bbox_predictions: Union[Dict[str, np.ndarray], None]) \
+            -> Tuple[Union[Generator, None], Union[TestCropTable, None]]:
         """
         Classifies each character according to the available classes via a CNN
 
         :param train_list: a train data list predicted at the object detection step
         :param bbox_predictions: the bbox data predicted at the object detection step or None if
                                 predictions were not done. dict as {path: score, xmin, ymin, xmax, ymax}
-        :return: a couple of list with train and bbox data.
+        :return: a generator of the predictions of each page with at least one crop and the table of the
+            test crops, aligned to the predictions. None and None if predict_on_test is false
         """
 
+        # Where the crops are kept: a file for each crop, in memory or in a packed CropStore
+        crop_storage = self.__model_params.get('crop_storage', 'files')
+
+        if crop_storage not in ['files', 'memory', 'packed']:
+            raise ValueError("Crop storage {} is not valid. Possibilities are 'files', 'memory' or 'packed'."
+                             .format(crop_storage))
+
+        assert not (crop_storage != 'files' and self.__model_params['augmentation']), \
+            'Augmentation reads the crops from files, it can only be used with crop_storage "files"'
+
         # Train mode cropping
-        train_list = self.__img_cropper.get_crops(img_data=train_list,
-                                                  crop_char_path=os.path.join('datasets', 'char_cropped_train'),
-                                                  regenerate=self.__model_params['regenerate_crops_train'],
-                                                  mode='train')
+        train_images: Union[np.ndarray, None] = None
+        if crop_storage == 'files':
+            train_list = self.__img_cropper.get_crops(img_data=train_list,
+                                                      crop_char_path=os.path.join('datasets', 'char_cropped_train'),
+                                                      regenerate=self.__model_params['regenerate_crops_train'],
+                                                      mode='train',
+                                                      incremental=self.__model_params.get('incremental_crops', False))
+        else:
+            if crop_storage == 'memory':
+                train_images, train_labels = self.__img_cropper.get_crop_arrays(img_data=train_list, mode='train')
+            else:
+                crop_store = self.__img_cropper.get_crops(img_data=train_list,
+                                                          crop_char_path=os.path.join('datasets', 'char_packed_train'),
+                                                          regenerate=self.__model_params['regenerate_crops_train'],
+                                                          mode='train',
+                                                          packed=True)
+                train_images, train_labels = crop_store.get_crops(), crop_store.get_labels()
+
+            train_list = list(zip(range(len(train_labels)), train_labels))
 
         # Test mode cropping
-        test_list: Union[List[List[str]], None] = None
+        test_list: Union[List[List[str]], List[np.ndarray], None] = None
+        test_table: Union[TestCropTable, None] = None
         if self.__model_params['predict_on_test']:
-            test_list = self.__img_cropper.get_crops(img_data=bbox_predictions,
-                                                     crop_char_path=os.path.join('datasets', 'char_cropped_test'),
-                                                     regenerate=self.__model_params['regenerate_crops_test'],
-                                                     mode='test')
-            flat_test_list: List[str] = natsort.natsorted([i for sublist in test_list for i in sublist])
-            self.__write_test_list_to_csv(flat_test_list, bbox_predictions)
+            # Pages already journaled by an interrupted submission are not classified again. The crops kept
+            # incrementally on disk or in a packed store still cover all the pages, otherwise the crops of the
+            # journaled pages would be deleted (or the store regenerated) only because they were left out
+            pending_predictions, journaled_ids = self.__skip_journaled_pages(bbox_predictions)
+
+            if crop_storage == 'files':
+                incremental_crops = self.__model_params.get('incremental_crops', False)
+                test_list = self.__img_cropper.get_crops(img_data=bbox_predictions if incremental_crops
+                                                         else pending_predictions,
+                                                         crop_char_path=os.path.join('datasets', 'char_cropped_test'),
+                                                         regenerate=self.__model_params['regenerate_crops_test'],
+                                                         mode='test',
+                                                         incremental=incremental_crops)
+                test_list = [sublist for sublist in test_list
+                             if sublist and '_'.join(sublist[0].split(os.sep)[-1].split('_')[:-1]) not in journaled_ids]
+                # Sort pages and crops as the pages and crops kept in memory or in a packed store
+                test_list = natsort.natsorted([natsort.natsorted(sublist) for sublist in test_list],
+                                              key=lambda sublist: sublist[0])
+
+                # Get the pages and the indices of the boxes from the names of the crops, e.g. dataset/img_3.jpg
+                crop_names = [[crop_path.split(os.sep)[-1].split('.')[0] for crop_path in sublist]
+                              for sublist in test_list]
+                test_pages = [os.path.join(self.__model_params['test_images_path'],
+                                           '_'.join(names[0].split('_')[:-1]) + '.jpg') for names in crop_names]
+                box_indices = [[int(name.split('_')[-1]) for name in names] for names in crop_names]
+            else:
+                if crop_storage == 'memory':
+                    test_pages, test_list = self.__img_cropper.get_crop_arrays(img_data=pending_predictions,
+                                                                               mode='test')
+                else:
+                    crop_store = self.__img_cropper.get_crops(img_data=bbox_predictions,
+                                                              crop_char_path=os.path.join('datasets',
+                                                                                          'char_packed_test'),
+                                                              regenerate=self.__model_params['regenerate_crops_test'],
+                                                              mode='test',
+                                                              packed=True)
+                    test_pages, test_list = crop_store.get_pages(), crop_store.get_page_crops()
+
+                if journaled_ids:
+                    pending = [(img_path, crops) for img_path, crops in zip(test_pages, test_list)
+                               if img_path.split(os.sep)[-1].split('.')[0] not in journaled_ids]
+                    test_pages, test_list = [img_path for img_path, _ in pending], [crops for _, crops in pending]
+
+                # The crops of each page are in the order of its boxes
+                box_indices = [np.arange(len(crops)) for crops in test_list]
+
+            self.__logs['execution'].info('Writing test data table...')
+            test_table = TestCropTable.from_pages(list(zip(test_pages, box_indices)), bbox_predictions)
+            test_table.save(DEFAULT_TABLE_PATH)
 
         dataset = ClassificationDataset(self.__model_params)
-        _, _, xy_eval = dataset.generate_dataset(train_list)
+        _, _, xy_eval = dataset.generate_dataset(train_list, images=train_images)
 
         # Train the model
         if self.__model_params['train']:
@@ -280,6 +564,6 @@ class Classifier:
 
         # Generate predictions
         if self.__model_params['predict_on_test']:
-            return self.__generate_predictions(test_list)
+            return self.__generate_predictions(test_list), test_table
 
-        return None
+        return None, None
@@ -2,14 +2,17 @@ import pandas as pd
 import tensorflow as tf
 import numpy as np
 import os
-from typing import Dict, List, Union
+from typing import Callable, Dict, Iterable, List, Union, Generator, Tuple
 
 import natsort
 from tensorflow.python.keras.optimizers import Adam
 
 from networks.classes.centernet.datasets.DetectionDataset import DetectionDataset
+from networks.classes.centernet.models.InferencePredictor import InferencePredictor
+from networks.classes.centernet.models.ModelExporter import ModelExporter
 from networks.classes.centernet.models.ModelCenterNet import ModelCenterNet
 from networks.classes.centernet.utils.BBoxesHandler import BBoxesHandler
+from networks.classes.centernet.utils.ImageSizeIndex import DEFAULT_INDEX_PATH
 from networks.classes.centernet.utils.Metrics import Metrics
 from networks.classes.centernet.models.ModelGeneratorKaggle import ModelGeneratorKaggle
 from networks.classes.centernet.models.ModelGenerator import ModelGenerator
@@ -25,10 +28,17 @@ class Detector:
         self.__model_params.update(dataset_params)
 
         self.__metrics = Metrics()
-        self.__bb_handler = BBoxesHandler()
+        self.__bb_handler = BBoxesHandler(nms_backend=self.__model_params.get('nms_backend', 'auto'),
+                                          decode_mode=self.__model_params.get('decode_mode', 'dense'),
+                                          peaks_top_k=self.__model_params.get('peaks_top_k', 1000),
+                                          image_index_path=self.__model_params.get('image_index_path',
+                                                                                   DEFAULT_INDEX_PATH))
         self.__model_utils = ModelCenterNet(logs=self.__logs)
 
-        self.__model = self.__build_and_compile_model()
+        # The inference-only model exported by export_model, next to the weights
+        self.__export_path = os.path.join(os.path.dirname(self.__weights_path), 'export')
+
+        self.__model = self.__load_model()
 
         test_list = pd.read_csv(dataset_params['test_csv_path'])['image_id'].to_list()
         base_path = dataset_params['test_images_path']
@@ -45,9 +55,57 @@ class Detector:
 
         image_string = tf.read_file(path)
         image_decoded = tf.image.decode_jpeg(image_string)
-        image_resized = tf.image.resize(image_decoded, (input_h, input_w))
 
-        return image_resized / 255
+        return DetectionDataset.resize_image(image_decoded, input_h, input_w)
+
+    def __load_model(self) -> Union[tf.keras.Model, InferencePredictor]:
+        """
+        Loads the exported inference model if it must only predict and it has been exported, otherwise
+        builds and compiles the keras model
+        """
+
+        use_exported_model = self.__model_params.get('use_exported_model', False) \
+                             and not self.__model_params['train'] \
+                             and not self.__model_params['evaluate']
+
+        if use_exported_model and InferencePredictor.is_exported(self.__export_path):
+            # An export of other weights (e.g. before a new training) is stale
+            export_metadata = InferencePredictor.load_metadata(self.__export_path)
+            if export_metadata.get('weights') == self.__get_weights_fingerprint():
+                self.__logs['execution'].info('Loading the exported detection model from {}...'
+                                              .format(self.__export_path))
+                return InferencePredictor(self.__export_path)
+
+            self.__logs['execution'].warning('The detection model exported to {} does not match the weights to '
+                                             'restore, using the keras model. Export the model again to use it'
+                                             .format(self.__export_path))
+
+        return self.__build_and_compile_model()
+
+    def __get_weights_fingerprint(self) -> Dict:
+        """
+        :return: the fingerprint of the weights file restored in the model
+        """
+
+        weights_path = None
+        if self.__model_params['restore_weights']:
+            weights_path = self.__model_utils.get_weights_path(init_epoch=self.__model_params['initial_epoch'],
+                                                               weights_folder_path=self.__weights_path)
+
+        return self.__model_utils.fingerprint_weights(weights_path)
+
+    def export_model(self) -> Dict:
+        """
+        Exports the model for inference only, with the batch normalizations folded into the convolutions
+
+        :return: the metadata of the export
+        """
+
+        metadata = {'model': self.__model_params['model'],
+                    'mode': 'detection',
+                    'weights': self.__get_weights_fingerprint()}
+
+        return ModelExporter(log=self.__logs['execution']).export(self.__model, self.__export_path, metadata=metadata)
 
     def __build_and_compile_model(self):
 
@@ -108,7 +166,8 @@ class Detector:
         _, avg_iou = self.__bb_handler.get_train_tiled_bboxes(xy_eval,
                                                               model=self.__model,
                                                               n_tiles=2,
-                                                              show=False)
+                                                              show=False,
+                                                              batch_size=self.__model_params['batch_size_predict'])
         self.__logs['execution'].info('The average IoU score using tile model is: {}'.format(avg_iou))
 
     def __show_standard_predictions(self, xy_eval):
@@ -158,43 +217,131 @@ class Detector:
             else:
                 self.__show_standard_predictions(xy_eval)
 
-    def __generate_tile_predictions(self) -> Dict[str, np.array]:
+    def __stream_tile_predictions(self) -> Generator[Tuple[str, np.ndarray], None, None]:
 
         self.__logs['execution'].info('Converting test predictions into bounding boxes...')
-        return self.__bb_handler.get_test_tiled_bboxes(self.__test_list,
-                                                       model=self.__model,
-                                                       n_tiles=2,
-                                                       show=False)
+        return self.__bb_handler.iter_test_tiled_bboxes(self.__test_list,
+                                                        model=self.__model,
+                                                        n_tiles=2,
+                                                        show=False,
+                                                        batch_size=self.__model_params['batch_size_predict'])
 
-    def __generate_standard_predictions(self, test_set) -> Dict[str, np.array]:
+    def __stream_standard_predictions(self, test_set) -> Generator[Tuple[str, np.ndarray], None, None]:
 
-        self.__logs['execution'].info('Predicting test bounding boxes (takes time)...')
-        test_predictions = self.__model_utils.predict(model=self.__model, dataset=test_set)
-        self.__logs['execution'].info('Predictions completed.')
+        self.__logs['execution'].info('Predicting test bounding boxes and converting them batch by batch...')
+        predictions_gen = self.__model_utils.predict_batches(model=self.__model, dataset=test_set)
 
-        self.__logs['execution'].info('Converting test predictions into bounding boxes...')
-        return self.__bb_handler.get_test_standard_bboxes(test_predictions,
-                                                          test_images_path=self.__test_list,
-                                                          show=False)
+        return self.__bb_handler.iter_test_standard_bboxes(predictions_gen,
+                                                           test_images_path=self.__test_list,
+                                                           show=False)
 
-    def __generate_test_predictions(self, dataset) -> Dict[str, np.array]:
+    def stream_test_predictions(self, dataset) -> Generator[Tuple[str, np.ndarray], None, None]:
+        """
+        Generates the predicted bboxes of the test images one image at a time. The predictions of the
+        model are decoded batch by batch, so memory is bounded by the batch size and not by the size
+        of the test set.
 
-        test_set, _ = dataset.get_test_set()
+        :param dataset: the detection dataset holding the test set
+        :return: a generator of (image_path, np.array[<score>, <ymin>, <xmin>, <ymax>, <xmax>]) pairs
+        """
 
         if self.__model_params['tiling']:
-            predictions = self.__generate_tile_predictions()
+            yield from self.__stream_tile_predictions()
         else:
-            predictions = self.__generate_standard_predictions(test_set)
+            test_set, _ = dataset.get_test_set()
+            yield from self.__stream_standard_predictions(test_set)
 
         self.__logs['execution'].info('Conversion completed.')
 
-        return predictions
+    def __generate_test_predictions(self, dataset) -> Dict[str, np.array]:
+        return dict(self.stream_test_predictions(dataset))
 
-    def detect(self, preprocessed_dataset) -> (List[List], Union[Dict[str, np.ndarray], None]):
+    def stream_inference_predictions(self, train_list: List[List]) -> Generator[Tuple[str, np.ndarray], None, None]:
+        """
+        Inference only: generates the predicted bboxes of the test images one image at a time, without
+        training or evaluating the model and without collecting the predictions of the whole test set
+
+        :param train_list: the train data list (crop values) computed at the preprocessing step
+        :return: a generator of (image_path, np.array[<score>, <ymin>, <xmin>, <ymax>, <xmax>]) pairs
+        """
+
+        dataset = DetectionDataset(self.__model_params)
+        dataset.generate_dataset(train_list, self.__test_list)
+
+        yield from self.stream_test_predictions(dataset)
+
+    def predict_batch(self, batch: np.ndarray) -> np.ndarray:
+        """
+        :param batch: the normalized pages or tiles, resized to the input of the model
+        :return: the predictions of the model (Bx128x128x5)
+        """
+
+        return np.asarray(self.__model.predict_on_batch(batch))
+
+    def detect_images(self,
+                      images: List[np.ndarray],
+                      predict_fn: Callable[[np.ndarray], np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Inference only: predicts the bboxes of pages already decoded in memory (e.g. received by a service).
+        In standard mode the pages are resized to the input of the model and predicted together, in tiling
+        mode the tiles of each page are predicted together
+
+        :param images: the RGB pages as uint8 arrays of shape (height, width, 3)
+        :param predict_fn: the function predicting a batch, e.g. a batching scheduler shared by many callers.
+            Defaults to the model of the detector
+        :return: for each page, np.array[<score>, <ymin>, <xmin>, <ymax>, <xmax>] in page coordinates
+        """
+
+        predict_fn = predict_fn if predict_fn is not None else self.predict_batch
+
+        if self.__model_params['tiling']:
+            return [self.__bb_handler.decode_tiled_page_bboxes(img, predict_fn, n_tiles=2) for img in images]
+
+        # The pages are resized as the ones of the test set, so that they are predicted the same
+        batch = np.stack([np.asarray(DetectionDataset.resize_image(img,
+                                                                   self.__model_params['input_height'],
+                                                                   self.__model_params['input_width']))
+                          for img in images])
+
+        predictions = predict_fn(batch)
+
+        return self.__bb_handler.decode_page_bboxes(predictions, [(img.shape[1], img.shape[0]) for img in images])
+
+    def get_inference_stages(self, train_list: List[List]) \
+            -> Tuple[Iterable, List[Tuple[str, Callable[[Iterable], Iterable]]]]:
+        """
+        Inference only: splits the prediction of the test bboxes into stages which can run concurrently on
+        different batches, i.e. the decoding of the pages (the source), the forward pass of the model and the
+        decoding of the boxes with the NMS. Tiled predictions are run as a single source stage
+
+        :param train_list: the train data list (crop values) computed at the preprocessing step
+        :return: the source of the stages and a list of (stage name, stage function), chaining to a stream of
+            (image_path, np.array[<score>, <ymin>, <xmin>, <ymax>, <xmax>]) pairs
+        """
+
+        if self.__model_params['tiling']:
+            return self.__stream_tile_predictions(), []
+
+        dataset = DetectionDataset(self.__model_params)
+        dataset.generate_dataset(train_list, self.__test_list)
+        test_set, _ = dataset.get_test_set()
+
+        def forward_pass(batches: Iterable) -> Generator[np.ndarray, None, None]:
+            for batch in batches:
+                yield self.predict_batch(batch)
+
+        def decode_boxes(predictions: Iterable[np.ndarray]) -> Generator[Tuple[str, np.ndarray], None, None]:
+            return self.__bb_handler.iter_test_standard_bboxes(predictions,
+                                                               test_images_path=self.__test_list,
+                                                               show=False)
+
+        return test_set, [('detection', forward_pass), ('box_decoding', decode_boxes)]
+
+    def detect(self, train_list: List[List]) -> (List[List], Union[Dict[str, np.ndarray], None]):
         """
         Creates and runs a CenterNet to perform the image detection
 
-        :param preprocessed_dataset: a ratio predictor
+        :param train_list: the train data list (crop values) computed at the preprocessing step
         :return: a couple of lists with train and bbox data. Bbox data are available only if
                  model_params['predict_on_test] is true. Otherwise return None
 
@@ -213,8 +360,6 @@ class Detector:
          {<image_path>: np.array[<score>, <ymin>, <xmin>, <ymax>, <xmax>]}
         """
 
-        train_list: List[List] = preprocessed_dataset.get_crop_values()
-
         # Pass the list of test images if we are in test mode,
         # otherwise pass None, so that the test set will not be generated
         self.__test_list = self.__test_list if self.__model_params['predict_on_test'] else None
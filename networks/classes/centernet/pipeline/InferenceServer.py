@@ -0,0 +1,237 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+from networks.classes.centernet.pipeline.Classifier import Classifier
+from networks.classes.centernet.pipeline.Detector import Detector
+from networks.classes.centernet.pipeline.SubmissionHandler import SubmissionHandler
+from networks.classes.centernet.utils.MicroBatcher import MicroBatcher
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front-end of the inference server:
+    - POST /predict?image_id=<id> with the bytes of a page image, returns {"image_id": ..., "labels": ...}
+      with the labels in the format of the submission, 'unicode X Y unicode X Y ...'
+    - GET /health, returns {"status": "ok"}
+    - GET /stats, returns the counters of the server
+    """
+
+    def log_message(self, format, *args):
+        self.server.inference_server.get_log().debug(format % args)
+
+    def __send_json(self, status: int, content: Dict):
+        body = json.dumps(content).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+
+        if path == '/health':
+            self.__send_json(200, {'status': 'ok'})
+        elif path == '/stats':
+            self.__send_json(200, self.server.inference_server.get_stats())
+        else:
+            self.__send_json(404, {'error': 'Unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path != '/predict':
+            self.__send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+            return
+
+        image_id = parse_qs(url.query).get('image_id', [''])[0]
+
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.__send_json(400, {'image_id': image_id, 'error': 'Missing or invalid Content-Length'})
+            return
+
+        if content_length <= 0:
+            self.__send_json(400, {'image_id': image_id, 'error': 'The body is empty'})
+            return
+
+        try:
+            image_bytes = self.rfile.read(content_length)
+            img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        except (cv2.error, ValueError):
+            img = None
+
+        if img is None:
+            self.__send_json(400, {'image_id': image_id, 'error': 'The body is not a valid image'})
+            return
+
+        try:
+            labels = self.server.inference_server.predict_page(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+        except Exception as e:
+            self.__send_json(500, {'image_id': image_id, 'error': str(e)})
+            return
+
+        self.__send_json(200, {'image_id': image_id, 'labels': labels})
+
+
+class InferenceServer:
+    """
+    Long-lived local inference service. The detector and the classifier are loaded once, then each page
+    received from a client is processed in the thread of its request, while the model calls go through a
+    batching scheduler for each model: the pages (or their tiles) and the crops of concurrent requests are
+    coalesced into full batches (see MicroBatcher).
+
+    The server binds to the loopback interface by default.
+    """
+
+    def __init__(self,
+                 detector: Detector,
+                 classifier: Classifier,
+                 sub_handler: SubmissionHandler,
+                 log,
+                 host: str = '127.0.0.1',
+                 port: int = 8500,
+                 detector_batch_size: int = 8,
+                 classifier_batch_size: int = 300,
+                 max_wait: float = 0.01):
+        """
+        :param detector: the detector, with the weights restored
+        :param classifier: the classifier, with the weights restored
+        :param sub_handler: the submission handler formatting the labels
+        :param log: the logger
+        :param host: the address the server binds to
+        :param port: the port the server listens on, 0 to pick a free one
+        :param detector_batch_size: the maximum number of pages (or tiles) in each batch of the detector
+        :param classifier_batch_size: the maximum number of crops in each batch of the classifier
+        :param max_wait: the maximum time in seconds a request waits for a batch to be filled
+        """
+
+        self.__detector = detector
+        self.__classifier = classifier
+        self.__sub_handler = sub_handler
+        self.__log = log
+
+        self.__detector_batcher = MicroBatcher(predict_fn=detector.predict_batch,
+                                               log=log,
+                                               name='detector',
+                                               max_batch_size=detector_batch_size,
+                                               max_wait=max_wait)
+
+        self.__classifier_batcher = MicroBatcher(predict_fn=classifier.predict_batch,
+                                                 log=log,
+                                                 name='classifier',
+                                                 max_batch_size=classifier_batch_size,
+                                                 max_wait=max_wait)
+
+        self.__stats_lock = threading.Lock()
+        self.__stats = {'requests': 0, 'errors': 0}
+
+        self.__http_server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+        self.__http_server.inference_server = self
+
+        self.__thread = None
+
+    def get_log(self):
+        return self.__log
+
+    def get_address(self) -> Tuple[str, int]:
+        return self.__http_server.server_address[:2]
+
+    def get_stats(self) -> Dict:
+        """
+        :return: the counters of the requests and the metrics of the batching scheduler of each model
+        """
+
+        with self.__stats_lock:
+            stats = dict(self.__stats)
+
+        stats['detector'] = self.__detector_batcher.get_metrics()
+        stats['classifier'] = self.__classifier_batcher.get_metrics()
+
+        return stats
+
+    def predict_page(self, img: np.ndarray) -> str:
+        """
+        Detects and classifies the characters of a page, batching the model calls with the other requests
+
+        :param img: the RGB page as a uint8 array of shape (height, width, 3)
+        :return: the labels of the page, as a string 'unicode X Y unicode X Y ...'
+        """
+
+        try:
+            bboxes = self.__detector.detect_images([img], predict_fn=self.__detector_batcher.predict)
+            (boxes, scores), = self.__classifier.classify_images([img], bboxes,
+                                                                 predict_fn=self.__classifier_batcher.predict)
+        except Exception:
+            with self.__stats_lock:
+                self.__stats['requests'] += 1
+                self.__stats['errors'] += 1
+            raise
+
+        with self.__stats_lock:
+            self.__stats['requests'] += 1
+
+        return self.__sub_handler.format_page(boxes, scores)
+
+    def start(self):
+        """
+        Starts the batching schedulers and the HTTP server in a background thread
+        """
+
+        self.__detector_batcher.start()
+        self.__classifier_batcher.start()
+
+        self.__thread = threading.Thread(target=self.__http_server.serve_forever, name='http', daemon=True)
+        self.__thread.start()
+
+        host, port = self.get_address()
+        self.__log.info('Inference server listening on http://{}:{}'.format(host, port))
+
+    def serve_forever(self):
+        """
+        Runs the server until it is interrupted
+        """
+
+        self.start()
+
+        try:
+            while self.__thread.is_alive():
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.__log.info('Inference server interrupted')
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Stops the HTTP server and the batching schedulers, then closes the socket
+        """
+
+        if self.__thread is not None:
+            self.__http_server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+
+            self.__detector_batcher.stop()
+            self.__classifier_batcher.stop()
+
+        self.__http_server.server_close()
+
+        self.__log.info('Inference server stopped, {} requests ({} errors)'.format(self.__stats['requests'],
+                                                                                  self.__stats['errors']))
+        self.__detector_batcher.log_metrics()
+        self.__classifier_batcher.log_metrics()
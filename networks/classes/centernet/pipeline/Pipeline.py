@@ -1,16 +1,26 @@
+import copy
 import os
 import shutil
 import sys
-from typing import List, Dict, Union, Generator
+from typing import List, Dict, Tuple, Union, Generator
 import numpy as np
-from networks.classes.centernet.datasets.PreprocessingDataset import PreprocessingDataset
 from networks.classes.centernet.pipeline.Preprocessor import Preprocessor
 from networks.classes.centernet.pipeline.Detector import Detector
 from networks.classes.centernet.pipeline.Classifier import Classifier
+from networks.classes.centernet.pipeline.InferenceServer import InferenceServer
 from networks.classes.centernet.pipeline.SubmissionHandler import SubmissionHandler
 from networks.classes.centernet.pipeline.Visualizer import Visualizer
+from networks.classes.centernet.utils.StageCache import DEFAULT_STAGE_CACHE_PATH, StageCache
+from networks.classes.centernet.utils.StagedExecutor import StagedExecutor
+from networks.classes.centernet.utils.SubmissionJournal import DEFAULT_JOURNAL_PATH
+from networks.classes.centernet.utils.TestCropTable import TestCropTable
 from networks.classes.general_utilities import Params
 
+# The dataset parameters read by each cached stage, the other ones (e.g. of the submission) do not change its artifacts
+PREPROCESSING_DATASET_KEYS = ['train_csv_path', 'train_images_path', 'image_index_path',
+                              'training_ratio', 'validation_ratio', 'evaluation_ratio']
+DETECTION_DATASET_KEYS = ['test_csv_path', 'test_images_path', 'image_index_path']
+
 
 class CenterNetPipeline:
 
@@ -19,6 +29,11 @@ class CenterNetPipeline:
         self.__dataset_params = dataset_params
         self.__dict_cat: Dict[str, int] = {}
 
+        # Cache of the artifacts of the preprocessing and detection stages, None if disabled
+        self.__stage_cache: Union[StageCache, None] = None
+        if dataset_params.get('cache_stages', False):
+            self.__stage_cache = StageCache(dataset_params.get('stage_cache_path', DEFAULT_STAGE_CACHE_PATH))
+
     def __check_no_weights_in_run_folder(self, folder: str):
         """
         Checks if the given folder contains weights files and  asks the user permission to delete them
@@ -46,34 +61,92 @@ class CenterNetPipeline:
                     self.__logs['execution'].info('Aborting after user command!')
                     sys.exit(0)
 
-    def __run_preprocessing(self, model_params: Dict) -> PreprocessingDataset:
+    @staticmethod
+    def __select_params(params: Dict, keys: List[str]) -> Dict:
+        """
+        :return: the given keys of the parameters, None for the missing ones
+        """
+
+        return {key: params.get(key) for key in keys}
+
+    def __run_preprocessing(self, model_params: Dict) -> (Dict[int, float], List[List]):
         """
         Creates and runs a CNN which takes an image/page of manuscript as input and predicts the
-        average dimensional ratio between the characters and the image itself
+        average dimensional ratio between the characters and the image itself.
+        The artifacts are loaded from the stage cache if the inputs did not change
 
         :param model_params: the parameters related to the network
-        :return: a ratio predictor
+        :return: the class weights and the train data list (crop values)
         """
 
+        cache_key = None
+        if self.__stage_cache is not None:
+            cache_key = self.__stage_cache.get_key('preprocessing',
+                                                   model_params,
+                                                   self.__select_params(self.__dataset_params,
+                                                                        PREPROCESSING_DATASET_KEYS),
+                                                   self.__stage_cache.fingerprint(
+                                                       [self.__dataset_params['train_csv_path'],
+                                                        self.__dataset_params['train_images_path']]))
+
+            artifacts = self.__stage_cache.load('preprocessing', cache_key)
+            if artifacts is not None:
+                self.__logs['execution'].info('Loaded the preprocessing artifacts from the stage cache')
+                self.__dict_cat = artifacts['dict_cat']
+                return artifacts['class_weights'], artifacts['train_list']
+
         preprocessor = Preprocessor(dataset_params=self.__dataset_params, log=self.__logs['execution'])
         preprocessed_dataset, self.__dict_cat = preprocessor.preprocess_data(model_params)
 
-        return preprocessed_dataset
+        class_weights, train_list = preprocessed_dataset.get_class_weights(), preprocessed_dataset.get_crop_values()
+
+        if self.__stage_cache is not None:
+            self.__stage_cache.save('preprocessing', cache_key, {'dict_cat': self.__dict_cat,
+                                                                 'class_weights': class_weights,
+                                                                 'train_list': train_list})
+
+        return class_weights, train_list
+
+    def __get_detection_cache_key(self, model_params: Dict, dataset_params: Dict, weights_path: str) -> str:
+        """
+        :return: the key of the detection artifacts, derived from the parameters, the test data and the weights
+        """
+
+        return self.__stage_cache.get_key('detection',
+                                          model_params,
+                                          self.__select_params(dataset_params, DETECTION_DATASET_KEYS),
+                                          self.__stage_cache.fingerprint([self.__dataset_params['test_csv_path'],
+                                                                          self.__dataset_params['test_images_path'],
+                                                                          weights_path]))
 
     def __run_detection(self,
                         model_params: Dict,
-                        preprocessed_dataset,
+                        train_list: List[List],
                         weights_path: str) -> (List[List], Union[Dict[str, np.ndarray], None]):
         """
-        Creates and runs a CenterNet to perform the image detection
+        Creates and runs a CenterNet to perform the image detection.
+        Unless training or evaluating, the test bboxes are loaded from the stage cache if the inputs did not change
 
         :param model_params: the parameters related to the network
-        :param preprocessed_dataset: a ratio predictor
+        :param train_list: the train data list (crop values) computed at the preprocessing step
         :param weights_path: the path to the saved weights (if present)
         :return: a couple of lists with train and bbox data. Bbox data are available only if
                  model_params['predict_on_test] is true. Otherwise return None
         """
 
+        cache_stage = self.__stage_cache is not None and model_params['predict_on_test']
+        inference_only = not model_params['train'] and not model_params['evaluate']
+
+        # The parameters are copied before the run, which may update them
+        params_copy = copy.deepcopy(model_params), copy.deepcopy(self.__dataset_params)
+
+        if cache_stage and inference_only:
+            bbox_predictions = self.__stage_cache.load('detection',
+                                                       self.__get_detection_cache_key(*params_copy, weights_path))
+            if bbox_predictions is not None:
+                self.__logs['execution'].info('Loaded the detection artifacts from the stage cache')
+                return train_list, bbox_predictions
+
         # Check weights folder is not full of previous stuff
         if model_params['train'] and not model_params['restore_weights']:
             self.__check_no_weights_in_run_folder(weights_path)
@@ -83,14 +156,22 @@ class CenterNetPipeline:
                             weights_path=weights_path,
                             logs=self.__logs)
 
-        return detector.detect(preprocessed_dataset)
+        train_list, bbox_predictions = detector.detect(train_list)
+
+        # The key is computed after the run, as training changes the weights
+        if cache_stage:
+            self.__stage_cache.save('detection',
+                                    self.__get_detection_cache_key(*params_copy, weights_path),
+                                    bbox_predictions)
+
+        return train_list, bbox_predictions
 
     def __run_classification(self,
                              model_params: Dict,
                              train_list: List[List],
                              bbox_predictions: Union[Dict[str, np.ndarray], None],
                              class_weights: Dict,
-                             weights_path: str) -> Union[Generator, None]:
+                             weights_path: str) -> Tuple[Union[Generator, None], Union[TestCropTable, None]]:
         """
         Classifies each character according to the available classes via a CNN
 
@@ -99,7 +180,8 @@ class CenterNetPipeline:
         :param bbox_predictions: the bbox data predicted at the object detection step or
             None if predictions were not done.
         :param weights_path: the path to the saved weights (if present)
-        :return: a couple of list with train and bbox data.
+        :return: a generator of the class predictions of the test pages and the table of the test crops,
+            or None and None if predictions were not done
         """
 
         # Check weights folder is not full of previous stuff
@@ -115,21 +197,133 @@ class CenterNetPipeline:
         return classifier.classify(train_list=train_list,
                                    bbox_predictions=bbox_predictions)
 
-    def __write_submission(self, predictions_gen: Generator = None):
+    def __write_submission(self, predictions_gen: Generator = None, test_table: TestCropTable = None):
         """
         Writes a submission csv file in the format:
         - names of columns : image_id, labels
         - example of row   : image_id, {label X Y} {...}
         :param predictions_gen: a list of class predictions for the cropped characters
+        :param test_table: the table of the test crops, aligned to the predictions
         """
 
-        sub_writer = SubmissionHandler(dict_cat=self.__dict_cat, log=self.__logs['execution'])
+        sub_writer = SubmissionHandler(dict_cat=self.__dict_cat,
+                                       log=self.__logs['execution'],
+                                       journal_path=self.__dataset_params.get('submission_journal_path',
+                                                                              DEFAULT_JOURNAL_PATH))
 
         if predictions_gen is not None:
-            sub_writer.write(predictions_gen)
+            sub_writer.write(predictions_gen, test_table)
         else:
             sub_writer.test(max_visualizations=5)
 
+    def __build_inference_models(self, params: Params, experiment_path: str) \
+            -> Tuple[List[List], Detector, Classifier, SubmissionHandler]:
+        """
+        Builds the detector, the classifier and the submission handler for inference only, restoring the
+        weights of the models
+
+        :param params: the parameters of the models
+        :param experiment_path: the base path to the current experiment
+        :return: the train data list, the detector, the classifier and the submission handler
+        """
+
+        assert params.detector['restore_weights'] and params.classifier['restore_weights'], \
+            'Inference requires restoring the weights of both the detector and the classifier'
+
+        class_weights, train_list = self.__run_preprocessing(model_params=params.preprocessor)
+
+        detector = Detector(model_params=params.detector,
+                            dataset_params=self.__dataset_params,
+                            weights_path=os.path.join(experiment_path + '_2', 'weights'),
+                            logs=self.__logs)
+
+        classifier = Classifier(model_params=params.classifier,
+                                dataset_params=self.__dataset_params,
+                                weights_path=os.path.join(experiment_path + '_3', 'weights'),
+                                class_weights=class_weights,
+                                logs=self.__logs)
+
+        sub_writer = SubmissionHandler(dict_cat=self.__dict_cat, log=self.__logs['execution'])
+
+        return train_list, detector, classifier, sub_writer
+
+    def __run_inference(self, params: Params, experiment_path: str) -> Dict[str, str]:
+        """
+        Runs detection, classification and submission as a single in-memory stream of test pages: boxes,
+        crops and class scores are handed over page by page, the only file written is the submission csv.
+        The models are not trained nor evaluated, their weights are restored
+
+        :param params: the parameters of the models
+        :param experiment_path: the base path to the current experiment
+        :return: the labels of each predicted test image, by image id
+        """
+
+        train_list, detector, classifier, sub_writer = self.__build_inference_models(params, experiment_path)
+
+        write_to_disk = self.__dataset_params.get('write_inference_submission', True)
+
+        if not self.__dataset_params.get('pipelined_inference', False):
+            bbox_predictions = detector.stream_inference_predictions(train_list)
+            classified_pages = classifier.classify_pages(bbox_predictions)
+
+            return sub_writer.write_pages(classified_pages, write_to_disk=write_to_disk)
+
+        # Each stage runs in its own thread, working on a different page (or batch) than the others
+        source, detector_stages = detector.get_inference_stages(train_list)
+        stages = detector_stages + [('cropping', classifier.crop_pages),
+                                    ('classification', classifier.classify_crops),
+                                    ('formatting', sub_writer.format_pages)]
+
+        executor = StagedExecutor(log=self.__logs['execution'],
+                                  queue_size=self.__dataset_params.get('inference_queue_size', 8))
+
+        return sub_writer.write_labels(executor.run(source, stages, source_name='page_decoding'),
+                                       write_to_disk=write_to_disk)
+
+    def __run_export(self, params: Params, experiment_path: str):
+        """
+        Exports the detector and the classifier as inference-only models, with the batch normalizations folded,
+        to the 'export' folder next to their weights
+
+        :param params: the parameters of the models
+        :param experiment_path: the base path to the current experiment
+        """
+
+        # The models to export are always the keras ones, restored from their weights
+        export_params = copy.copy(params)
+        export_params.detector = dict(params.detector, use_exported_model=False)
+        export_params.classifier = dict(params.classifier, use_exported_model=False)
+
+        _, detector, classifier, _ = self.__build_inference_models(export_params, experiment_path)
+
+        self.__logs['execution'].info('Exporting the detection model...')
+        detector.export_model()
+
+        self.__logs['execution'].info('Exporting the classification model...')
+        classifier.export_model()
+
+    def __run_server(self, params: Params, experiment_path: str):
+        """
+        Loads the models once and serves the predictions of the pages sent by local clients, until interrupted
+
+        :param params: the parameters of the models and of the server
+        :param experiment_path: the base path to the current experiment
+        """
+
+        _, detector, classifier, sub_writer = self.__build_inference_models(params, experiment_path)
+
+        server = InferenceServer(detector=detector,
+                                 classifier=classifier,
+                                 sub_handler=sub_writer,
+                                 log=self.__logs['execution'],
+                                 host=params.server.get('host', '127.0.0.1'),
+                                 port=params.server.get('port', 8500),
+                                 detector_batch_size=params.server.get('detector_batch_size', 8),
+                                 classifier_batch_size=params.server.get('classifier_batch_size',
+                                                                         params.classifier['batch_size_predict']),
+                                 max_wait=params.server.get('max_wait_ms', 10) / 1000)
+        server.serve_forever()
+
     def __visualize_final_results(self, max_visualizations: int = 5):
         """
         Visualizes the predicted results
@@ -150,15 +344,30 @@ class CenterNetPipeline:
             - classification
             - submission
             - visualization
+            - inference (in-memory detection, classification and submission, exclusive of the others)
+            - serving (local inference server, exclusive of the others)
+            - exporting (inference-only models, exclusive of the others)
         :param params: the parameters of the models
         :param experiment_path: the base path to the current experiment
         """
 
         self.__logs['execution'].info('Starting learning pipeline with operations: {}'.format(operations))
 
+        if 'inference' in operations:
+            self.__run_inference(params, experiment_path)
+            return
+
+        if 'serving' in operations:
+            self.__run_server(params, experiment_path)
+            return
+
+        if 'exporting' in operations:
+            self.__run_export(params, experiment_path)
+            return
+
         # --- STEP 1: Pre-processing ---
         if 'preprocessing' in operations:
-            preprocessed_dataset = self.__run_preprocessing(model_params=params.preprocessor)
+            class_weights, train_list = self.__run_preprocessing(model_params=params.preprocessor)
 
         # --- STEP 2: Detection using CenterNet ---
         if 'detection' in operations:
@@ -168,7 +377,7 @@ class CenterNetPipeline:
                                 'Please specify "preprocessing" in the list of operations')
 
             train_list, bbox_predictions = self.__run_detection(model_params=params.detector,
-                                                                preprocessed_dataset=preprocessed_dataset,
+                                                                train_list=train_list,
                                                                 weights_path=os.path.join(experiment_path + '_2',
                                                                                           'weights'))
 
@@ -179,18 +388,19 @@ class CenterNetPipeline:
                 raise Exception('ERROR: Cannot perform classification without detection!'
                                 'Please specify "detection" in the list of operations')
 
-            predictions = self.__run_classification(model_params=params.classifier,
-                                                    train_list=train_list,
-                                                    bbox_predictions=bbox_predictions,
-                                                    class_weights=preprocessed_dataset.get_class_weights(),
-                                                    weights_path=os.path.join(experiment_path + '_3', 'weights'))
+            predictions, test_table = self.__run_classification(model_params=params.classifier,
+                                                                train_list=train_list,
+                                                                bbox_predictions=bbox_predictions,
+                                                                class_weights=class_weights,
+                                                                weights_path=os.path.join(experiment_path + '_3',
+                                                                                          'weights'))
 
         # -- STEP 4:  Analysis and visualization of results ---
         if 'submission' in operations:
             if 'test_submission' in operations:
                 self.__write_submission()
             else:
-                self.__write_submission(predictions)
+                self.__write_submission(predictions, test_table)
 
         if 'visualization' in operations:
             self.__visualize_final_results()
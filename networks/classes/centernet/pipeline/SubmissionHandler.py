@@ -1,7 +1,6 @@
 import os
-import gc
-from itertools import islice
-from typing import Generator, List, Tuple
+from collections import OrderedDict
+from typing import Dict, Generator, Iterable, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -9,13 +8,27 @@ from tqdm import tqdm
 import regex as re
 
 from networks.classes.centernet.utils.BBoxesVisualizer import BBoxesVisualizer
+from networks.classes.centernet.utils.SubmissionJournal import DEFAULT_JOURNAL_PATH, SubmissionJournal
+from networks.classes.centernet.utils.SubmissionWriter import SubmissionWriter
+from networks.classes.centernet.utils.TestCropTable import DEFAULT_TABLE_PATH, TestCropTable
 
 
 class SubmissionHandler:
 
-    def __init__(self, dict_cat, log):
+    def __init__(self, dict_cat, log, journal_path: str = DEFAULT_JOURNAL_PATH):
+        """
+        :param dict_cat: the mapping from the unicode classes to their indices
+        :param log: the logger
+        :param journal_path: the path to the journal of the classified pages, from which the submission is written
+        """
+
         self.__log = log
-        self.__dict_cat: [str, str] = {str(v): k for k, v in dict_cat.items()}
+        self.__journal_path = journal_path
+
+        # Lookup table from the index of each class to its unicode
+        self.__class_unicodes = np.empty(max(int(v) for v in dict_cat.values()) + 1 if dict_cat else 0, dtype=object)
+        for k, v in dict_cat.items():
+            self.__class_unicodes[int(v)] = k
 
     def test(self, max_visualizations=5):
 
@@ -54,155 +67,194 @@ class SubmissionHandler:
 
             i += 1
 
-    def __get_class(self, prediction: List[List]):
+    def __get_class(self, prediction: np.ndarray) -> np.ndarray:
         """
-        Gets list of unicode classes from the predictions
-        :param prediction: a list of class predictions
-        :return:
+        Gets the unicode classes from the predictions
+        :param prediction: the class predictions, with shape (n chars, n classes)
+        :return: the array of the unicode classes
         """
 
-        return [self.__dict_cat[str(k)] for k in np.argmax(prediction, axis=1)]
+        return self.__class_unicodes[np.argmax(prediction, axis=1)]
 
     @staticmethod
-    def __get_center_coords(bbox: List[str]):
+    def __get_center_coords(bbox: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """
         Gets the coordinates of the center of the bboxes
-        :param bbox: a string representing the coordinates of the bbox
-        :return:
+        :param bbox: the float coordinates of the bboxes, as rows [ymin, xmin, ymax, xmax]
+        :return: the integer x and y coordinates of the centers
         """
 
-        # Get the coordinates of the bbox
-        # ymin, xmin, ymax, xmax = bbox.split(':')
-        coords = [(round(float(ymin)), round(float(xmin)), round(float(ymax)), round(float(xmax)))
-                  for ymin, xmin, ymax, xmax in (bb.split(':') for bb in bbox)]
+        # np.round rounds half to even, as the builtin round
+        ymin, xmin, ymax, xmax = np.round(bbox).astype(np.int64).T
 
-        # ymin = round(float(ymin))
-        # xmin = round(float(xmin))
-        # ymax = round(float(ymax))
-        # xmax = round(float(xmax))
+        return xmin + (xmax - xmin) // 2, ymin + (ymax - ymin) // 2
 
-        return [(str(xmin + ((xmax - xmin) // 2)), str(ymin + ((ymax - ymin) // 2)))
-                for ymin, xmin, ymax, xmax in coords]
+    @staticmethod
+    def __format_labels(unicode: np.ndarray, x_centers: np.ndarray, y_centers: np.ndarray) -> str:
+        """
+        Formats the labels of a page as a string 'label X Y label X Y ...'
+        """
 
-    def __write_img_with_chars(self, images_data, predictions_gen, path_to_submission):
+        labels = np.empty(3 * len(unicode), dtype=object)
+        labels[0::3] = unicode
+        labels[1::3] = x_centers.astype(str)
+        labels[2::3] = y_centers.astype(str)
 
-        submission_list = []
+        return ' '.join(labels.tolist())
+
+    def __write_img_with_chars(self, test_table: TestCropTable, predictions_gen, journal: SubmissionJournal):
+
+        # Get the coordinates of the centers of all the boxes at once
+        x_centers, y_centers = self.__get_center_coords(test_table.get_boxes())
+        page_offsets = test_table.get_page_offsets()
 
         # Iterate over all the predicted original images
-        for img_data in tqdm(images_data, total=len(images_data)):
+        for page_idx, img_id in enumerate(tqdm(test_table.get_page_ids())):
 
-            batch_labels: List[str] = []
-            bboxes = list(img_data['bboxes'].split(' '))
+            start, end = page_offsets[page_idx], page_offsets[page_idx + 1]
 
-            # Iterate over all the bboxes of the current image
-            i = 0
-            while i < len(bboxes):
+            # Get the unicode classes of all the bboxes of the current image
+            page_unicode: List[np.ndarray] = []
+            n_predicted = 0
+            while n_predicted < end - start:
                 # Get a class prediction from the generator
                 try:
                     prediction = next(predictions_gen)
                 except StopIteration:
                     break
 
-                batch_size = len(prediction)
+                page_unicode.append(self.__get_class(prediction))
+                n_predicted += len(prediction)
 
-                # Get batch of bboxes with same length
-                bbox_batch = bboxes[i:i + batch_size]
-                i += batch_size
+            unicode = np.concatenate(page_unicode)[:end - start] if page_unicode else np.empty(0, dtype=object)
+            end = start + len(unicode)
 
-                # Get the unicode classes from the predictions
-                unicode: List[str] = self.__get_class(prediction)
+            # Journal the submission of the current image
+            journal.append(str(img_id), self.__format_labels(unicode, x_centers[start:end], y_centers[start:end]))
 
-                del prediction
-                gc.collect()
+    @staticmethod
+    def __write_img_with_no_chars(writer: SubmissionWriter):
 
-                # Get the coordinates of the center of boxes in 'bbox_batch'
-                coords: List[Tuple[str, str]] = self.__get_center_coords(bbox_batch)
+        for img_path in tqdm(os.listdir(os.path.join('datasets', 'kaggle', 'testing', 'images'))):
 
-                # Append the labels of current batch to the list of the labels of the current image
-                batch_labels.extend([' '.join([u, c[0], c[1]]) for u, c in zip(unicode, coords)])
+            img_id = img_path.split(os.sep)[-1].split('.')[0]
 
-            # Gather the data for the submission of the current image
-            submission_list.append({'image_id': img_data['original_image'],
-                                    'labels': ' '.join(batch_labels)})
+            # Write an empty submission for the images which have not been written
+            if not writer.is_written(img_id):
+                writer.write_row(img_id, '')
 
-        # Write the submission to csv
-        img_submission = pd.DataFrame(submission_list, columns=['image_id', 'labels'])
-        img_submission.to_csv(path_to_submission, mode='a', header=False)
+    def write(self, predictions_gen: Generator, test_table: TestCropTable = None):
+        """
+        Writes a submission csv file in the format:
+        - names of columns : image_id, labels
+        - example of row   : image_id, {label X Y} {...}
+        :param predictions_gen: a list of class predictions for the cropped characters
+        :param test_table: the table of the test crops aligned to the predictions, read from disk if None
+        """
 
-    @staticmethod
-    def __write_img_with_no_chars(path_to_submission):
+        self.__log.info('Writing submission data...')
 
-        submission = pd.read_csv(path_to_submission)
-        submitted_images = submission['image_id'].tolist()
+        # Read the test data table from disk if not handed over
+        if test_table is None:
+            try:
+                test_table = TestCropTable.load(DEFAULT_TABLE_PATH)
+            except FileNotFoundError:
+                raise Exception('Cannot write submission because no test table was written at {}\n'
+                                'Probably predict_on_test param was set to False, thus no prediction has been '
+                                'made on test'.format(DEFAULT_TABLE_PATH))
 
-        for img_path in tqdm(os.listdir(os.path.join('datasets', 'kaggle', 'testing', 'images'))):
+        # Set the path to the submission
+        path_to_submission = os.path.join('datasets', 'submission.csv')
 
-            img_id = img_path.split(os.sep)[-1].split('.')[0]
+        # The test table holds only the pages which were not journaled when the classification started
+        with SubmissionJournal(self.__journal_path).load() as journal:
+            self.__log.info('Classifying {} images with characters ({} already journaled)...'
+                            .format(len(test_table), len(journal.get_entries())))
+            self.__write_img_with_chars(test_table=test_table,
+                                        predictions_gen=predictions_gen,
+                                        journal=journal)
 
-            if img_id not in submitted_images:
-                # Gather the data for the submission of the empty image
-                img_submission = pd.DataFrame(data={'image_id': img_id,
-                                                    'labels': ''},
-                                              columns=['image_id', 'labels'],
-                                              index=[0])
+        self.__write_submission_csv(journal.get_entries(), path_to_submission)
 
-                # Write the submission to csv
-                img_submission.to_csv(path_to_submission, mode='a', header=False)
+        # The submission is complete, the next one starts from scratch
+        journal.reset()
 
-    @staticmethod
-    def __fetch_images_data(path_to_submission, test_list):
+    def __write_submission_csv(self, submission: Dict[str, str], path_to_submission: str):
+        """
+        Writes the submission csv from the labels of the images, adding the images with no characters
 
-        # Delete the previous submission
-        if os.path.isfile(path_to_submission):
-            partial_sub = pd.read_csv(path_to_submission, usecols=['image_id', 'labels'])
+        :param submission: the labels of the images with characters, by image id
+        :param path_to_submission: the path to the submission csv
+        """
 
-            # Start iterating through the images from the last image inserted in the partial submission
-            images_data = [img_data for _, img_data in islice(test_list.iterrows(), len(partial_sub.index) - 1, None)]
+        # Write the header
+        pd.DataFrame(columns=['image_id', 'labels']).to_csv(path_to_submission)
 
-            # Remove last row (since it may be partial)
-            partial_sub.drop(partial_sub.tail(1).index, inplace=True)
-            partial_sub.to_csv(path_to_submission)
+        with SubmissionWriter(path_to_submission) as writer:
+            self.__log.info('Writing images with characters...')
+            for img_id, labels in submission.items():
+                writer.write_row(img_id, labels)
 
-        else:
-            # Start iterating through the images from the beginning
-            images_data = [img_data for _, img_data in test_list.iterrows()]
+            self.__log.info('Writing images with no characters...')
+            self.__write_img_with_no_chars(writer)
 
-            # Write the header
-            pd.DataFrame(columns=['image_id', 'labels']).to_csv(path_to_submission)
+        self.__log.info('Written submission data at {}'.format(path_to_submission))
 
-        return images_data
+    def write_pages(self,
+                    classified_pages: Iterable[Tuple[str, np.ndarray, np.ndarray]],
+                    write_to_disk: bool = True) -> Dict[str, str]:
+        """
+        Builds the submission from a stream of classified pages, keeping the labels in memory
 
-    def write(self, predictions_gen: Generator):
+        :param classified_pages: an iterable of (page path, boxes as rows [ymin, xmin, ymax, xmax], class scores)
+        :param write_to_disk: whether to write the submission csv, the only file written
+        :return: the labels of each predicted image, by image id
         """
-        Writes a submission csv file in the format:
-        - names of columns : image_id, labels
-        - example of row   : image_id, {label X Y} {...}
-        :param predictions_gen: a list of class predictions for the cropped characters
+
+        return self.write_labels(self.format_pages(classified_pages), write_to_disk=write_to_disk)
+
+    def format_pages(self, classified_pages: Iterable[Tuple[str, np.ndarray, np.ndarray]]) \
+            -> Generator[Tuple[str, str], None, None]:
         """
+        Formats the labels of a stream of classified pages
 
-        self.__log.info('Writing submission data...')
+        :param classified_pages: an iterable of (page path, boxes as rows [ymin, xmin, ymax, xmax], class scores)
+        :return: a generator of (image id, labels as a string 'label X Y label X Y ...')
+        """
 
-        # Read the test data from csv file
-        path_to_test_list = os.path.join('datasets', 'test_list.csv')
-        try:
-            test_list = pd.read_csv(path_to_test_list, usecols=['original_image', 'cropped_images', 'bboxes'])
-        except FileNotFoundError:
-            raise Exception('Cannot write submission because non test list was written at {}\n'
-                            'Probably predict_on_test param was set to False, thus no prediction has been made on test'
-                            .format(path_to_test_list))
+        for img_path, boxes, scores in classified_pages:
+            yield img_path.split(os.sep)[-1].split('.')[0], self.format_page(boxes, scores)
 
-        # Set the path to the submission
-        path_to_submission = os.path.join('datasets', 'submission.csv')
+    def format_page(self, boxes: np.ndarray, scores: np.ndarray) -> str:
+        """
+        Formats the labels of a classified page
 
-        # Fetch the data of the images
-        images_data = self.__fetch_images_data(path_to_submission, test_list)
+        :param boxes: the boxes of the characters, as rows [ymin, xmin, ymax, xmax]
+        :param scores: the class scores of the characters (N, n classes)
+        :return: the labels as a string 'label X Y label X Y ...', empty if the page has no characters
+        """
 
-        self.__log.info('Writing images with characters...')
-        self.__write_img_with_chars(images_data=images_data,
-                                    predictions_gen=predictions_gen,
-                                    path_to_submission=path_to_submission)
+        if len(scores) == 0:
+            return ''
 
-        self.__log.info('Writing images with no characters...')
-        self.__write_img_with_no_chars(path_to_submission)
+        x_centers, y_centers = self.__get_center_coords(boxes)
 
-        self.__log.info('Written submission data at {}'.format(path_to_submission))
+        return self.__format_labels(self.__get_class(scores), x_centers, y_centers)
+
+    def write_labels(self, labelled_pages: Iterable[Tuple[str, str]], write_to_disk: bool = True) -> Dict[str, str]:
+        """
+        Builds the submission from a stream of formatted labels, keeping them in memory
+
+        :param labelled_pages: an iterable of (image id, labels as a string 'label X Y label X Y ...')
+        :param write_to_disk: whether to write the submission csv, the only file written
+        :return: the labels of each predicted image, by image id
+        """
+
+        self.__log.info('Building submission data in memory...')
+
+        submission: Dict[str, str] = OrderedDict(tqdm(labelled_pages))
+
+        if write_to_disk:
+            self.__write_submission_csv(submission, os.path.join('datasets', 'submission.csv'))
+
+        return submission
@@ -4,6 +4,7 @@ import pandas as pd
 import regex as re
 
 from networks.classes.centernet.utils.BBoxesVisualizer import BBoxesVisualizer
+from networks.classes.centernet.utils.TestCropTable import DEFAULT_TABLE_PATH, TestCropTable
 
 
 class Visualizer:
@@ -25,15 +26,17 @@ class Visualizer:
                 'Probably predict_on_test param was set to False, thus no submission has been written'
                     .format(path_to_submission))
 
-        # Read the test data from csv file
-        path_to_test_list = os.path.join('datasets', 'test_list.csv')
+        # Read the test data table
         try:
-            test_list = pd.read_csv(path_to_test_list, usecols=['original_image', 'cropped_images', 'bboxes'])
+            test_table = TestCropTable.load(DEFAULT_TABLE_PATH)
         except FileNotFoundError:
             raise Exception(
-                'Cannot fetch data for visualization because no submission was written at {}\n'
+                'Cannot fetch data for visualization because no test table was written at {}\n'
                 'Probably predict_on_test param was set to False, thus no prediction has been made on test'
-                    .format(path_to_test_list))
+                    .format(DEFAULT_TABLE_PATH))
+
+        # Map the id of each page to its index in the table
+        page_indices = {str(page_id): page_idx for page_idx, page_id in enumerate(test_table.get_page_ids())}
 
         # Initialize a bboxes visualizer object to print bboxes on images
         bbox_visualizer = BBoxesVisualizer(path_to_images=os.path.join('datasets', 'kaggle', 'testing', 'images'))
@@ -41,27 +44,27 @@ class Visualizer:
         # i counts the number of images that can be visualized
         i = 0
 
-        submission_rows = [r for _, r in submission.iterrows()]
-        test_data_rows = [r for _, r in test_list.iterrows()]
-
         # Iterate over the images
-        for sub_data, test_data in zip(submission_rows, test_data_rows):
+        for _, sub_data in submission.iterrows():
 
             if i == max_visualizations:
                 break
 
+            # Skip the images which are not in the table (e.g. images with no characters)
+            page_idx = page_indices.get(str(sub_data['image_id']))
+            if page_idx is None:
+                continue
+
             classes = [label.strip().split(' ')[0] for label in re.findall(r"(?:\s?\S*\s){2}\S*", sub_data['labels'])]
-            bboxes = test_data['bboxes'].split(' ')
+            bboxes = test_table.get_page_boxes(page_idx).tolist()
 
             # Iterate over the predicted classes and corresponding bboxes
             labels = []
-            for char_class, bbox in zip(classes, bboxes):
-                ymin, xmin, ymax, xmax = bbox.split(':')
-
-                xmin = round(float(xmin))
-                ymin = round(float(ymin))
-                xmax = round(float(xmax))
-                ymax = round(float(ymax))
+            for char_class, (ymin, xmin, ymax, xmax) in zip(classes, bboxes):
+                xmin = round(xmin)
+                ymin = round(ymin)
+                xmax = round(xmax)
+                ymax = round(ymax)
 
                 labels.append([char_class,
                                xmin,
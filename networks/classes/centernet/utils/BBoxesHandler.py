@@ -1,5 +1,5 @@
 from statistics import mean
-from typing import Dict, Tuple
+from typing import Callable, Dict, Tuple, Generator, Iterable
 from typing import List
 
 import cv2
@@ -10,15 +10,46 @@ from PIL import ImageDraw
 from tqdm import tqdm
 from tensorflow.python.keras.models import Model
 
+from networks.classes.centernet.utils.ImageSizeIndex import DEFAULT_INDEX_PATH, get_image_size_index
+from networks.classes.centernet.utils.NMSEngine import NMSEngine
+
 
 class BBoxesHandler:
 
-    def __init__(self, out_w: int = 128, out_h: int = 128, in_w: int = 512, in_h: int = 512):
+    def __init__(self,
+                 out_w: int = 128,
+                 out_h: int = 128,
+                 in_w: int = 512,
+                 in_h: int = 512,
+                 nms_backend: str = 'auto',
+                 decode_mode: str = 'dense',
+                 peaks_top_k: int = 1000,
+                 image_index_path: str = DEFAULT_INDEX_PATH):
+        """
+        :param nms_backend: the backend of the non-maximum suppression (see NMSEngine)
+        :param decode_mode: how the candidate centers are taken from the heatmap:
+            - dense: all the cells above the score threshold
+            - peaks: only the local maxima of the heatmap (3x3 max-pool), at most peaks_top_k per image
+        :param peaks_top_k: the maximum number of peaks per image in 'peaks' mode
+        :param image_index_path: the path to the index of the image sizes (see ImageSizeIndex)
+        """
+
+        if decode_mode not in ['dense', 'peaks']:
+            raise ValueError("Decode mode {} is not valid. Possibilities are 'dense' or 'peaks'."
+                             .format(decode_mode))
+
         self.__pred_out_w = out_w
         self.__pred_out_h = out_h
         self.__pred_in_w = in_w
         self.__pred_in_h = in_h
 
+        self.__nms_engine = NMSEngine(backend=nms_backend)
+        self.__decode_mode = decode_mode
+        self.__peaks_top_k = peaks_top_k
+
+        # Sizes of the original images, read from the headers to rescale the boxes
+        self.__image_sizes = get_image_size_index(image_index_path)
+
     def __show_train_standard_bboxes(self, true_bboxes, predicted_bboxes, img, heatmap):
         # Draw true and predicted bboxes
         img = self.__draw_rectangle(predicted_bboxes, img, "red")
@@ -52,20 +83,18 @@ class BBoxesHandler:
         all_boxes = {}
         iou_scores = []
 
+        # List of bidimensional np.ndarray. Each row is <score> <ymin> <xmin> <ymax> <xmax>
+        all_bbox_and_score = self.__get_batch_bboxes(predictions, score_thresh=0.3, iou_thresh=0.4)
+
         for i in tqdm(np.arange(0, predictions.shape[0])):
 
             image_path = annotation_list[i][0]
-            img = Image.open(image_path).convert("RGB")
 
-            # Bidimensional np.ndarray. Each row is <score> <ymin> <xmin> <ymax> <xmax>
-            bbox_and_score = self.__get_img_bboxes(predicts=predictions[i],
-                                                   category_n=1,
-                                                   score_thresh=0.3,
-                                                   iou_thresh=0.4)
+            bbox_and_score = all_bbox_and_score[i]
 
             if len(bbox_and_score) > 0:
                 # Get width and height of the image
-                print_w, print_h = img.size
+                print_w, print_h = self.__image_sizes.get_size(image_path)
 
                 # Resize predicted box to original size. Leave unchanged score
                 bbox_and_score = bbox_and_score * [1,
@@ -88,11 +117,13 @@ class BBoxesHandler:
                 if show:
                     self.__show_train_standard_bboxes(true_bboxes=true_bboxes,
                                                       predicted_bboxes=predicted_bboxes,
-                                                      img=img,
+                                                      img=Image.open(image_path).convert("RGB"),
                                                       heatmap=predictions[i, :, :, 0])
             else:
                 continue
 
+        self.__image_sizes.save()
+
         return all_boxes, mean(iou_scores)
 
     def get_test_standard_bboxes(self,
@@ -100,83 +131,250 @@ class BBoxesHandler:
                                  test_images_path: List[str] = None,
                                  show: bool = False) -> Dict[str, np.ndarray]:
 
-        all_boxes = {}
+        return dict(self.iter_test_standard_bboxes([predictions], test_images_path, show))
 
-        for i in tqdm(np.arange(0, predictions.shape[0])):
+    def __rescale_bboxes(self, bbox_and_score: np.ndarray, print_w: int, print_h: int) -> np.ndarray:
+        """
+        Resizes the boxes predicted on the output map to the original size of the page. Leaves unchanged the score
+        """
 
-            image_path = test_images_path[i]
-            img = Image.open(image_path).convert("RGB")
+        return bbox_and_score * [1,
+                                 print_h / self.__pred_out_h,
+                                 print_w / self.__pred_out_w,
+                                 print_h / self.__pred_out_h,
+                                 print_w / self.__pred_out_w]
+
+    def decode_page_bboxes(self, predictions: np.ndarray, page_sizes: List[Tuple[int, int]]) -> List[np.ndarray]:
+        """
+        Decodes the boxes of a batch of pages which are not read from disk (e.g. received by a service)
+
+        :param predictions: the prediction batch (Bx128x128x5)
+        :param page_sizes: the (width, height) of each page of the batch
+        :return: for each page, np.ndarray([score, ymin, xmin, ymax, xmax]) in page coordinates
+        """
 
-            # Bidimensional np.ndarray. Each row is (score, ymin, xmin, ymax, xmax)
+        all_bbox_and_score = self.__get_batch_bboxes(predictions, score_thresh=0.3, iou_thresh=0.4)
+
+        return [self.__rescale_bboxes(bbox_and_score, print_w, print_h)
+                for bbox_and_score, (print_w, print_h) in zip(all_bbox_and_score, page_sizes)]
+
+    def iter_test_standard_bboxes(self,
+                                  predictions_gen: Iterable[np.ndarray],
+                                  test_images_path: List[str] = None,
+                                  show: bool = False) -> Generator[Tuple[str, np.ndarray], None, None]:
+        """
+        Streaming version of get_test_standard_bboxes. Decodes the boxes batch by batch, so that only
+        one batch of predictions at a time must be kept in memory.
+
+        :param predictions_gen: an iterable of prediction batches (Bx128x128x5), in the same order of
+            test_images_path
+        :param test_images_path: the paths to the test images
+        :param show: whether to show the predicted boxes
+        :return: a generator of (image_path, np.ndarray([score, ymin, xmin, ymax, xmax])) pairs
+        """
+
+        i = 0
+        progress_bar = tqdm(total=len(test_images_path))
+
+        for predictions in predictions_gen:
+
+            # List of bidimensional np.ndarray. Each row is (score, ymin, xmin, ymax, xmax)
             # We removed category (from the original implementation)
-            bbox_and_score = self.__get_img_bboxes(predicts=predictions[i],
-                                                   category_n=1,
-                                                   score_thresh=0.3,
-                                                   iou_thresh=0.4)
+            all_bbox_and_score = self.__get_batch_bboxes(predictions, score_thresh=0.3, iou_thresh=0.4)
 
-            if len(bbox_and_score) >= 0:
+            for j, bbox_and_score in enumerate(all_bbox_and_score):
 
-                print_w, print_h = img.size
+                image_path = test_images_path[i]
 
-                # Resize predicted box to original size. Leave unchanged score
-                bbox_and_score = bbox_and_score * [1,
-                                                   print_h / self.__pred_out_h,
-                                                   print_w / self.__pred_out_w,
-                                                   print_h / self.__pred_out_h,
-                                                   print_w / self.__pred_out_w]
+                print_w, print_h = self.__image_sizes.get_size(image_path)
 
-                # Produce a dictionary { "image_path": np.ndarray([score, ymin, xmin, ymax, xmax]) }
-                all_boxes[image_path] = bbox_and_score
+                # Resize predicted box to original size. Leave unchanged score
+                bbox_and_score = self.__rescale_bboxes(bbox_and_score, print_w, print_h)
 
                 if show:
                     self.__show_test_standard_bboxes(predicted_bboxes=bbox_and_score[:, 1:],
-                                                     img=img,
-                                                     heatmap=predictions[i, :, :, 0])
-            else:
+                                                     img=Image.open(image_path).convert("RGB"),
+                                                     heatmap=predictions[j, :, :, 0])
+
+                i += 1
+                progress_bar.update(1)
+
+                yield image_path, bbox_and_score
+
+        progress_bar.close()
+        self.__image_sizes.save()
+
+    @staticmethod
+    def __get_tile_offsets(img_w: int, img_h: int, n_tiles: int) -> Tuple[List[Tuple[int, int, int, int]], int, int]:
+        """
+        Computes the offsets of the n_tiles x n_tiles overlapping tiles of an image
+
+        :param img_w: the width of the image
+        :param img_h: the height of the image
+        :param n_tiles: number of tiles to split each side of the image
+        :return: the list of (top, bottom, left, right) offsets, in row-major order, and the tile size
+        """
+
+        k_h = (4 * img_h) // (3 * n_tiles + 1)
+        k_w = (4 * img_w) // (3 * n_tiles + 1)
+
+        left_offsets = [int(i * 0.75 * k_w) for i in range(0, n_tiles)]
+        right_offsets = [(img_w - lo) for lo in reversed(left_offsets)]
+        top_offsets = [int(i * 0.75 * k_h) for i in range(0, n_tiles)]
+        bottom_offsets = [(img_h - to) for to in reversed(top_offsets)]
+
+        offsets = [(top_offset, bottom_offset, left_offset, right_offset)
+                   for top_offset, bottom_offset in zip(top_offsets, bottom_offsets)
+                   for left_offset, right_offset in zip(left_offsets, right_offsets)]
+
+        return offsets, k_w, k_h
+
+    def __decode_tiles(self, tiles: List[np.ndarray], tiles_info: List[Tuple], model: Model,
+                       pages_boxes: Dict[int, List[np.ndarray]], pending_tiles: Dict[int, int]):
+        """
+        Runs a single forward pass over a batch of tiles, possibly coming from different pages, and
+        scatters the decoded boxes back to their page, in page coordinates
+
+        :param tiles: the uint8 tiles, already resized to the input size of the model
+        :param tiles_info: for each tile, (page index, top offset, left offset, tile width, tile height)
+        :param model: a trained keras model
+        :param pages_boxes: the boxes found so far for each page, updated in place
+        :param pending_tiles: the number of tiles still to be decoded for each page, updated in place
+        """
+
+        batch = np.array(tiles, dtype=np.float32)
+        batch /= 255
+
+        # Output shape is (len(tiles), 128, 128, 5)
+        predictions = model.predict(batch, batch_size=len(tiles))
+
+        # Boxes have format: <score> <top> <left> <bot> <right>
+        all_boxes = self.__get_batch_bboxes(predictions, score_thresh=0.3, iou_thresh=0.4)
+
+        for boxes, (page_idx, top_offset, left_offset, k_w, k_h) in zip(all_boxes, tiles_info):
+            pending_tiles[page_idx] -= 1
+
+            if len(boxes) == 0:
                 continue
 
-        return all_boxes
+            pages_boxes[page_idx].append(self.__tile_to_page_bboxes(boxes, top_offset, left_offset, k_w, k_h))
+
+    def __tile_to_page_bboxes(self, boxes: np.ndarray, top_offset: int, left_offset: int, k_w: int, k_h: int) \
+            -> np.ndarray:
+        """
+        Reshapes the boxes decoded from a tile and adds the offset of the tile, to get page coordinates
+        """
+
+        return boxes * [1,
+                        k_h / self.__pred_out_h,
+                        k_w / self.__pred_out_w,
+                        k_h / self.__pred_out_h,
+                        k_w / self.__pred_out_w] \
+               + np.array([0, top_offset, left_offset, top_offset, left_offset])
+
+    def decode_tiled_page_bboxes(self,
+                                 img: np.ndarray,
+                                 predict_fn: Callable[[np.ndarray], np.ndarray],
+                                 n_tiles: int) -> np.ndarray:
+        """
+        Tiled detection of a page which is not read from disk (e.g. received by a service). All the tiles
+        of the page are predicted by a single call, so that a batching scheduler can coalesce them with the
+        tiles of other pages
+
+        :param img: the RGB page as a uint8 array of shape (height, width, 3)
+        :param predict_fn: the function predicting a batch of tiles, e.g. the predict_on_batch of the model
+        :param n_tiles: number of tiles to split each side of the image
+        :return: np.ndarray([score, ymin, xmin, ymax, xmax]) in page coordinates, with shape (0, 5) if no
+            box is found
+        """
 
-    def __get_all_tiled_bboxes(self, offsets, k, pic, model):
+        img_h, img_w = img.shape[:2]
+        offsets, k_w, k_h = self.__get_tile_offsets(img_w, img_h, n_tiles)
 
-        top_offsets, bottom_offsets, left_offsets, right_offsets = offsets
-        k_w, k_h = k
+        tiles = np.array([cv2.resize(img[top_offset:bottom_offset, left_offset:right_offset, :],
+                                     (self.__pred_in_h, self.__pred_in_w))
+                          for top_offset, bottom_offset, left_offset, right_offset in offsets], dtype=np.float32)
+        tiles /= 255
 
-        all_tile_boxes = np.array([])
+        all_boxes = self.__get_batch_bboxes(np.asarray(predict_fn(tiles)), score_thresh=0.3, iou_thresh=0.4)
 
-        for top_offset, bottom_offset in zip(top_offsets, bottom_offsets):
-            for left_offset, right_offset in zip(left_offsets, right_offsets):
-                tile = cv2.resize(pic[top_offset:bottom_offset, left_offset:right_offset, :],
-                                  (self.__pred_in_h, self.__pred_in_w))
+        tile_boxes = [self.__tile_to_page_bboxes(boxes, top_offset, left_offset, k_w, k_h)
+                      for boxes, (top_offset, _, left_offset, _) in zip(all_boxes, offsets) if len(boxes) > 0]
 
-                tile = np.array(tile, dtype=np.float32)
-                tile /= 255
+        if not tile_boxes:
+            return np.zeros((0, 5))
 
-                # Output shape is (1, 128, 128, 5)
-                predictions = model.predict(tile.reshape((1, self.__pred_in_h, self.__pred_in_w, 3)),
-                                            batch_size=1,
-                                            steps=1)
+        all_tile_boxes = self.__merge_tile_boxes(tile_boxes)
 
-                # Boxes have format: <category> <score> <top> <left> <bot> <right>
-                boxes = self.__get_img_bboxes(predictions, 1, 0.3, 0.4)
+        return self.__get_nms_bboxes(all_tile_boxes[:, 0],
+                                     all_tile_boxes[:, 1],
+                                     all_tile_boxes[:, 2],
+                                     all_tile_boxes[:, 3],
+                                     all_tile_boxes[:, 4],
+                                     iou_thresh=0.4,
+                                     tiled_mode=True)
 
-                if len(boxes) == 0:
-                    continue
+    def __get_all_tiled_bboxes(self, image_paths: List[str], model: Model, n_tiles: int, batch_size: int) \
+            -> Generator[np.ndarray, None, None]:
+        """
+        Tiled inference engine. Cuts the tiles of consecutive pages and packs them into full batches
+        for the model, so that a forward pass is not limited to the tiles of a single page.
 
-                # Reshape and add the offset
-                boxes = boxes * [1,
-                                 k_h / self.__pred_out_h,
-                                 k_w / self.__pred_out_w,
-                                 k_h / self.__pred_out_h,
-                                 k_w / self.__pred_out_w] \
-                        + np.array([0, top_offset, left_offset, top_offset, left_offset])
+        :param image_paths: the paths to the pages
+        :param model: a trained keras model
+        :param n_tiles: number of tiles to split each side of the image
+        :param batch_size: the number of tiles in each forward pass
+        :return: a generator of the boxes of all the tiles of each page, in the same order of image_paths.
+            Each row is <score> <top> <left> <bot> <right>, in page coordinates
+        """
 
-                if all_tile_boxes.size == 0:
-                    all_tile_boxes = boxes
-                else:
-                    all_tile_boxes = np.concatenate((all_tile_boxes, boxes), axis=0)
+        tiles, tiles_info = [], []
+        pages_boxes: Dict[int, List[np.ndarray]] = {}
+        pending_tiles: Dict[int, int] = {}
+        next_page = 0
 
-        return all_tile_boxes
+        for page_idx, image_path in enumerate(image_paths):
+
+            # Process the single image
+            pic = Image.open(image_path)
+
+            img_w, img_h = pic.size
+            offsets, k_w, k_h = self.__get_tile_offsets(img_w, img_h, n_tiles)
+
+            pic = np.asarray(pic.convert('RGB'), dtype=np.uint8)
+
+            pages_boxes[page_idx] = []
+            pending_tiles[page_idx] = len(offsets)
+
+            for top_offset, bottom_offset, left_offset, right_offset in offsets:
+                tiles.append(cv2.resize(pic[top_offset:bottom_offset, left_offset:right_offset, :],
+                                        (self.__pred_in_h, self.__pred_in_w)))
+                tiles_info.append((page_idx, top_offset, left_offset, k_w, k_h))
+
+                if len(tiles) == batch_size:
+                    self.__decode_tiles(tiles, tiles_info, model, pages_boxes, pending_tiles)
+                    tiles, tiles_info = [], []
+
+            # Release the pages whose tiles have all been decoded
+            while next_page <= page_idx and pending_tiles[next_page] == 0:
+                yield self.__merge_tile_boxes(pages_boxes.pop(next_page))
+                del pending_tiles[next_page]
+                next_page += 1
+
+        # Decode the last incomplete batch
+        if tiles:
+            self.__decode_tiles(tiles, tiles_info, model, pages_boxes, pending_tiles)
+
+        while next_page in pages_boxes:
+            yield self.__merge_tile_boxes(pages_boxes.pop(next_page))
+            next_page += 1
+
+    @staticmethod
+    def __merge_tile_boxes(tile_boxes: List[np.ndarray]) -> np.ndarray:
+        if not tile_boxes:
+            return np.array([])
+
+        return np.concatenate(tile_boxes, axis=0)
 
     def __show_test_tiled_bboxes(self, predicted_bboxes, image_path):
 
@@ -220,7 +418,12 @@ class BBoxesHandler:
 
         return true_bboxes, predicted_bboxes
 
-    def get_train_tiled_bboxes(self, dataset: np.array, model: Model, n_tiles: int, show: bool):
+    def get_train_tiled_bboxes(self,
+                               dataset: np.array,
+                               model: Model,
+                               n_tiles: int,
+                               show: bool,
+                               batch_size: int = 1):
         """
         This functions behaves similarly to get_standard_bboxes, but it compute bboxes directly
          from each image using tiling to improve accuracy.
@@ -229,33 +432,18 @@ class BBoxesHandler:
         :param model: a trained keras model
         :param n_tiles: number of tiles t split the image
         :param show: whether to show results and scores
+        :param batch_size: the number of tiles (from one or more images) predicted in each forward pass
         :return:
         """
 
         all_boxes = {}
         iou_scores = []
 
-        for example in tqdm(dataset):
+        tiled_bboxes = self.__get_all_tiled_bboxes([example[0] for example in dataset], model, n_tiles, batch_size)
 
-            image_path = example[0]
+        for example, all_tile_boxes in tqdm(zip(dataset, tiled_bboxes), total=len(dataset)):
 
-            # Process the single image
-            pic = Image.open(image_path)
-
-            img_w, img_h = pic.size
-            k_h = (4 * img_h) // (3 * n_tiles + 1)
-            k_w = (4 * img_w) // (3 * n_tiles + 1)
-
-            left_offsets = [int(i * 0.75 * k_w) for i in range(0, n_tiles)]
-            right_offsets = [(img_w - lo) for lo in reversed(left_offsets)]
-            top_offsets = [int(i * 0.75 * k_h) for i in range(0, n_tiles)]
-            bottom_offsets = [(img_h - to) for to in reversed(top_offsets)]
-
-            all_tile_boxes = self.__get_all_tiled_bboxes(
-                offsets=(top_offsets, bottom_offsets, left_offsets, right_offsets),
-                k=(k_w, k_h),
-                pic=np.asarray(pic.convert('RGB'), dtype=np.uint8),
-                model=model)
+            image_path = example[0]
 
             if all_tile_boxes.size == 0:
                 continue
@@ -293,41 +481,42 @@ class BBoxesHandler:
         # Return the dict and the mean of the IoU scores
         return all_boxes, mean(iou_scores)
 
-    def get_test_tiled_bboxes(self, dataset: np.array, model: Model, n_tiles: int, show: bool):
+    def get_test_tiled_bboxes(self,
+                              dataset: np.array,
+                              model: Model,
+                              n_tiles: int,
+                              show: bool,
+                              batch_size: int = 1):
         """
         This functions behaves similarly to get_standard_bboxes, but it compute bboxes directly
          from each image using tiling to improve accuracy.
 
-        :param dataset: the dataset in the format [[image path, annotations, height split, width split]]
+        :param dataset: the list of test images file paths
         :param model: a trained keras model
         :param n_tiles: number of tiles t split the image
         :param show: whether to show results and scores
+        :param batch_size: the number of tiles (from one or more images) predicted in each forward pass
         :return:
         """
 
-        all_boxes = {}
-
-        for example in tqdm(dataset):
-
-            image_path = example
-
-            # Process the single image
-            pic = Image.open(image_path)
+        # Return the dict
+        return dict(self.iter_test_tiled_bboxes(dataset, model, n_tiles, show, batch_size))
+
+    def iter_test_tiled_bboxes(self,
+                               dataset: List[str],
+                               model: Model,
+                               n_tiles: int,
+                               show: bool,
+                               batch_size: int = 1) -> Generator[Tuple[str, np.ndarray], None, None]:
+        """
+        Streaming version of get_test_tiled_bboxes. Images with no boxes are skipped.
 
-            img_w, img_h = pic.size
-            k_h = (4 * img_h) // (3 * n_tiles + 1)
-            k_w = (4 * img_w) // (3 * n_tiles + 1)
+        :return: a generator of (image_path, np.ndarray([score, ymin, xmin, ymax, xmax])) pairs
+        """
 
-            left_offsets = [int(i * 0.75 * k_w) for i in range(0, n_tiles)]
-            right_offsets = [(img_w - lo) for lo in reversed(left_offsets)]
-            top_offsets = [int(i * 0.75 * k_h) for i in range(0, n_tiles)]
-            bottom_offsets = [(img_h - to) for to in reversed(top_offsets)]
+        tiled_bboxes = self.__get_all_tiled_bboxes(dataset, model, n_tiles, batch_size)
 
-            all_tile_boxes = self.__get_all_tiled_bboxes(
-                offsets=(top_offsets, bottom_offsets, left_offsets, right_offsets),
-                k=(k_w, k_h),
-                pic=np.asarray(pic.convert('RGB'), dtype=np.uint8),
-                model=model)
+        for image_path, all_tile_boxes in tqdm(zip(dataset, tiled_bboxes), total=len(dataset)):
 
             if all_tile_boxes.size == 0:
                 continue
@@ -348,14 +537,82 @@ class BBoxesHandler:
                 print('No boxes found')
                 continue
 
-            # Produce a dictionary { "image_path": np.ndarray([score, ymin, xmin, ymax, xmax]) }
-            all_boxes[image_path] = bbox_and_score
-
             if show:
                 self.__show_test_tiled_bboxes(predicted_bboxes=bbox_and_score[:, 1:], image_path=image_path)
 
-        # Return the dict
-        return all_boxes
+            yield image_path, bbox_and_score
+
+    def __get_batch_bboxes(self, predictions, score_thresh, iou_thresh) -> List[np.ndarray]:
+        """
+        Given the predictions for a batch of images, returns the non-maximum suppressed bboxes of
+        each image, according to the decode mode
+
+        :param predictions: the predictions of the model (Nx128x128x5)
+        :param score_thresh: the minimum confidence threshold for the centers
+        :param iou_thresh: the minimum IoU threshold for non-maximum suppression
+        :return: a list with an array of bboxes for each image, each row is <score> <ymin> <xmin> <ymax> <xmax>
+        """
+
+        if self.__decode_mode == 'dense':
+            return [self.__get_img_bboxes(predicts=predicts,
+                                          category_n=1,
+                                          score_thresh=score_thresh,
+                                          iou_thresh=iou_thresh)
+                    for predicts in predictions]
+
+        all_bbox_and_score = []
+
+        for score, y_c, x_c, height, width in self.__get_peaks(predictions, score_thresh):
+            bbox_and_score = self.__get_nms_bboxes(score, y_c, x_c, height, width, iou_thresh)
+            all_bbox_and_score.append(self.__remove_duplicated_bboxes(bbox_and_score))
+
+        return all_bbox_and_score
+
+    def __get_peaks(self, predictions, score_thresh) -> List[Tuple[np.ndarray, ...]]:
+        """
+        Extracts the local maxima of the heatmaps of a batch of images, as in the standard CenterNet
+        decoding. A cell is a peak if it is the maximum of its 3x3 neighbourhood and its score is
+        above the threshold. Only the top-k peaks of each image are kept
+
+        :param predictions: the predictions of the model (Nx128x128x5)
+        :param score_thresh: the minimum confidence threshold for the peaks
+        :return: a list with a tuple (score, y_c, x_c, height, width) of flatten arrays for each image
+        """
+
+        n_images = predictions.shape[0]
+        heatmap = predictions[..., 0]
+
+        # 3x3 max-pool with stride 1 and same padding
+        padded = np.pad(heatmap, ((0, 0), (1, 1), (1, 1)), mode='constant', constant_values=-np.inf)
+        pooled = heatmap.copy()
+        for dy in range(3):
+            for dx in range(3):
+                pooled = np.maximum(pooled, padded[:, dy:dy + self.__pred_out_h, dx:dx + self.__pred_out_w])
+
+        peaks = (heatmap == pooled) * (heatmap > score_thresh)
+        scores = np.where(peaks, heatmap, -np.inf).reshape(n_images, -1)
+
+        # Take the top-k peaks of each image (in no particular order, NMS sorts them afterwards)
+        top_k = min(self.__peaks_top_k, scores.shape[1])
+        top_idx = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        is_peak = np.take_along_axis(scores, top_idx, axis=1) > -np.inf
+
+        # Gather the predictions of the peaks of all images at once
+        ys, xs = np.divmod(top_idx, self.__pred_out_w)
+        peak_predictions = predictions[np.arange(n_images).reshape(-1, 1), ys, xs]
+
+        score = peak_predictions[..., 0]
+        y_c = peak_predictions[..., 1] + ys
+        x_c = peak_predictions[..., 2] + xs
+        height = peak_predictions[..., 3] * self.__pred_out_h
+        width = peak_predictions[..., 4] * self.__pred_out_w
+
+        return [(score[i][is_peak[i]],
+                 y_c[i][is_peak[i]],
+                 x_c[i][is_peak[i]],
+                 height[i][is_peak[i]],
+                 width[i][is_peak[i]])
+                for i in range(n_images)]
 
     def __get_img_bboxes(self, predicts, category_n, score_thresh, iou_thresh) -> np.ndarray:
         """
@@ -398,6 +655,10 @@ class BBoxesHandler:
             else:
                 bbox_and_score = np.concatenate((bbox_and_score, bbox_and_score), axis=0)
 
+        return self.__remove_duplicated_bboxes(bbox_and_score)
+
+    @staticmethod
+    def __remove_duplicated_bboxes(bbox_and_score) -> np.ndarray:
         # Get indexes to sort by score in descending order
         score_sort = np.argsort(bbox_and_score[:, 0])[::-1]
         bbox_and_score = bbox_and_score[score_sort]
@@ -433,48 +694,6 @@ class BBoxesHandler:
 
         return xmin, xmax, ymin, ymax, score
 
-    @staticmethod
-    def __nms(xmin, xmax, ymin, ymax, iou_thresh):
-        box_idx = np.arange(len(ymin))
-        boxes_to_keep = []
-
-        # Box area of score-sorted boxes
-        area = ((ymax - ymin) * (xmax - xmin))
-
-        while len(box_idx) > 0:
-            # Insert the index of the best bbox in the list of boxes to keep
-            boxes_to_keep.append(box_idx[0])
-
-            # y2 - y1 is an array with the distance (element-wise) between boxes on y coord
-            y1 = np.maximum(ymin[0], ymin)
-            x1 = np.maximum(xmin[0], xmin)
-            y2 = np.minimum(ymax[0], ymax)
-            x2 = np.minimum(xmax[0], xmax)
-
-            # Bbox-wise area
-            cross_h = np.maximum(0, y2 - y1)
-            cross_w = np.maximum(0, x2 - x1)
-
-            # Mask to keep just the boxes which overlap with best box for less than threshold
-            max_over_lap = (((cross_h * cross_w) / area[0]) < iou_thresh)
-
-            # Mask to keep just the boxes with enough out_lap surface
-            min_out_lap = (((area - (cross_h * cross_w)) / area) > (1 - iou_thresh))
-
-            still_alive = max_over_lap * min_out_lap
-
-            assert np.sum(still_alive) != len(box_idx), \
-                'An error occurred: {} {}'.format(np.max((cross_h * cross_w)), area[0])
-
-            ymin = ymin[still_alive]
-            xmin = xmin[still_alive]
-            ymax = ymax[still_alive]
-            xmax = xmax[still_alive]
-            area = area[still_alive]
-            box_idx = box_idx[still_alive]
-
-        return boxes_to_keep
-
     def __get_nms_bboxes(self, score, y_c, x_c, height, width, iou_thresh, tiled_mode=False) -> np.array:
         """
         Performs the non-maximum suppression on the given bboxes
@@ -516,7 +735,7 @@ class BBoxesHandler:
                                axis=1)
 
         # Return non-maximum-suppressed boxes
-        return boxes[self.__nms(xmin, xmax, ymin, ymax, iou_thresh)]
+        return boxes[self.__nms_engine.suppress(xmin, xmax, ymin, ymax, iou_thresh)]
 
     @staticmethod
     def __draw_rectangle(bbox_and_score: np.array, img: Image, color: str):
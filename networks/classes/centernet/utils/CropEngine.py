@@ -0,0 +1,144 @@
+import os
+from typing import Generator, Iterable, List, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from networks.classes.centernet.utils.OrderedProcessPool import OrderedProcessPool
+
+
+class CropEngine:
+    """
+    Extracts the characters of a page as fixed-size arrays, decoding the page only once.
+
+    The boxes are cut with the same rules of PIL Image.crop (coordinates rounded to the nearest
+    integer, zero padding outside of the page) and then resized to crop_height x crop_width.
+
+    Sequences of pages can be cropped by a pool of processes, one page per task, with the results
+    returned in the order of the pages.
+    """
+
+    def __init__(self,
+                 crop_height: int = 40,
+                 crop_width: int = 40,
+                 n_workers: int = 0,
+                 max_in_flight_pages: Union[int, None] = None):
+        """
+        :param crop_height: the height of the crops
+        :param crop_width: the width of the crops
+        :param n_workers: the number of processes cropping the pages, 0 to crop in the calling process
+        :param max_in_flight_pages: the maximum number of pages cropped and not yet consumed
+        """
+
+        self.__crop_height = crop_height
+        self.__crop_width = crop_width
+        self.__pool = OrderedProcessPool(n_workers, max_in_flight_pages)
+
+    def get_crop_shape(self) -> Tuple[int, int, int]:
+        return self.__crop_height, self.__crop_width, 3
+
+    def crop_image(self, img: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        Crops and resizes all the boxes of a decoded page
+
+        :param img: the RGB page as a uint8 array of shape (height, width, 3)
+        :param boxes: the boxes as an array of rows [ymin, xmin, ymax, xmax]
+        :return: the uint8 crops, with shape (n boxes, crop height, crop width, 3)
+        """
+
+        img_h, img_w = img.shape[:2]
+        crops = np.zeros((len(boxes),) + self.get_crop_shape(), dtype=np.uint8)
+
+        if len(boxes) == 0:
+            return crops
+
+        coords = np.round(np.asarray(boxes, dtype=np.float64)[:, :4]).astype(int)
+        ymin, xmin, ymax, xmax = coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3]
+
+        # Empty boxes are grown to a single pixel, so that they can still be resized
+        ymax = np.maximum(ymax, ymin + 1)
+        xmax = np.maximum(xmax, xmin + 1)
+
+        for i in range(len(boxes)):
+            box_h, box_w = ymax[i] - ymin[i], xmax[i] - xmin[i]
+
+            top, bottom = max(ymin[i], 0), min(ymax[i], img_h)
+            left, right = max(xmin[i], 0), min(xmax[i], img_w)
+
+            if top == ymin[i] and left == xmin[i] and bottom == ymax[i] and right == xmax[i]:
+                crop = img[top:bottom, left:right]
+            else:
+                # Pad with zeros the part of the box out of the page
+                crop = np.zeros((box_h, box_w, 3), dtype=np.uint8)
+                if top < bottom and left < right:
+                    crop[top - ymin[i]:bottom - ymin[i], left - xmin[i]:right - xmin[i]] = \
+                        img[top:bottom, left:right]
+
+            crops[i] = cv2.resize(crop, (self.__crop_width, self.__crop_height), interpolation=cv2.INTER_LINEAR)
+
+        return crops
+
+    def crop_page(self, img_path: str, boxes: np.ndarray) -> np.ndarray:
+        """
+        Decodes a page and crops all its boxes
+
+        :param img_path: the path to the page
+        :param boxes: the boxes as an array of rows [ymin, xmin, ymax, xmax]
+        :return: the uint8 crops, with shape (n boxes, crop height, crop width, 3)
+        """
+
+        with Image.open(img_path) as img:
+            img = np.asarray(img.convert('RGB'), dtype=np.uint8)
+
+        return self.crop_image(img, boxes)
+
+    def crop_pages(self, pages: Iterable[Tuple[str, np.ndarray]]) -> Generator[np.ndarray, None, None]:
+        """
+        Crops a sequence of pages, one page at a time
+
+        :param pages: an iterable of (page path, boxes as rows [ymin, xmin, ymax, xmax])
+        :return: a generator of the crops of each page, in the same order of the pages
+        """
+
+        return self.__pool.map(self.crop_page, pages)
+
+    @staticmethod
+    def save_page(img_path: str, boxes: np.ndarray, img_name_path: str) -> List[str]:
+        """
+        Crops all the boxes of a page at their original size, saving a jpg file for each one
+
+        :param img_path: the path to the page
+        :param boxes: the boxes as an array of rows [ymin, xmin, ymax, xmax]
+        :param img_name_path: the prefix of the files, which are named <prefix>_<box index>.jpg
+        :return: the paths to the crops, in the order of the boxes
+        """
+
+        filepaths = []
+
+        with Image.open(img_path) as img:
+            for box_n, box in enumerate(boxes):
+                ymin, xmin, ymax, xmax = (float(c) for c in box[:4])
+
+                filepath = img_name_path + '_' + str(box_n) + '.jpg'
+                img.crop((xmin, ymin, xmax, ymax)).save(filepath)
+                filepaths.append(filepath)
+
+        return filepaths
+
+    def save_pages(self,
+                   pages: Iterable[Tuple[str, np.ndarray]],
+                   save_dir: str) -> Generator[List[str], None, None]:
+        """
+        Crops a sequence of pages to jpg files in save_dir, one page at a time
+
+        :param pages: an iterable of (page path, boxes as rows [ymin, xmin, ymax, xmax])
+        :param save_dir: the directory where to save the crops
+        :return: a generator of the paths to the crops of each page, in the same order of the pages
+        """
+
+        # Get image name without extension, e.g. dataset/img.jpg -> img
+        tasks = ((img_path, boxes, os.path.join(save_dir, os.path.basename(img_path).split('.')[0]))
+                 for img_path, boxes in pages)
+
+        return self.__pool.map(self.save_page, tasks)
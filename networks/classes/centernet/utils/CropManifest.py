@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Union
+
+import numpy as np
+
+MANIFEST_NAME = 'crop_manifest.json'
+
+
+class CropManifest:
+    """
+    Records, for each page cropped to a folder of crop files, a hash of the page file, a hash of
+    its boxes and the paths to its crops, so that a regeneration can re-crop only the changed pages.
+
+    The hash of a page file is recomputed only when its modification time (in ns) or byte size change.
+    """
+
+    def __init__(self, save_dir: str):
+        self.__manifest_path = os.path.join(save_dir, MANIFEST_NAME)
+        self.__entries: Dict[str, Dict] = {}
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.__manifest_path)
+
+    def load(self) -> 'CropManifest':
+        """
+        Reads the manifest from disk, if any
+
+        :return: the manifest itself
+        """
+
+        if self.exists():
+            with open(self.__manifest_path) as f:
+                self.__entries = json.load(f)
+
+        return self
+
+    def save(self):
+        """
+        Writes the manifest atomically, so that an interrupted write leaves the previous one
+        """
+
+        tmp_path = self.__manifest_path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            json.dump(self.__entries, f)
+
+        os.replace(tmp_path, self.__manifest_path)
+
+    def get_pages(self) -> List[str]:
+        return list(self.__entries.keys())
+
+    def get_crops(self, img_path: str) -> List[str]:
+        return self.__entries[img_path]['crops']
+
+    def hash_page(self, img_path: str) -> str:
+        """
+        Hashes a page file, reusing the recorded hash if the file did not change since it was cropped
+
+        :param img_path: the path to the page
+        :return: the hex digest of the page file
+        """
+
+        stat = os.stat(img_path)
+        entry = self.__entries.get(img_path)
+
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry['page_hash']
+
+        sha = hashlib.sha1()
+        with open(img_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    @staticmethod
+    def hash_boxes(boxes: np.ndarray) -> str:
+        """
+        :param boxes: the boxes of a page as rows [ymin, xmin, ymax, xmax]
+        :return: the hex digest of the boxes
+        """
+
+        boxes = np.ascontiguousarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+        return hashlib.sha1(boxes.tobytes()).hexdigest()
+
+    def is_current(self, img_path: str, page_hash: str, boxes_hash: str) -> bool:
+        """
+        :return: whether the recorded crops of the page were cut from the same page file and boxes
+        """
+
+        entry = self.__entries.get(img_path)
+
+        return entry is not None and entry['page_hash'] == page_hash and entry['boxes_hash'] == boxes_hash
+
+    def update(self, img_path: str, page_hash: str, boxes_hash: str, crops: List[str]):
+        stat = os.stat(img_path)
+        self.__entries[img_path] = {
+            'page_hash': page_hash,
+            'boxes_hash': boxes_hash,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'crops': crops
+        }
+
+    def remove(self, img_path: str) -> Union[Dict, None]:
+        return self.__entries.pop(img_path, None)
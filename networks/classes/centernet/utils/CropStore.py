@@ -0,0 +1,176 @@
+import json
+import os
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from networks.classes.centernet.utils.CropEngine import CropEngine
+
+
+class CropStore:
+    """
+    Packed on-disk store of the character crops, replacing a folder with a file for each crop.
+
+    The store folder contains:
+    - crops.npy: uint8 array (N, crop height, crop width, 3) of crops
+    - labels.npy: int32 array (N,) of classes, -1 for unlabelled (test) crops
+    - index.npy: int32 array (N, 2) of (page index, box index in the page)
+    - boxes.npy: float64 array (N, 4) of boxes in page coordinates [ymin, xmin, ymax, xmax]
+    - meta.json: the page paths, written last to mark the store as complete
+
+    The crops of each page are contiguous and the pages are stored in the given order. Arrays are
+    opened as memory maps, so indexing them reads only the requested crops.
+    """
+
+    def __init__(self, store_path: str):
+        self.__store_path = store_path
+
+        self.__crops: Union[np.ndarray, None] = None
+        self.__labels: Union[np.ndarray, None] = None
+        self.__index: Union[np.ndarray, None] = None
+        self.__boxes: Union[np.ndarray, None] = None
+        self.__pages: List[str] = []
+
+    def __get_file(self, name: str) -> str:
+        return os.path.join(self.__store_path, name)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.__get_file('meta.json'))
+
+    def load(self) -> 'CropStore':
+        """
+        Opens the arrays of the store as memory maps
+
+        :return: the store itself
+        """
+
+        assert self.exists(), 'Error: no complete crop store at {}'.format(self.__store_path)
+
+        with open(self.__get_file('meta.json')) as f:
+            self.__pages = json.load(f)['pages']
+
+        self.__crops = np.load(self.__get_file('crops.npy'), mmap_mode='r')
+        self.__labels = np.load(self.__get_file('labels.npy'), mmap_mode='r')
+        self.__index = np.load(self.__get_file('index.npy'), mmap_mode='r')
+        self.__boxes = np.load(self.__get_file('boxes.npy'), mmap_mode='r')
+
+        return self
+
+    def write(self,
+              pages: List[Tuple[str, np.ndarray, Union[np.ndarray, None]]],
+              crop_engine: CropEngine) -> 'CropStore':
+        """
+        Crops the given pages and writes them to the store, one page at a time
+
+        :param pages: a list of (page path, boxes as rows [ymin, xmin, ymax, xmax], classes or None)
+        :param crop_engine: the engine cropping the pages
+        :return: the store itself, loaded
+        """
+
+        os.makedirs(self.__store_path, exist_ok=True)
+
+        # Remove the marker first, so that an interrupted write leaves an incomplete store
+        if self.exists():
+            os.remove(self.__get_file('meta.json'))
+
+        n_boxes = [len(boxes) for _, boxes, _ in pages]
+        n_crops = sum(n_boxes)
+
+        crops = np.lib.format.open_memmap(self.__get_file('crops.npy'),
+                                          mode='w+',
+                                          dtype=np.uint8,
+                                          shape=(n_crops,) + crop_engine.get_crop_shape())
+
+        labels = np.full(n_crops, -1, dtype=np.int32)
+        index = np.zeros((n_crops, 2), dtype=np.int32)
+        boxes = np.zeros((n_crops, 4), dtype=np.float64)
+
+        start = 0
+        page_crops: Iterable[np.ndarray] = crop_engine.crop_pages((img_path, img_boxes)
+                                                                  for img_path, img_boxes, _ in pages)
+
+        for page_idx, ((_, img_boxes, img_labels), img_crops) in enumerate(tqdm(zip(pages, page_crops),
+                                                                                 total=len(pages))):
+            end = start + len(img_crops)
+
+            crops[start:end] = img_crops
+            index[start:end, 0] = page_idx
+            index[start:end, 1] = np.arange(len(img_crops))
+
+            if len(img_crops):
+                boxes[start:end] = np.asarray(img_boxes, dtype=np.float64)[:, :4]
+
+            if img_labels is not None:
+                labels[start:end] = img_labels
+
+            start = end
+
+        crops.flush()
+        del crops
+
+        np.save(self.__get_file('labels.npy'), labels)
+        np.save(self.__get_file('index.npy'), index)
+        np.save(self.__get_file('boxes.npy'), boxes)
+
+        with open(self.__get_file('meta.json'), 'w') as f:
+            json.dump({'pages': [img_path for img_path, _, _ in pages], 'n_crops': n_crops}, f, indent=4)
+
+        return self.load()
+
+    def matches(self, pages: List[Tuple[str, np.ndarray, Union[np.ndarray, None]]]) -> bool:
+        """
+        Checks that the loaded store holds the crops of the given pages, boxes and classes
+
+        :param pages: a list of (page path, boxes as rows [ymin, xmin, ymax, xmax], classes or None), as to write
+        :return: whether the store was written from the same pages, boxes and classes, in the same order
+        """
+
+        if self.__pages != [img_path for img_path, _, _ in pages]:
+            return False
+
+        offsets = self.get_page_offsets()
+
+        for (_, img_boxes, img_labels), start, end in zip(pages, offsets[:-1], offsets[1:]):
+            if end - start != len(img_boxes):
+                return False
+
+            if len(img_boxes) and not np.array_equal(self.__boxes[start:end],
+                                                     np.asarray(img_boxes, dtype=np.float64)[:, :4]):
+                return False
+
+            if img_labels is not None and not np.array_equal(self.__labels[start:end], img_labels):
+                return False
+
+        return True
+
+    def get_crops(self) -> np.ndarray:
+        return self.__crops
+
+    def get_labels(self) -> np.ndarray:
+        return self.__labels
+
+    def get_index(self) -> np.ndarray:
+        return self.__index
+
+    def get_boxes(self) -> np.ndarray:
+        return self.__boxes
+
+    def get_pages(self) -> List[str]:
+        return self.__pages
+
+    def get_page_offsets(self) -> np.ndarray:
+        """
+        :return: the offsets of the crops of each page, the crops of page i are in [offsets[i], offsets[i + 1])
+        """
+
+        return np.searchsorted(self.__index[:, 0], np.arange(len(self.__pages) + 1), side='left')
+
+    def get_page_crops(self) -> List[np.ndarray]:
+        """
+        :return: the memory-mapped crops of each page, in the order of the pages
+        """
+
+        offsets = self.get_page_offsets()
+
+        return [self.__crops[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
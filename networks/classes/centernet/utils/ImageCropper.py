@@ -2,42 +2,181 @@ import os
 import shutil
 import sys
 import natsort
-from typing import List, Tuple, Dict, Union
+from collections import deque
+from typing import Generator, Iterable, List, Tuple, Dict, Union
 
 import numpy as np
 import pandas as pd
-from PIL import Image
 from tqdm import tqdm
 
+from networks.classes.centernet.utils.CropEngine import CropEngine
+from networks.classes.centernet.utils.CropManifest import CropManifest
+from networks.classes.centernet.utils.CropStore import CropStore
+
 
 class ImageCropper:
 
-    def __init__(self, log):
-        self.__log = log
+    def __init__(self,
+                 log,
+                 crop_height: int = 40,
+                 crop_width: int = 40,
+                 n_workers: int = 0,
+                 max_in_flight_pages: Union[int, None] = None):
+        """
+        :param log: the logger
+        :param crop_height: the height of the crops kept in memory or in a packed store
+        :param crop_width: the width of the crops kept in memory or in a packed store
+        :param n_workers: the number of processes cropping the pages, 0 to crop in the calling process
+        :param max_in_flight_pages: the maximum number of pages cropped and not yet consumed
+        """
 
-    def get_crops(self, img_data: any, crop_char_path: str, mode='train', regenerate: bool = False) \
-            -> Union[List[Tuple[str, int]], List[List[str]]]:
+        self.__log = log
+        self.__crop_engine = CropEngine(crop_height=crop_height,
+                                        crop_width=crop_width,
+                                        n_workers=n_workers,
+                                        max_in_flight_pages=max_in_flight_pages)
+
+    def get_crops(self,
+                  img_data: any,
+                  crop_char_path: str,
+                  mode='train',
+                  regenerate: bool = False,
+                  packed: bool = False,
+                  incremental: bool = False) -> Union[List[Tuple[str, int]], List[List[str]], CropStore]:
         """
 
         :param img_data:
         :param crop_char_path:
         :param mode:
         :param regenerate:
+        :param packed: whether to store the crops in a single packed CropStore instead of a file for each crop
+        :param incremental: whether to regenerate only the crop files of the pages whose file or boxes changed
+            since the last regeneration (ignored in packed mode)
         :return: a list of tuple if in train mode, otw a list of list with crops for each individual
-        image
+        image. The CropStore in packed mode
         """
 
+        if packed:
+            if regenerate:
+                return self.__regenerate_packed_crops(img_data, crop_char_path, mode)
+
+            crop_store = CropStore(crop_char_path)
+
+            # A store written from other pages or boxes (e.g. of a previous detection) is stale
+            if crop_store.exists() and crop_store.load().matches(self.__get_pages_to_crop(img_data, mode)):
+                return crop_store
+
+            self.__log.warning('The packed {} crops at {} are missing or do not match the current bounding boxes, '
+                               'regenerating them'.format(mode, crop_char_path))
+
+            return self.__regenerate_packed_crops(img_data, crop_char_path, mode)
+
         regenerate_crops = {
             'train': self.__regenerate_crops_train,
             'test': self.__regenerate_crops_test
         }
 
         if regenerate:
-            return regenerate_crops[mode](img_data, crop_char_path)
+            return regenerate_crops[mode](img_data, crop_char_path, incremental)
         else:
             return self.__load_crop_characters(crop_char_path, mode=mode)
 
-    def __regenerate_crops_train(self, train_list, crop_char_path_train) -> List[Tuple[str, int]]:
+    def __get_pages_to_crop(self, img_data: any, mode: str) -> List[Tuple[str, np.ndarray, Union[np.ndarray, None]]]:
+        """
+        Lists the pages to crop with their boxes
+
+        :param img_data: the train list in train mode, the dict of the predicted bboxes in test mode
+        :param mode: strings 'train' or 'test'
+        :return: a list of (page path, boxes as rows [ymin, xmin, ymax, xmax], classes or None). In test
+            mode pages are natsorted, as the crop files
+        """
+
+        if mode == 'train':
+            self.__log.info('Getting bounding boxes from annotations...')
+            boxes = self.__annotations_to_bounding_boxes(img_data)
+
+            return [(img_path, img_boxes[:, 1:], img_boxes[:, 0].astype(int)) for img_path, img_boxes in boxes.items()]
+
+        if mode == 'test':
+            # img_data is a dict: {image: np.arr[score, ymin, xmin, ymax, xmax]}
+            boxes = self.__predictions_to_bounding_boxes(img_data)
+
+            return [(img_path, boxes[img_path], None) for img_path in natsort.natsorted(boxes.keys())]
+
+        raise ValueError("Mode value {} is not valid. Possibilities are 'test' or 'train'.".format(mode))
+
+    def get_crop_arrays(self, img_data: any, mode='train') \
+            -> Union[Tuple[np.ndarray, np.ndarray], Tuple[List[str], List[np.ndarray]]]:
+        """
+        Crops the characters in memory, decoding each page once, instead of writing a file per character
+
+        :param img_data: the train list in train mode, the dict of the predicted bboxes in test mode
+        :param mode: strings 'train' or 'test'
+        :return: in train mode, the uint8 crops of all the characters (N, H, W, 3) and their classes.
+            In test mode, the paths to the pages (natsorted, as the crop files) and the crops of each page
+        """
+
+        pages = self.__get_pages_to_crop(img_data, mode)
+
+        self.__log.info('Cropping {} images to characters in memory...'.format(mode))
+        crops = list(tqdm(self.__crop_engine.crop_pages((img_path, img_boxes) for img_path, img_boxes, _ in pages),
+                          total=len(pages)))
+        self.__log.info('Cropping done successfully!')
+
+        if mode == 'train':
+            return np.concatenate(crops), np.concatenate([img_labels for _, _, img_labels in pages])
+
+        return [img_path for img_path, _, _ in pages], crops
+
+    def iter_crop_arrays(self, bbox_predictions: Iterable[Tuple[str, np.ndarray]]) \
+            -> Generator[Tuple[str, np.ndarray, np.ndarray], None, None]:
+        """
+        Crops the characters of a stream of pages in memory, one page at a time and as the pages come
+
+        :param bbox_predictions: an iterable of (page path, np.arr[score, ymin, xmin, ymax, xmax])
+        :return: a generator of (page path, boxes as rows [ymin, xmin, ymax, xmax], uint8 crops (N, H, W, 3)),
+            in the order of the pages
+        """
+
+        # Pages handed to the crop engine and not yet returned, the engine keeps their order
+        in_flight: deque = deque()
+
+        def pages_to_crop():
+            for img_path, bboxes in bbox_predictions:
+                in_flight.append((img_path, bboxes[:, 1:]))
+                yield in_flight[-1]
+
+        for crops in self.__crop_engine.crop_pages(pages_to_crop()):
+            img_path, boxes = in_flight.popleft()
+            yield img_path, boxes, crops
+
+    def crop_image(self, img: np.ndarray, bboxes: np.ndarray) -> np.ndarray:
+        """
+        Crops the characters of a page already decoded in memory
+
+        :param img: the RGB page as a uint8 array of shape (height, width, 3)
+        :param bboxes: the predicted bboxes of the page, as np.arr[score, ymin, xmin, ymax, xmax]
+        :return: the uint8 crops, with shape (N, H, W, 3)
+        """
+
+        return self.__crop_engine.crop_image(img, bboxes[:, 1:])
+
+    def __regenerate_packed_crops(self, img_data: any, crop_char_path: str, mode: str) -> CropStore:
+
+        self.__log.info('Starting procedure to regenerate packed {} character crops'.format(mode))
+
+        pages = self.__get_pages_to_crop(img_data, mode)
+
+        self.__user_check(crop_char_path)
+
+        self.__log.info('Cropping {} images to characters at {}...'.format(mode, crop_char_path))
+        crop_store = CropStore(crop_char_path).write(pages, self.__crop_engine)
+        self.__log.info('Cropping done successfully!')
+
+        return crop_store
+
+    def __regenerate_crops_train(self, train_list, crop_char_path_train, incremental: bool = False) \
+            -> List[Tuple[str, int]]:
 
         self.__log.info('Starting procedure to regenerate cropped train character images')
 
@@ -46,12 +185,14 @@ class ImageCropper:
 
         self.__log.info('Cropping images to characters...')
         train_list: List[Tuple[str, int]] = self.__create_crop_characters_train(crop_formatted_list,
-                                                                                crop_char_path_train)
+                                                                                crop_char_path_train,
+                                                                                incremental=incremental)
         self.__log.info('Cropping done successfully!')
 
         return train_list
 
-    def __regenerate_crops_test(self, bbox_predictions, crop_char_path_test) -> List[List[str]]:
+    def __regenerate_crops_test(self, bbox_predictions, crop_char_path_test, incremental: bool = False) \
+            -> List[List[str]]:
 
         self.__log.info('Starting procedure to regenerate cropped test character images')
 
@@ -60,7 +201,7 @@ class ImageCropper:
 
         self.__log.info('Cropping test images to characters...')
         test_list: List[List[str]] = \
-            self.create_crop_characters_test(nice_formatted_dict, crop_char_path_test)
+            self.create_crop_characters_test(nice_formatted_dict, crop_char_path_test, incremental=incremental)
         self.__log.info('Cropping done successfully!')
 
         return test_list
@@ -119,54 +260,35 @@ class ImageCropper:
 
     def create_crop_characters_test(self,
                                     images_to_split: Dict[str, np.array],
-                                    save_dir: str) -> List[List[str]]:
+                                    save_dir: str,
+                                    incremental: bool = False) -> List[List[str]]:
         """
         Crop image into all its bounding boxes, saving a different image for each one in save_dir.
 
         :param images_to_split: dict of {image_path: ndarray([ymin, xmin, ymax, xmax])}
         :param save_dir: directory where to save cropped images
+        :param incremental: whether to crop only the images whose file or boxes changed since the last call
         :return a list with crops for each image. Each image has a separate list
         """
 
-        self.__user_check(save_dir)
-
         # ---- Cropping ----
 
         # List of lists with crops of all images. Each one in a separate list
-        cropped_list: List[List[str]] = []
-
-        for img_path, boxes in tqdm(images_to_split.items()):
-            # List of crops for single image
-            image_cropped_list: List[str] = []
-
-            # Get image name without extension, e.g. dataset/img.jpg -> img
-            img_name = img_path.split(str(os.sep))[-1].split('.')[0]
-            # Relative path with image name (no extension)
-            img_name_path = os.path.join(save_dir, img_name)
-
-            with Image.open(img_path) as img:
-                # Give incremental id to each cropped box in image filename
-                box_n = 0
-
-                for box in boxes:
-                    ymin = float(box[0])
-                    xmin = float(box[1])
-                    ymax = float(box[2])
-                    xmax = float(box[3])
-
-                    filepath = img_name_path + '_' + str(box_n) + '.jpg'
-                    img.crop((xmin, ymin, xmax, ymax)).save(filepath)
-                    image_cropped_list.append(filepath)
-                    box_n += 1
-
-            cropped_list.append(image_cropped_list)
+        if incremental:
+            cropped_list: List[List[str]] = self.__crop_pages_incrementally(list(images_to_split.items()), save_dir)
+        else:
+            self.__user_check(save_dir)
+            cropped_list: List[List[str]] = list(tqdm(self.__crop_engine.save_pages(images_to_split.items(),
+                                                                                    save_dir),
+                                                      total=len(images_to_split)))
 
         return cropped_list
 
     def __create_crop_characters_train(self,
                                        images_to_split: Dict[str, np.array],
                                        save_dir: str,
-                                       save_csv: bool = True) -> List[Tuple[str, int]]:
+                                       save_csv: bool = True,
+                                       incremental: bool = False) -> List[Tuple[str, int]]:
         """
         Crops image into all bounding box, saving a different image for each one in save_dir.
         Additionally save a csv containing all pairs (char_image, char_class) in save_dir folder.
@@ -174,34 +296,23 @@ class ImageCropper:
         :param save_csv: whether to save (cropped_img_path, char_class) to a cvs file
         :param images_to_split: dict of {image_path: ndarray([char_class, ymin, xmin, ymax, xmax])}
         :param save_dir: directory where to save cropped images
+        :param incremental: whether to crop only the images whose file or boxes changed since the last call
         """
 
-        self.__user_check(save_dir)
-
         cropped_list = []
 
-        for img_path, boxes in tqdm(images_to_split.items()):
-            # Get image name without extension, e.g. dataset/img.jpg -> img
-            img_name = img_path.split('/')[-1].split('.')[0]
+        # The boxes are cropped without the class, in the first column. The classes are always
+        # taken from the annotations, so a change of class only rewrites the csv
+        pages = [(img_path, boxes[:, 1:]) for img_path, boxes in images_to_split.items()]
 
-            # Relative path with image name (no extension)
-            img_name_path = os.path.join(save_dir, img_name)
-
-            with Image.open(img_path) as img:
-                # Give incremental id to each cropped box in image filename
-                box_n = 0
-
-                for box in boxes:
-                    char_class = int(box[0])
-                    ymin = float(box[1])
-                    xmin = float(box[2])
-                    ymax = float(box[3])
-                    xmax = float(box[4])
+        if incremental:
+            page_crops = self.__crop_pages_incrementally(pages, save_dir)
+        else:
+            self.__user_check(save_dir)
+            page_crops = self.__crop_engine.save_pages(pages, save_dir)
 
-                    filepath = img_name_path + '_' + str(box_n) + '.jpg'
-                    img.crop((xmin, ymin, xmax, ymax)).save(filepath)
-                    cropped_list.append((filepath, char_class))
-                    box_n += 1
+        for boxes, filepaths in tqdm(zip(images_to_split.values(), page_crops), total=len(pages)):
+            cropped_list.extend((filepath, int(box[0])) for filepath, box in zip(filepaths, boxes))
 
         # Save list to csv, to rapidly load them
         if save_csv:
@@ -211,6 +322,58 @@ class ImageCropper:
 
         return cropped_list
 
+    def __crop_pages_incrementally(self, pages: List[Tuple[str, np.ndarray]], save_dir: str) -> List[List[str]]:
+        """
+        Crops to files only the pages whose file or boxes changed since the last regeneration in save_dir,
+        deleting the crops of the boxes and pages which no longer exist
+
+        :param pages: a list of (page path, boxes as rows [ymin, xmin, ymax, xmax])
+        :param save_dir: directory where to save cropped images
+        :return: the paths to the crops of each page, in the order of the pages
+        """
+
+        manifest = CropManifest(save_dir)
+
+        if manifest.exists():
+            manifest.load()
+        else:
+            # Without a manifest the content of the folder is unknown, so everything is regenerated
+            self.__user_check(save_dir)
+
+        hashes = [(manifest.hash_page(img_path), manifest.hash_boxes(boxes)) for img_path, boxes in pages]
+        changed = [i for i, ((img_path, _), (page_hash, boxes_hash)) in enumerate(zip(pages, hashes))
+                   if not manifest.is_current(img_path, page_hash, boxes_hash)]
+
+        # Delete the crops of the pages which are no longer listed
+        page_paths = set(img_path for img_path, _ in pages)
+        for img_path in manifest.get_pages():
+            if img_path not in page_paths:
+                self.__delete_crops(manifest.remove(img_path)['crops'])
+
+        self.__log.info('Cropping {} changed images out of {}...'.format(len(changed), len(pages)))
+
+        page_crops = self.__crop_engine.save_pages((pages[i] for i in changed), save_dir)
+
+        for i, crops in tqdm(zip(changed, page_crops), total=len(changed)):
+            img_path = pages[i][0]
+
+            # Delete the crops of the boxes which are no longer listed
+            entry = manifest.remove(img_path)
+            if entry is not None:
+                self.__delete_crops(set(entry['crops']) - set(crops))
+
+            manifest.update(img_path, hashes[i][0], hashes[i][1], crops)
+
+        manifest.save()
+
+        return [manifest.get_crops(img_path) for img_path, _ in pages]
+
+    @staticmethod
+    def __delete_crops(crops: Iterable[str]):
+        for crop_path in crops:
+            if os.path.isfile(crop_path):
+                os.remove(crop_path)
+
     @staticmethod
     def __load_crop_characters(save_dir: str, mode: str) \
             -> Union[List[Tuple[str, int]], List[List[str]]]:
@@ -234,7 +397,7 @@ class ImageCropper:
 
             csv_df = pd.read_csv(csv_path, delimiter=',')
 
-            assert len(os.listdir(save_dir)) - 1 == len(csv_df.index), \
+            assert len(ImageCropper.__list_crop_files(save_dir)) == len(csv_df.index), \
                 "Error: csv and save_dir contains different number of items"
 
             return [tuple(c) for c in csv_df.values]
@@ -245,7 +408,7 @@ class ImageCropper:
                 .format(save_dir)
 
             # Sort the images
-            img = natsort.natsorted(os.listdir(save_dir))
+            img = natsort.natsorted(ImageCropper.__list_crop_files(save_dir))
 
             # Add relative path to image name
             img = [str(os.path.join(save_dir, name)) for name in img]
@@ -270,6 +433,14 @@ class ImageCropper:
 
         raise ValueError("Mode value {} is not valid. Possibilities are 'test' or 'train'.".format(mode))
 
+    @staticmethod
+    def __list_crop_files(save_dir: str) -> List[str]:
+        """
+        :return: the names of the crop files in save_dir, leaving out the csv and the manifest
+        """
+
+        return [name for name in os.listdir(save_dir) if name.endswith('.jpg')]
+
     @staticmethod
     def __user_check(save_dir):
         """
@@ -0,0 +1,100 @@
+import os
+from typing import Dict, List, Tuple
+
+import pandas as pd
+from PIL import Image
+
+DEFAULT_INDEX_PATH = os.path.join('datasets', 'cache', 'image_sizes.csv')
+
+# Indexes shared by all the call sites of the process, by index path
+_shared_indexes: Dict[str, 'ImageSizeIndex'] = {}
+
+
+class ImageSizeIndex:
+    """
+    Persistent index of the sizes of the images, stored as a csv with columns
+    path, width, height, mtime, size.
+
+    The sizes are read from the image headers only (PIL opens images lazily), and an entry is
+    refreshed whenever the modification time (in ns) or the byte size of its file change.
+    """
+
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH):
+        self.__index_path = index_path
+        self.__entries: Dict[str, Tuple[int, int, int, int]] = {}
+        self.__changed = False
+
+        if os.path.isfile(index_path):
+            index = pd.read_csv(index_path)
+            self.__entries = {path: (int(w), int(h), int(mtime), int(size))
+                              for path, w, h, mtime, size in index[['path', 'width', 'height', 'mtime', 'size']].values}
+
+    def get_size(self, image_path: str) -> Tuple[int, int]:
+        """
+        Gets the size of an image, reading its header only if the index entry is missing or stale
+
+        :param image_path: the path to the image
+        :return: the width and height of the image
+        """
+
+        stat = os.stat(image_path)
+        entry = self.__entries.get(image_path)
+
+        if entry is None or entry[2] != stat.st_mtime_ns or entry[3] != stat.st_size:
+            with Image.open(image_path) as img:
+                width, height = img.size
+
+            entry = (width, height, stat.st_mtime_ns, stat.st_size)
+            self.__entries[image_path] = entry
+            self.__changed = True
+
+        return entry[0], entry[1]
+
+    def get_sizes(self, image_paths: List[str]) -> List[Tuple[int, int]]:
+        """
+        Gets the sizes of a list of images and saves the index if any entry has been refreshed
+
+        :param image_paths: the paths to the images
+        :return: the list of (width, height) of the images
+        """
+
+        sizes = [self.get_size(image_path) for image_path in image_paths]
+        self.save()
+
+        return sizes
+
+    def save(self):
+        """
+        Writes the index on disk if it changed since the last save
+        """
+
+        if not self.__changed:
+            return
+
+        index_folder = os.path.dirname(self.__index_path)
+        if index_folder:
+            os.makedirs(index_folder, exist_ok=True)
+
+        index = pd.DataFrame([(path,) + entry for path, entry in self.__entries.items()],
+                             columns=['path', 'width', 'height', 'mtime', 'size'])
+
+        # Write to a temporary file first, so that a crash never leaves a truncated index
+        tmp_path = self.__index_path + '.tmp'
+        index.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.__index_path)
+
+        self.__changed = False
+
+
+def get_image_size_index(index_path: str = DEFAULT_INDEX_PATH) -> ImageSizeIndex:
+    """
+    Gets the index of the image sizes stored at the given path, loading it once per process
+
+    :param index_path: the path to the csv of the index
+    :return: the shared index
+    """
+
+    if index_path not in _shared_indexes:
+        _shared_indexes[index_path] = ImageSizeIndex(index_path)
+
+    return _shared_indexes[index_path]
@@ -0,0 +1,73 @@
+import http.client
+import ipaddress
+import json
+import os
+import socket
+from typing import Dict
+from urllib.parse import urlencode
+
+
+class InferenceClient:
+    """
+    Client of the local inference server. It only connects to loopback addresses, being a stand-in for
+    the jobs running on the same machine of the server.
+    """
+
+    def __init__(self, port: int = 8500, host: str = '127.0.0.1', timeout: float = 60.0):
+        """
+        :param port: the port the server listens on
+        :param host: a loopback address or name (e.g. 127.0.0.1, localhost)
+        :param timeout: the timeout in seconds of each request
+        """
+
+        if not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+            raise ValueError('The inference client only connects to loopback addresses, not {}'.format(host))
+
+        self.__host = host
+        self.__port = port
+        self.__timeout = timeout
+
+    def __request(self, method: str, url: str, body: bytes = None) -> Dict:
+        connection = http.client.HTTPConnection(self.__host, self.__port, timeout=self.__timeout)
+
+        try:
+            connection.request(method, url, body=body, headers={'Content-Type': 'application/octet-stream'})
+            response = connection.getresponse()
+            content = json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError('Request {} {} failed with status {}: {}'
+                               .format(method, url, response.status, content.get('error')))
+
+        return content
+
+    def health(self) -> bool:
+        try:
+            return self.__request('GET', '/health')['status'] == 'ok'
+        except (OSError, RuntimeError):
+            return False
+
+    def get_stats(self) -> Dict:
+        return self.__request('GET', '/stats')
+
+    def predict(self, image_bytes: bytes, image_id: str = '') -> str:
+        """
+        :param image_bytes: the encoded page image (e.g. the content of a jpg file)
+        :param image_id: the id of the page, echoed by the server
+        :return: the labels of the page, as a string 'unicode X Y unicode X Y ...'
+        """
+
+        return self.__request('POST', '/predict?' + urlencode({'image_id': image_id}), body=image_bytes)['labels']
+
+    def predict_file(self, img_path: str) -> str:
+        """
+        :param img_path: the path to the page image
+        :return: the labels of the page, as a string 'unicode X Y unicode X Y ...'
+        """
+
+        with open(img_path, 'rb') as f:
+            image_bytes = f.read()
+
+        return self.predict(image_bytes, image_id=os.path.basename(img_path).split('.')[0])
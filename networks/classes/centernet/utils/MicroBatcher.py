@@ -0,0 +1,265 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+
+class BatchRequest:
+    """
+    The samples submitted by a caller, possibly spread over several batches
+    """
+
+    def __init__(self, inputs: np.ndarray):
+        self.inputs = inputs
+        self.future = Future()
+        self.submit_time = time.perf_counter()
+        self.n_dispatched = 0
+        self.outputs: List[np.ndarray] = []
+
+
+class MicroBatcher:
+    """
+    Dynamic batching scheduler in front of a model. Callers from any thread submit arrays of samples (e.g.
+    the tiles of a page, the crops of a page, a single page) and a worker thread coalesces the pending
+    samples into batches of at most max_batch_size samples for the model:
+    - a batch is dispatched as soon as it is full, or when its oldest pending request has waited max_wait
+    - the samples of a request may be split over consecutive batches, its outputs are reassembled in order
+
+    The scheduler records the histogram of the sizes of the dispatched batches and the queueing delay of the
+    requests, i.e. the time from their submission to the dispatch of their first samples.
+    """
+
+    def __init__(self,
+                 predict_fn: Callable[[np.ndarray], np.ndarray],
+                 log,
+                 name: str = 'model',
+                 max_batch_size: int = 32,
+                 max_wait: float = 0.005,
+                 max_recorded_delays: int = 10000):
+        """
+        :param predict_fn: the function predicting a batch, e.g. the predict_on_batch of a keras model
+        :param log: the logger
+        :param name: the name of the model in the logs
+        :param max_batch_size: the maximum number of samples in each batch
+        :param max_wait: the maximum time in seconds a request waits for the batch to be filled
+        :param max_recorded_delays: the number of most recent queueing delays kept for the metrics
+        """
+
+        self.__predict_fn = predict_fn
+        self.__log = log
+        self.__name = name
+        self.__max_batch_size = max_batch_size
+        self.__max_wait = max_wait
+
+        self.__pending: deque = deque()
+        self.__n_pending_samples = 0
+        self.__condition = threading.Condition()
+        self.__stop = False
+        self.__thread = None
+
+        self.__batch_sizes: Counter = Counter()
+        self.__delays: deque = deque(maxlen=max_recorded_delays)
+        self.__n_requests = 0
+
+    def __enter__(self) -> 'MicroBatcher':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self) -> 'MicroBatcher':
+        with self.__condition:
+            self.__stop = False
+
+        self.__thread = threading.Thread(target=self.__run, name='{}_batcher'.format(self.__name), daemon=True)
+        self.__thread.start()
+
+        return self
+
+    def stop(self):
+        """
+        Stops the worker after the pending requests are dispatched
+        """
+
+        with self.__condition:
+            self.__stop = True
+            self.__condition.notify_all()
+
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        """
+        Queues the samples of a request
+
+        :param inputs: the samples, an array with the samples on the first axis
+        :return: a future of the outputs of the model for the samples, in the same order
+        """
+
+        if len(inputs) == 0:
+            raise ValueError('A request to the {} batcher must have at least one sample'.format(self.__name))
+
+        request = BatchRequest(inputs)
+
+        with self.__condition:
+            if self.__stop:
+                raise RuntimeError('The {} batcher is stopped'.format(self.__name))
+
+            self.__pending.append(request)
+            self.__n_pending_samples += len(inputs)
+            self.__condition.notify_all()
+
+        return request.future
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Submits the samples of a request and waits for their outputs
+
+        :param inputs: the samples, an array with the samples on the first axis
+        :return: the outputs of the model for the samples
+        """
+
+        return self.submit(inputs).result()
+
+    def __get_batch(self) -> List[Tuple[BatchRequest, int, int]]:
+        """
+        Waits for a full batch or for the oldest pending request to reach the maximum wait
+
+        :return: the slices of the requests in the batch, as (request, start, end), empty if stopped
+        """
+
+        with self.__condition:
+            batch, n_samples = [], 0
+
+            while not batch:
+                while not self.__pending:
+                    if self.__stop:
+                        return []
+                    self.__condition.wait()
+
+                deadline = self.__pending[0].submit_time + self.__max_wait
+
+                while self.__n_pending_samples < self.__max_batch_size and not self.__stop:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    self.__condition.wait(timeout)
+
+                dispatch_time = time.perf_counter()
+
+                while self.__pending and n_samples < self.__max_batch_size:
+                    request = self.__pending[0]
+
+                    # A request already done (e.g. cancelled by its caller) has no more samples to predict
+                    if request.future.done():
+                        self.__discard_pending(request)
+                        continue
+
+                    n_taken = min(self.__max_batch_size - n_samples, len(request.inputs) - request.n_dispatched)
+
+                    if request.n_dispatched == 0:
+                        self.__delays.append(dispatch_time - request.submit_time)
+                        self.__n_requests += 1
+
+                    batch.append((request, request.n_dispatched, request.n_dispatched + n_taken))
+                    request.n_dispatched += n_taken
+                    n_samples += n_taken
+
+                    if request.n_dispatched == len(request.inputs):
+                        self.__pending.popleft()
+
+            self.__n_pending_samples -= n_samples
+            self.__batch_sizes[n_samples] += 1
+
+        return batch
+
+    def __discard_pending(self, request: BatchRequest):
+        """
+        Removes the samples of a request which are not dispatched yet, with the condition held
+
+        :param request: the request, pending if some of its samples are not dispatched yet
+        """
+
+        if request.n_dispatched < len(request.inputs):
+            self.__pending.remove(request)
+            self.__n_pending_samples -= len(request.inputs) - request.n_dispatched
+            request.n_dispatched = len(request.inputs)
+
+    def __run_batch(self, batch: List[Tuple[BatchRequest, int, int]]):
+        try:
+            outputs = np.asarray(self.__predict_fn(np.concatenate([request.inputs[start:end]
+                                                                   for request, start, end in batch])))
+        except Exception as e:
+            self.__log.error('Prediction of a {} batch failed: {}'.format(self.__name, e))
+
+            # The failed requests are not predicted further, their remaining samples are dropped
+            with self.__condition:
+                for request, _, _ in batch:
+                    self.__discard_pending(request)
+
+            for request, _, _ in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        offset = 0
+
+        for request, start, end in batch:
+            request.outputs.append(outputs[offset:offset + end - start])
+            offset += end - start
+
+            if end == len(request.inputs) and not request.future.done():
+                request.future.set_result(np.concatenate(request.outputs))
+
+    def __run(self):
+        while True:
+            batch = self.__get_batch()
+            if not batch:
+                return
+
+            self.__run_batch(batch)
+
+    def get_metrics(self) -> Dict:
+        """
+        :return: the number of requests, batches and samples, the histogram of the batch sizes as
+            {batch size: number of batches} and the statistics of the recent queueing delays in ms
+        """
+
+        with self.__condition:
+            batch_sizes = dict(sorted(self.__batch_sizes.items()))
+            delays = np.array(self.__delays) * 1000
+            n_requests = self.__n_requests
+
+        metrics = {'requests': n_requests,
+                   'batches': sum(batch_sizes.values()),
+                   'samples': sum(size * count for size, count in batch_sizes.items()),
+                   'batch_size_histogram': batch_sizes}
+
+        metrics['mean_batch_size'] = metrics['samples'] / max(metrics['batches'], 1)
+
+        if len(delays):
+            metrics['queue_delay_ms'] = {'mean': float(np.mean(delays)),
+                                         'p50': float(np.percentile(delays, 50)),
+                                         'p95': float(np.percentile(delays, 95)),
+                                         'max': float(np.max(delays))}
+
+        return metrics
+
+    def log_metrics(self):
+        metrics = self.get_metrics()
+
+        lines = ['{:>12} {:>10}'.format('batch size', 'batches')]
+        lines += ['{:>12} {:>10}'.format(size, count) for size, count in metrics['batch_size_histogram'].items()]
+
+        delays = metrics.get('queue_delay_ms', {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0})
+
+        self.__log.info('{} batcher: {} requests in {} batches (mean size {:.2f}, max {}), queueing delay '
+                        'mean {:.1f}ms, p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms:\n{}'
+                        .format(self.__name, metrics['requests'], metrics['batches'], metrics['mean_batch_size'],
+                                self.__max_batch_size, delays['mean'], delays['p50'], delays['p95'],
+                                delays['max'], '\n'.join(lines)))
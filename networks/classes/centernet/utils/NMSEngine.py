@@ -0,0 +1,193 @@
+from typing import List
+
+import numpy as np
+
+
+class NMSEngine:
+    """
+    Greedy non-maximum suppression over score-sorted boxes.
+
+    A box j is suppressed by an already kept box i if the overlap covers at least 'iou_thresh'
+    of the area of i, or if less than (1 - iou_thresh) of the area of j lies outside i (out_lap).
+
+    Available backends:
+    - loop: the reference implementation, one kept box per numpy pass over all survivors
+    - blocked: pairwise suppression matrices computed in blocks of 'block_size' boxes
+    - sweep: boxes sorted by xmin, each kept box is only compared with its horizontal neighbours
+    - auto: blocked up to 'sweep_min_boxes' boxes, sweep otherwise
+    """
+
+    def __init__(self, backend: str = 'auto', block_size: int = 256, sweep_min_boxes: int = 1500):
+        backends = {
+            'loop': self.__loop_nms,
+            'blocked': self.__blocked_nms,
+            'sweep': self.__sweep_nms,
+            'auto': self.__auto_nms
+        }
+
+        if backend not in backends:
+            raise ValueError("NMS backend {} is not valid. Possibilities are {}."
+                             .format(backend, ', '.join(backends.keys())))
+
+        self.__backend = backend
+        self.__nms = backends[backend]
+        self.__block_size = block_size
+        self.__sweep_min_boxes = sweep_min_boxes
+
+    def get_backend(self) -> str:
+        return self.__backend
+
+    def suppress(self, xmin, xmax, ymin, ymax, iou_thresh) -> List[int]:
+        """
+        Performs the non-maximum suppression on boxes already sorted by score in descending order
+
+        :param xmin: the left coordinate of the boxes (flatten array)
+        :param xmax: the right coordinate of the boxes (flatten array)
+        :param ymin: the top coordinate of the boxes (flatten array)
+        :param ymax: the bottom coordinate of the boxes (flatten array)
+        :param iou_thresh: the minimum overlap threshold for the suppression
+        :return: the indexes of the boxes to keep, in ascending order
+        """
+
+        return self.__nms(xmin, xmax, ymin, ymax, iou_thresh)
+
+    @staticmethod
+    def __still_alive(best, candidates, xmin, xmax, ymin, ymax, area, iou_thresh) -> np.ndarray:
+        """
+        Computes which candidate boxes survive each of the best boxes. The element-wise operations
+        are the same of the reference loop, so that all the backends take the same decisions.
+
+        :param best: the indexes of the suppressing boxes (rows of the result)
+        :param candidates: the indexes of the boxes that may be suppressed (columns of the result)
+        :return: a boolean matrix of shape (len(best), len(candidates))
+        """
+
+        y1 = np.maximum(ymin[best].reshape(-1, 1), ymin[candidates].reshape(1, -1))
+        x1 = np.maximum(xmin[best].reshape(-1, 1), xmin[candidates].reshape(1, -1))
+        y2 = np.minimum(ymax[best].reshape(-1, 1), ymax[candidates].reshape(1, -1))
+        x2 = np.minimum(xmax[best].reshape(-1, 1), xmax[candidates].reshape(1, -1))
+
+        # Bbox-wise area
+        cross = np.maximum(0, y2 - y1) * np.maximum(0, x2 - x1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Mask to keep just the boxes which overlap with best box for less than threshold
+            max_over_lap = (cross / area[best].reshape(-1, 1)) < iou_thresh
+
+            # Mask to keep just the boxes with enough out_lap surface
+            candidates_area = area[candidates].reshape(1, -1)
+            min_out_lap = ((candidates_area - cross) / candidates_area) > (1 - iou_thresh)
+
+        return max_over_lap * min_out_lap
+
+    @staticmethod
+    def __loop_nms(xmin, xmax, ymin, ymax, iou_thresh) -> List[int]:
+        box_idx = np.arange(len(ymin))
+        boxes_to_keep = []
+
+        # Box area of score-sorted boxes
+        area = ((ymax - ymin) * (xmax - xmin))
+
+        while len(box_idx) > 0:
+            # Insert the index of the best bbox in the list of boxes to keep
+            boxes_to_keep.append(box_idx[0])
+
+            # y2 - y1 is an array with the distance (element-wise) between boxes on y coord
+            y1 = np.maximum(ymin[0], ymin)
+            x1 = np.maximum(xmin[0], xmin)
+            y2 = np.minimum(ymax[0], ymax)
+            x2 = np.minimum(xmax[0], xmax)
+
+            # Bbox-wise area
+            cross_h = np.maximum(0, y2 - y1)
+            cross_w = np.maximum(0, x2 - x1)
+
+            # Mask to keep just the boxes which overlap with best box for less than threshold
+            max_over_lap = (((cross_h * cross_w) / area[0]) < iou_thresh)
+
+            # Mask to keep just the boxes with enough out_lap surface
+            min_out_lap = (((area - (cross_h * cross_w)) / area) > (1 - iou_thresh))
+
+            still_alive = max_over_lap * min_out_lap
+
+            assert np.sum(still_alive) != len(box_idx), \
+                'An error occurred: {} {}'.format(np.max((cross_h * cross_w)), area[0])
+
+            ymin = ymin[still_alive]
+            xmin = xmin[still_alive]
+            ymax = ymax[still_alive]
+            xmax = xmax[still_alive]
+            area = area[still_alive]
+            box_idx = box_idx[still_alive]
+
+        return boxes_to_keep
+
+    def __blocked_nms(self, xmin, xmax, ymin, ymax, iou_thresh) -> List[int]:
+        n_boxes = len(ymin)
+        area = ((ymax - ymin) * (xmax - xmin))
+
+        alive = np.ones(n_boxes, dtype=bool)
+        boxes_to_keep = []
+
+        for start in range(0, n_boxes, self.__block_size):
+            end = min(start + self.__block_size, n_boxes)
+            block = np.arange(start, end)
+
+            # Suppress the boxes of the block overlapping a box kept in the previous blocks
+            if boxes_to_keep:
+                still_alive = self.__still_alive(np.array(boxes_to_keep), block,
+                                                 xmin, xmax, ymin, ymax, area, iou_thresh)
+                alive[start:end] *= still_alive.all(axis=0)
+
+            # Resolve the greedy selection inside the block
+            still_alive = self.__still_alive(block, block, xmin, xmax, ymin, ymax, area, iou_thresh)
+
+            for i in range(end - start):
+                if alive[start + i]:
+                    boxes_to_keep.append(start + i)
+                    alive[start + i + 1:end] *= still_alive[i, i + 1:]
+
+        return boxes_to_keep
+
+    def __sweep_nms(self, xmin, xmax, ymin, ymax, iou_thresh) -> List[int]:
+        area = ((ymax - ymin) * (xmax - xmin))
+
+        # Boxes that do not intersect survive only if all areas are positive and the threshold is
+        # not null. Otherwise, the neighbours alone are not enough to reproduce the reference
+        if len(area) == 0 or iou_thresh <= 0 or not np.all(area > 0):
+            return self.__blocked_nms(xmin, xmax, ymin, ymax, iou_thresh)
+
+        n_boxes = len(ymin)
+        alive = np.ones(n_boxes, dtype=bool)
+        boxes_to_keep = []
+
+        # Sort boxes by left coordinate, so that horizontal neighbours are contiguous
+        x_order = np.argsort(xmin, kind='mergesort')
+        x_sorted = xmin[x_order]
+
+        # Twice the largest width, to be safe against rounding in xmax - xmin
+        max_width = 2 * np.max(xmax - xmin)
+
+        for i in range(n_boxes):
+            if not alive[i]:
+                continue
+
+            boxes_to_keep.append(i)
+
+            # Only boxes whose left side lies in (xmin - max width, xmax] can overlap the best box
+            lo = np.searchsorted(x_sorted, xmin[i] - max_width, side='left')
+            hi = np.searchsorted(x_sorted, xmax[i], side='right')
+            candidates = x_order[lo:hi]
+            candidates = candidates[(candidates > i) & alive[candidates]]
+
+            if candidates.size > 0:
+                alive[candidates] = self.__still_alive(np.array([i]), candidates,
+                                                       xmin, xmax, ymin, ymax, area, iou_thresh)[0]
+
+        return boxes_to_keep
+
+    def __auto_nms(self, xmin, xmax, ymin, ymax, iou_thresh) -> List[int]:
+        if len(ymin) < self.__sweep_min_boxes:
+            return self.__blocked_nms(xmin, xmax, ymin, ymax, iou_thresh)
+
+        return self.__sweep_nms(xmin, xmax, ymin, ymax, iou_thresh)
@@ -0,0 +1,52 @@
+import multiprocessing as mp
+from collections import deque
+from typing import Callable, Generator, Iterable, Tuple, Union
+
+
+class OrderedProcessPool:
+    """
+    Maps a function over a sequence of independent tasks with a pool of processes, yielding the
+    results in the order of the tasks.
+
+    At most 'max_in_flight' tasks are submitted and not yet consumed at any time, which bounds the
+    memory taken by pending results (e.g. the crops of decoded pages).
+    """
+
+    def __init__(self, n_workers: int = 0, max_in_flight: Union[int, None] = None):
+        """
+        :param n_workers: the number of worker processes, 0 to run the tasks in the calling process
+        :param max_in_flight: the maximum number of pending tasks, defaults to twice the workers
+        """
+
+        self.__n_workers = n_workers
+        self.__max_in_flight = max(1, max_in_flight if max_in_flight else 2 * n_workers)
+
+    def get_n_workers(self) -> int:
+        return self.__n_workers
+
+    def map(self, function: Callable, tasks: Iterable[Tuple]) -> Generator:
+        """
+        Applies the function to the arguments of each task
+
+        :param function: a picklable function (e.g. a module function or a public method)
+        :param tasks: an iterable of tuples of arguments, consumed lazily
+        :return: a generator of the results, in the order of the tasks
+        """
+
+        if self.__n_workers <= 0:
+            for args in tasks:
+                yield function(*args)
+            return
+
+        # Workers are forked, so that they share the state of the calling process
+        with mp.get_context('fork').Pool(self.__n_workers) as pool:
+            pending = deque()
+
+            for args in tasks:
+                pending.append(pool.apply_async(function, args))
+
+                if len(pending) >= self.__max_in_flight:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
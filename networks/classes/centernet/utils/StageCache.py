@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import pickle
+from typing import Any, Iterable, List, Union
+
+DEFAULT_STAGE_CACHE_PATH = os.path.join('datasets', 'cache', 'stages')
+
+
+class StageCache:
+    """
+    Cache of the artifacts of the stages of the pipeline, each pickled under a key derived from
+    the inputs of its stage (the relevant sections of the parameters and the input files), so that
+    a later run with the same inputs loads the artifacts instead of running the stage.
+
+    Files are fingerprinted by the hash of their content, folders (e.g. of images or weights) by the
+    names, byte sizes and modification times of the files they contain.
+    """
+
+    def __init__(self, cache_path: str = DEFAULT_STAGE_CACHE_PATH):
+        self.__cache_path = cache_path
+
+    @staticmethod
+    def __hash_file(path: str) -> str:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    @staticmethod
+    def fingerprint(paths: Iterable[str]) -> List:
+        """
+        Fingerprints a list of input files and folders
+
+        :param paths: the paths to the files and folders, missing paths are fingerprinted as such
+        :return: a json serializable fingerprint, which changes whenever an input changes
+        """
+
+        fingerprints = []
+
+        for path in paths:
+            if os.path.isfile(path):
+                fingerprints.append([path, StageCache.__hash_file(path)])
+            elif os.path.isdir(path):
+                entries = []
+                for folder, _, files in sorted(os.walk(path)):
+                    for name in sorted(files):
+                        stat = os.stat(os.path.join(folder, name))
+                        entries.append([os.path.relpath(os.path.join(folder, name), path),
+                                        stat.st_size,
+                                        stat.st_mtime_ns])
+                fingerprints.append([path, hashlib.sha1(json.dumps(entries).encode('utf-8')).hexdigest()])
+            else:
+                fingerprints.append([path, None])
+
+        return fingerprints
+
+    @staticmethod
+    def get_key(stage: str, *inputs) -> str:
+        """
+        :param stage: the name of the stage
+        :param inputs: the json serializable inputs of the stage (parameters, fingerprints, keys of other stages)
+        :return: the key of the artifacts of the stage
+        """
+
+        content = json.dumps([stage, inputs], sort_keys=True, default=str)
+
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def __get_file(self, stage: str, key: str) -> str:
+        return os.path.join(self.__cache_path, '{}_{}.pkl'.format(stage, key))
+
+    def load(self, stage: str, key: str) -> Union[Any, None]:
+        """
+        :return: the cached artifacts of the stage for the given key, None if missing
+        """
+
+        try:
+            with open(self.__get_file(stage, key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, stage: str, key: str, artifacts: Any):
+        """
+        Pickles the artifacts of the stage atomically, so that an interrupted write is never loaded
+        """
+
+        os.makedirs(self.__cache_path, exist_ok=True)
+
+        artifacts_path = self.__get_file(stage, key)
+        with open(artifacts_path + '.tmp', 'wb') as f:
+            pickle.dump(artifacts, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(artifacts_path + '.tmp', artifacts_path)
@@ -0,0 +1,175 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generator, Iterable, List, Tuple
+
+# Marker closing the stream of a queue
+_END = object()
+
+
+class StagedExecutor:
+    """
+    Runs a chain of streaming stages concurrently, each stage in its own thread, connected by bounded
+    queues. A stage is a function from the iterable of its inputs to the iterable of its outputs (e.g. a
+    generator function), so that each stage works on a different item (page, batch) at the same time.
+
+    For each stage, the executor records the number of items produced, the depth of its output queue
+    when each item is put, the time spent waiting for inputs (the stage is starved, upstream is the
+    bottleneck) and the time spent waiting to put outputs (the stage is blocked, downstream is the
+    bottleneck).
+    """
+
+    def __init__(self, log, queue_size: int = 8, poll_interval: float = 0.1):
+        """
+        :param log: the logger
+        :param queue_size: the maximum number of items waiting between two consecutive stages
+        :param poll_interval: the interval in seconds at which blocked threads check if the run was stopped
+        """
+
+        self.__log = log
+        self.__queue_size = queue_size
+        self.__poll_interval = poll_interval
+        self.__metrics: Dict[str, Dict] = OrderedDict()
+
+    def get_metrics(self) -> Dict[str, Dict]:
+        """
+        :return: the metrics of each stage of the last run, by stage name, in the order of the stages
+        """
+
+        return self.__metrics
+
+    def __get(self, in_queue: queue.Queue, stop: threading.Event, metrics: Dict) -> Generator:
+        """
+        Iterates over the items of a queue until the end of its stream or the stop of the run
+        """
+
+        while True:
+            start = time.perf_counter()
+
+            while True:
+                try:
+                    item = in_queue.get(timeout=self.__poll_interval)
+                    break
+                except queue.Empty:
+                    if stop.is_set():
+                        return
+
+            metrics['wait_in'] += time.perf_counter() - start
+
+            if item is _END:
+                return
+
+            yield item
+
+    def __put(self, out_queue: queue.Queue, item, stop: threading.Event) -> bool:
+        """
+        Puts an item in a queue, waiting for a free slot unless the run is stopped
+
+        :return: whether the item was put
+        """
+
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=self.__poll_interval)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def __feed(self, items: Iterable, out_queue: queue.Queue, stop: threading.Event, errors: List, metrics: Dict):
+        """
+        Body of the thread of a stage, moving the outputs of the stage to its output queue
+        """
+
+        try:
+            for item in items:
+                metrics['items'] += 1
+                depth = out_queue.qsize()
+                metrics['depth_sum'] += depth
+                metrics['depth_max'] = max(metrics['depth_max'], depth)
+
+                start = time.perf_counter()
+                if not self.__put(out_queue, item, stop):
+                    return
+                metrics['wait_out'] += time.perf_counter() - start
+
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+        finally:
+            self.__put(out_queue, _END, stop)
+
+    def run(self,
+            source: Iterable,
+            stages: List[Tuple[str, Callable[[Iterable], Iterable]]],
+            source_name: str = 'source') -> Generator:
+        """
+        Runs the stages over the items of the source
+
+        :param source: the iterable of the inputs of the first stage, iterated in a thread of its own
+        :param stages: a list of (name, stage function), each function maps the iterable of the outputs of
+            the previous stage to the iterable of its outputs
+        :param source_name: the name of the source in the metrics
+        :return: a generator of the outputs of the last stage. Closing it stops the run, an error raised by
+            any stage is raised by it
+        """
+
+        names = [source_name] + [name for name, _ in stages]
+        self.__metrics = OrderedDict((name, {'items': 0,
+                                             'depth_sum': 0,
+                                             'depth_max': 0,
+                                             'wait_in': 0.0,
+                                             'wait_out': 0.0}) for name in names)
+
+        queues = [queue.Queue(maxsize=self.__queue_size) for _ in names]
+        stop = threading.Event()
+        errors: List[BaseException] = []
+
+        threads = [threading.Thread(target=self.__feed,
+                                    args=(source, queues[0], stop, errors, self.__metrics[source_name]),
+                                    name=source_name,
+                                    daemon=True)]
+
+        for i, (name, stage_fn) in enumerate(stages):
+            stage_inputs = self.__get(queues[i], stop, self.__metrics[name])
+            threads.append(threading.Thread(target=self.__feed,
+                                            args=(stage_fn(stage_inputs), queues[i + 1], stop, errors,
+                                                  self.__metrics[name]),
+                                            name=name,
+                                            daemon=True))
+
+        start = time.perf_counter()
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            yield from self.__get(queues[-1], stop, {'wait_in': 0.0})
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            self.__log_metrics(time.perf_counter() - start)
+
+        if errors:
+            raise errors[0]
+
+    def __log_metrics(self, elapsed: float):
+        lines = ['{:<16} {:>8} {:>10} {:>10} {:>12} {:>12}'.format('stage', 'items', 'avg depth', 'max depth',
+                                                                  'starved (s)', 'blocked (s)')]
+
+        for name, metrics in self.__metrics.items():
+            lines.append('{:<16} {:>8} {:>10.2f} {:>10} {:>12.2f} {:>12.2f}'.format(
+                name,
+                metrics['items'],
+                metrics['depth_sum'] / max(metrics['items'], 1),
+                metrics['depth_max'],
+                metrics['wait_in'],
+                metrics['wait_out']))
+
+        self.__log.info('Staged execution completed in {:.2f}s, queue size {}:\n{}'
+                        .format(elapsed, self.__queue_size, '\n'.join(lines)))
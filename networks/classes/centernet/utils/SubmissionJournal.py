@@ -0,0 +1,159 @@
+import os
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+DEFAULT_JOURNAL_PATH = os.path.join('datasets', 'submission_journal.tsv')
+
+FINGERPRINT_HEADER = '#fingerprint'
+
+
+class SubmissionJournal:
+    """
+    Append-only journal of the labels of the classified test pages, the checkpoint from which an
+    interrupted submission is resumed. Each page is a line 'image_id<TAB>labels'.
+
+    The first line '#fingerprint<TAB>fingerprint' records the inputs the labels were predicted from
+    (e.g. the weights of the classifier and the predicted bboxes), so that the journal of a different
+    run is not resumed.
+
+    Entries are appended in batches, each flushed and fsync'd, so that a crash loses at most the
+    pages of the batch being written. A torn last line is discarded when the journal is loaded.
+    """
+
+    def __init__(self, journal_path: str = DEFAULT_JOURNAL_PATH, sync_every: int = 32):
+        """
+        :param journal_path: the path to the journal file
+        :param sync_every: the number of pages appended in each fsync'd batch
+        """
+
+        self.__journal_path = journal_path
+        self.__sync_every = sync_every
+
+        self.__entries: Dict[str, str] = OrderedDict()
+        self.__fingerprint: Union[str, None] = None
+        self.__buffer: List[Tuple[str, str]] = []
+        self.__file = None
+
+    def __enter__(self) -> 'SubmissionJournal':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def load(self) -> 'SubmissionJournal':
+        """
+        Reads the entries of the journal, truncating a torn last line left by a crash
+
+        :return: the journal itself
+        """
+
+        self.__entries = OrderedDict()
+        self.__fingerprint = None
+
+        if not os.path.isfile(self.__journal_path):
+            return self
+
+        with open(self.__journal_path, 'rb') as f:
+            content = f.read()
+
+        # Only the lines terminated by a newline have been completely written
+        valid_end = content.rfind(b'\n') + 1
+
+        for line in content[:valid_end].decode('utf-8').splitlines():
+            image_id, labels = line.split('\t', 1)
+            if image_id == FINGERPRINT_HEADER:
+                self.__fingerprint = labels
+            else:
+                self.__entries[image_id] = labels
+
+        if valid_end < len(content):
+            with open(self.__journal_path, 'r+b') as f:
+                f.truncate(valid_end)
+
+        return self
+
+    def reset(self):
+        """
+        Deletes the journal, to start a submission from scratch
+        """
+
+        self.__buffer = []
+        self.close()
+
+        if os.path.isfile(self.__journal_path):
+            os.remove(self.__journal_path)
+
+        self.__entries = OrderedDict()
+        self.__fingerprint = None
+
+    def start(self, fingerprint: str):
+        """
+        Deletes the journal and starts a new one for the given inputs
+
+        :param fingerprint: the fingerprint of the inputs of the submission
+        """
+
+        self.reset()
+
+        self.__fingerprint = fingerprint
+        self.__buffer.append((FINGERPRINT_HEADER, fingerprint))
+        self.sync()
+
+    def get_fingerprint(self) -> Union[str, None]:
+        """
+        :return: the fingerprint of the inputs of the journaled submission, None if not recorded
+        """
+
+        return self.__fingerprint
+
+    def get_entries(self) -> Dict[str, str]:
+        """
+        :return: the labels of the journaled pages, by image id, in the order they were first appended
+        """
+
+        return self.__entries
+
+    def is_done(self, image_id: str) -> bool:
+        return image_id in self.__entries
+
+    def append(self, image_id: str, labels: str):
+        """
+        Appends the labels of a page, syncing the journal when a batch is complete
+
+        :param image_id: the id of the page
+        :param labels: the labels of the page, as a string 'label X Y label X Y ...'
+        """
+
+        self.__buffer.append((image_id, labels))
+        self.__entries[image_id] = labels
+
+        if len(self.__buffer) >= self.__sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Writes the buffered entries and forces them to disk
+        """
+
+        if not self.__buffer:
+            return
+
+        if self.__file is None:
+            journal_folder = os.path.dirname(self.__journal_path)
+            if journal_folder:
+                os.makedirs(journal_folder, exist_ok=True)
+
+            self.__file = open(self.__journal_path, 'a', encoding='utf-8')
+
+        self.__file.write(''.join('{}\t{}\n'.format(image_id, labels) for image_id, labels in self.__buffer))
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+        self.__buffer = []
+
+    def close(self):
+        self.sync()
+
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
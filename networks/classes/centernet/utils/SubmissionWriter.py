@@ -0,0 +1,62 @@
+import csv
+from typing import Iterable, List, Set
+
+
+class SubmissionWriter:
+    """
+    Buffered streaming writer of the rows of a submission csv, in the format:
+    - names of columns : <row index>, image_id, labels
+    - example of row   : <row index>, image_id, {label X Y} {...}
+
+    Rows are buffered and appended to the file in chunks, and the ids of the written images are
+    kept in memory, so that no row is ever read back from the file.
+    """
+
+    def __init__(self, path_to_submission: str, written_ids: Iterable[str] = (), chunk_size: int = 256):
+        """
+        :param path_to_submission: the path to the submission csv, which must already contain the header
+        :param written_ids: the ids of the images already written in the submission, in order
+        :param chunk_size: the number of rows buffered before each append to the file
+        """
+
+        self.__written_ids: Set[str] = set(written_ids)
+        self.__chunk_size = chunk_size
+        self.__buffer: List[List] = []
+        self.__n_rows = len(self.__written_ids)
+
+        self.__file = open(path_to_submission, 'a', newline='')
+        self.__writer = csv.writer(self.__file)
+
+    def __enter__(self) -> 'SubmissionWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_written(self, image_id: str) -> bool:
+        return image_id in self.__written_ids
+
+    def write_row(self, image_id: str, labels: str):
+        """
+        Buffers the row of an image, flushing the buffer when it is full
+
+        :param image_id: the id of the image
+        :param labels: the labels of the image, as a string 'label X Y label X Y ...'
+        """
+
+        self.__buffer.append([self.__n_rows, image_id, labels])
+        self.__written_ids.add(image_id)
+        self.__n_rows += 1
+
+        if len(self.__buffer) >= self.__chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.__writer.writerows(self.__buffer)
+        self.__file.flush()
+        self.__buffer = []
+
+    def close(self):
+        if not self.__file.closed:
+            self.flush()
+            self.__file.close()
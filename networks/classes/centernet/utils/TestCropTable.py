@@ -0,0 +1,93 @@
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+DEFAULT_TABLE_PATH = os.path.join('datasets', 'test_list.npz')
+
+
+class TestCropTable:
+    """
+    Columnar table of the test crops, handed from the classifier to the submission:
+    - page_ids: the ids of the pages with at least one crop, in the order of the predictions
+    - page_offsets: the crops of page i are the rows [page_offsets[i], page_offsets[i + 1])
+    - box_indices: for each crop, the index of its box among the predicted boxes of the page
+    - boxes: for each crop, the float coordinates of its box [ymin, xmin, ymax, xmax]
+
+    The table is persisted as a npz file.
+    """
+
+    def __init__(self,
+                 page_ids: np.ndarray,
+                 page_offsets: np.ndarray,
+                 box_indices: np.ndarray,
+                 boxes: np.ndarray):
+        self.__page_ids = page_ids
+        self.__page_offsets = page_offsets
+        self.__box_indices = box_indices
+        self.__boxes = boxes
+
+    @classmethod
+    def from_pages(cls,
+                   pages: List[Tuple[str, np.ndarray]],
+                   bbox_predictions: Dict[str, np.ndarray]) -> 'TestCropTable':
+        """
+        Builds the table from the cropped boxes of each page
+
+        :param pages: a list of (page path, indices of the cropped boxes), in the order of the predictions
+        :param bbox_predictions: the predicted bboxes, as a dict {page path: np.arr[score, ymin, xmin, ymax, xmax]}
+        :return: the table, leaving out the pages with no crops
+        """
+
+        pages = [(img_path, np.asarray(indices, dtype=np.int64)) for img_path, indices in pages if len(indices)]
+
+        page_ids = np.array([img_path.split(os.sep)[-1].split('.')[0] for img_path, _ in pages], dtype=np.str_)
+        page_offsets = np.concatenate(([0], np.cumsum([len(indices) for _, indices in pages]))).astype(np.int64)
+
+        if not pages:
+            return cls(page_ids, page_offsets, np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.float64))
+
+        box_indices = np.concatenate([indices for _, indices in pages])
+        boxes = np.concatenate([np.asarray(bbox_predictions[img_path], dtype=np.float64)[indices, 1:5]
+                                for img_path, indices in pages])
+
+        return cls(page_ids, page_offsets, box_indices, boxes)
+
+    @classmethod
+    def load(cls, table_path: str = DEFAULT_TABLE_PATH) -> 'TestCropTable':
+        with np.load(table_path) as table:
+            return cls(table['page_ids'], table['page_offsets'], table['box_indices'], table['boxes'])
+
+    def save(self, table_path: str = DEFAULT_TABLE_PATH):
+        table_folder = os.path.dirname(table_path)
+        if table_folder:
+            os.makedirs(table_folder, exist_ok=True)
+
+        np.savez(table_path,
+                 page_ids=self.__page_ids,
+                 page_offsets=self.__page_offsets,
+                 box_indices=self.__box_indices,
+                 boxes=self.__boxes)
+
+    def __len__(self) -> int:
+        return len(self.__page_ids)
+
+    def get_page_ids(self) -> np.ndarray:
+        return self.__page_ids
+
+    def get_page_offsets(self) -> np.ndarray:
+        return self.__page_offsets
+
+    def get_box_indices(self) -> np.ndarray:
+        return self.__box_indices
+
+    def get_boxes(self) -> np.ndarray:
+        return self.__boxes
+
+    def get_page_boxes(self, page_idx: int) -> np.ndarray:
+        """
+        :param page_idx: the index of the page in the table
+        :return: the boxes of the crops of the page, as rows [ymin, xmin, ymax, xmax]
+        """
+
+        return self.__boxes[self.__page_offsets[page_idx]:self.__page_offsets[page_idx + 1]]
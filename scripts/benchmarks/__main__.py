@@ -0,0 +1,52 @@
+import os
+
+from scripts.benchmarks.functions.nms import check_nms_backends, benchmark_nms_backends
+from scripts.benchmarks.functions.preprocessing import benchmark_preprocessing
+from scripts.benchmarks.functions.service import benchmark_inference_service
+from scripts.benchmarks.functions.targets import check_target_rendering, benchmark_target_rendering
+
+
+def main(nms: bool = True, targets: bool = True, preprocessing: bool = True, service: bool = False):
+    """
+    Runs the correctness checks and the benchmarks of the optimized routines.
+
+    :param nms: a boolean flag to check and benchmark the non-maximum suppression backends
+    :param targets: a boolean flag to check and benchmark the rendering of the detection targets
+    :param preprocessing: a boolean flag to benchmark the tf.py_function and native preprocessing paths
+    :param service: a boolean flag to load test the local inference server, which must be already running
+    """
+
+    print('\n---------------------------------------------------------------')
+    print('                          BENCHMARKS                           ')
+    print('---------------------------------------------------------------\n')
+
+    if nms:
+        print('Checking the NMS backends against the reference loop...')
+        check_nms_backends(box_counts=[1, 10, 100, 1000, 5000])
+
+        print('\nBenchmarking the NMS backends...')
+        benchmark_nms_backends(box_counts=[100, 500, 1000, 2000, 5000, 10000, 20000])
+        print('---------------------------------------------------------------')
+
+    if targets:
+        print('Checking the windowed target rendering against the dense one...')
+        check_target_rendering(char_counts=[0, 1, 10, 100, 300, 600])
+
+        print('\nBenchmarking the target rendering...')
+        benchmark_target_rendering(char_counts=[10, 100, 300, 600])
+        print('---------------------------------------------------------------')
+
+    if preprocessing:
+        print('Benchmarking the preprocessing of the training set...')
+        benchmark_preprocessing()
+        print('---------------------------------------------------------------')
+
+    if service:
+        print('Load testing the local inference server...')
+        benchmark_inference_service(images_path=os.path.join('datasets', 'kaggle', 'testing', 'images'),
+                                    concurrency_levels=[1, 2, 4, 8, 16])
+        print('---------------------------------------------------------------')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import time
+from typing import List
+
+import numpy as np
+
+from networks.classes.centernet.utils.NMSEngine import NMSEngine
+
+
+def generate_page_boxes(n_boxes: int, seed: int = 0) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Generates score-sorted candidate boxes resembling a dense page: characters laid out in vertical
+    columns, each one detected several times with some jitter.
+
+    :param n_boxes: the number of candidate boxes
+    :param seed: the seed of the random generator
+    :return: the xmin, xmax, ymin and ymax arrays
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # Roughly 4 candidates for each character
+    n_chars = max(1, n_boxes // 4)
+    n_columns = max(1, int(np.sqrt(n_chars / 3)))
+    page_w, page_h = 30.0 * n_columns, 90.0 * int(np.ceil(n_chars / n_columns))
+
+    char_x = (np.arange(n_chars) % n_columns) * 30.0 + 15
+    char_y = (np.arange(n_chars) // n_columns) * 30.0 + 15
+
+    owner = rng.randint(0, n_chars, n_boxes)
+    x_c = char_x[owner] + rng.normal(0, 3, n_boxes)
+    y_c = char_y[owner] + rng.normal(0, 3, n_boxes)
+    width = rng.uniform(12, 28, n_boxes)
+    height = rng.uniform(12, 28, n_boxes)
+
+    score = rng.uniform(0.3, 1, n_boxes)
+    score_sort = np.argsort(score)[::-1]
+
+    xmin = np.clip(x_c - width / 2, 0, page_w)[score_sort]
+    xmax = np.clip(x_c + width / 2, 0, page_w)[score_sort]
+    ymin = np.clip(y_c - height / 2, 0, page_h)[score_sort]
+    ymax = np.clip(y_c + height / 2, 0, page_h)[score_sort]
+
+    return xmin, xmax, ymin, ymax
+
+
+def check_nms_backends(box_counts: List[int], iou_thresh: float = 0.4, n_seeds: int = 3):
+    """
+    Checks that every backend keeps exactly the same boxes of the reference loop
+
+    :param box_counts: the numbers of candidate boxes to test
+    :param iou_thresh: the overlap threshold of the suppression
+    :param n_seeds: the number of random pages for each box count
+    """
+
+    reference = NMSEngine(backend='loop')
+    engines = [NMSEngine(backend=backend) for backend in ['blocked', 'sweep', 'auto']]
+
+    for n_boxes in box_counts:
+        for seed in range(n_seeds):
+            boxes = generate_page_boxes(n_boxes, seed)
+            expected = list(reference.suppress(*boxes, iou_thresh))
+
+            for engine in engines:
+                kept = list(engine.suppress(*boxes, iou_thresh))
+                assert kept == expected, \
+                    'Backend {} differs from the reference on {} boxes (seed {})' \
+                    .format(engine.get_backend(), n_boxes, seed)
+
+        print('* {:>6} boxes: all backends match the reference'.format(n_boxes))
+
+
+def benchmark_nms_backends(box_counts: List[int], iou_thresh: float = 0.4, repeats: int = 3):
+    """
+    Prints the best execution time of each backend over the given box counts
+
+    :param box_counts: the numbers of candidate boxes to benchmark
+    :param iou_thresh: the overlap threshold of the suppression
+    :param repeats: the number of runs of each backend, the best one is reported
+    """
+
+    backends = ['loop', 'blocked', 'sweep', 'auto']
+
+    print('{:>8} '.format('boxes') + ' '.join('{:>10}'.format(b) for b in backends) + '   (ms)')
+
+    for n_boxes in box_counts:
+        boxes = generate_page_boxes(n_boxes)
+        timings = []
+
+        for backend in backends:
+            engine = NMSEngine(backend=backend)
+            best = float('inf')
+
+            for _ in range(repeats):
+                start = time.perf_counter()
+                engine.suppress(*boxes, iou_thresh)
+                best = min(best, time.perf_counter() - start)
+
+            timings.append(best * 1000)
+
+        print('{:>8} '.format(n_boxes) + ' '.join('{:>10.1f}'.format(t) for t in timings))
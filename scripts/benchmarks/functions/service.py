@@ -0,0 +1,72 @@
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+from networks.classes.centernet.utils.InferenceClient import InferenceClient
+
+
+def benchmark_inference_service(images_path: str,
+                                concurrency_levels: List[int],
+                                n_requests: int = 64,
+                                port: int = 8500):
+    """
+    Load tests a running local inference server (see the 'serve' operation of __centernet__), sending the
+    same pages from an increasing number of concurrent clients
+
+    :param images_path: the folder of the jpg pages to send
+    :param concurrency_levels: the numbers of concurrent clients to test
+    :param n_requests: the number of pages sent at each concurrency level
+    :param port: the port the server listens on
+    """
+
+    client = InferenceClient(port=port)
+
+    if not client.health():
+        print('No inference server is listening on port {}, skipping.'.format(port))
+        return
+
+    img_paths = sorted(glob.glob(os.path.join(images_path, '*.jpg')))[:n_requests]
+    if not img_paths:
+        print('No pages found in {}, skipping.'.format(images_path))
+        return
+
+    pages = []
+    for img_path in img_paths:
+        with open(img_path, 'rb') as f:
+            pages.append(f.read())
+
+    def send(i: int) -> float:
+        start = time.perf_counter()
+        client.predict(pages[i % len(pages)], image_id=str(i))
+        return time.perf_counter() - start
+
+    # Warm up the models
+    send(0)
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>16} {:>16}'.format('clients', 'pages/s', 'p50 (ms)', 'p95 (ms)',
+                                                           'detector batch', 'classifier batch'))
+
+    for n_clients in concurrency_levels:
+        stats_before = client.get_stats()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_clients) as executor:
+            latencies = np.array(list(executor.map(send, range(n_requests))))
+        elapsed = time.perf_counter() - start
+
+        stats_after = client.get_stats()
+        mean_batch_sizes = []
+        for model in ['detector', 'classifier']:
+            n_batches = stats_after[model]['batches'] - stats_before[model]['batches']
+            n_samples = stats_after[model]['samples'] - stats_before[model]['samples']
+            mean_batch_sizes.append(n_samples / max(n_batches, 1))
+
+        print('{:>8} {:>12.2f} {:>12.1f} {:>12.1f} {:>16.2f} {:>16.2f}'.format(n_clients,
+                                                                              n_requests / elapsed,
+                                                                              np.percentile(latencies, 50) * 1000,
+                                                                              np.percentile(latencies, 95) * 1000,
+                                                                              *mean_batch_sizes))
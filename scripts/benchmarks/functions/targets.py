@@ -0,0 +1,88 @@
+import time
+from typing import List
+
+import numpy as np
+
+from networks.classes.centernet.datasets.TargetRenderer import TargetRenderer
+
+
+def generate_page_annotations(n_chars: int, seed: int = 0) -> (np.ndarray, int, int):
+    """
+    Generates the annotations of a page with the format of PreprocessingDataset:
+    [class, x_center, y_center, width, height]
+
+    :param n_chars: the number of characters in the page
+    :param seed: the seed of the random generator
+    :return: the annotations and the width and height of the page
+    """
+
+    rng = np.random.RandomState(seed)
+    pic_width, pic_height = 2000, 3000
+
+    annotations = np.zeros((n_chars, 5), dtype='int32')
+    annotations[:, 0] = rng.randint(0, 4000, n_chars)
+    annotations[:, 3] = rng.randint(20, 120, n_chars)
+    annotations[:, 4] = rng.randint(20, 120, n_chars)
+    annotations[:, 1] = rng.randint(0, pic_width, n_chars)
+    annotations[:, 2] = rng.randint(0, pic_height, n_chars)
+
+    return annotations, pic_width, pic_height
+
+
+def check_target_rendering(char_counts: List[int], n_seeds: int = 5):
+    """
+    Checks that the windowed rendering yields the same float32 targets of the dense one, both for
+    full pages and for random crops
+
+    :param char_counts: the numbers of characters per page to test
+    :param n_seeds: the number of random pages for each count
+    """
+
+    renderer = TargetRenderer(output_height=128, output_width=128)
+
+    for n_chars in char_counts:
+        for seed in range(n_seeds):
+            annotations, pic_width, pic_height = generate_page_annotations(n_chars, seed)
+
+            rng = np.random.RandomState(seed)
+            crop_h, crop_w = int(pic_height * rng.uniform(0.3, 1)), int(pic_width * rng.uniform(0.3, 1))
+            crops = [(0, 0, pic_height, pic_width),
+                     (rng.randint(0, pic_height - crop_h + 1), rng.randint(0, pic_width - crop_w + 1), crop_h, crop_w)]
+
+            for crop in crops:
+                expected = renderer.render_dense(annotations, *crop).astype(np.float32)
+                rendered = renderer.render(annotations, *crop).astype(np.float32)
+
+                assert expected.tobytes() == rendered.tobytes(), \
+                    'Rendered targets differ from the reference for {} chars (seed {})'.format(n_chars, seed)
+
+        print('* {:>4} chars: targets are byte-identical'.format(n_chars))
+
+
+def benchmark_target_rendering(char_counts: List[int], repeats: int = 3):
+    """
+    Prints the characters rendered per second by the dense and the windowed rendering
+
+    :param char_counts: the numbers of characters per page to benchmark
+    :param repeats: the number of runs of each rendering, the best one is reported
+    """
+
+    renderer = TargetRenderer(output_height=128, output_width=128)
+
+    print('{:>8} {:>12} {:>12}   (chars/sec)'.format('chars', 'dense', 'windowed'))
+
+    for n_chars in char_counts:
+        annotations, pic_width, pic_height = generate_page_annotations(n_chars)
+        rates = []
+
+        for render in [renderer.render_dense, renderer.render]:
+            best = float('inf')
+
+            for _ in range(repeats):
+                start = time.perf_counter()
+                render(annotations, 0, 0, pic_height, pic_width)
+                best = min(best, time.perf_counter() - start)
+
+            rates.append(n_chars / best)
+
+        print('{:>8} {:>12.0f} {:>12.0f}'.format(n_chars, *rates))
@@ -1,8 +1,8 @@
 import os
 import pandas as pd
 import regex as re
-from PIL import Image
 
+from networks.classes.centernet.utils.ImageSizeIndex import get_image_size_index
 from scripts.data_format_conversion.functions.darkflow_conversion import convert_to_darkflow, \
     write_as_darkflow
 from scripts.data_format_conversion.functions.yolov2_conversion import convert_to_yolov2, write_as_yolov2
@@ -78,8 +78,9 @@ def get_annotation_data(image_base_name: str,
     # Convert the string of labels to list
     labels = [line[:-1] for line in re.findall(r"(?:\S*\s){5}", str(labels))]
 
-    # Get the width and height of the image
-    img_width, img_height = Image.open(os.path.join(path_to_images, to_file_name(image_base_name))).size
+    # Get the width and height of the image, from its header through the persistent index
+    img_width, img_height = get_image_size_index().get_size(os.path.join(path_to_images,
+                                                                         to_file_name(image_base_name)))
 
     convert_to = {
         'YOLOv2': convert_to_yolov2,
@@ -177,6 +178,9 @@ def generate_annotations(path_to_annotations, path_to_images, path_to_map, path_
         # Write the annotation on file
         write_as[ann_format](annotation, path_to_annotations, image_id)
 
+    # Store the sizes of the images read so far
+    get_image_size_index().save()
+
     # Count the written annotations (just for check)
     if ann_format != 'frcnn':
         count = len(list(os.listdir(path_to_annotations)))